@@ -0,0 +1 @@
+"""Offline analysis of the results exported by process_iRacing_data/results_export.py"""
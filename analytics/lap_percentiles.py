@@ -0,0 +1,130 @@
+"""
+Lap time percentiles for every car class at every track, from the exported Parquet results
+
+Only the columns needed are read and the rows are grouped with a single sort, so the
+percentiles of millions of rows are computed without a Python loop over the rows.
+Rows exported more than once by a retried batch are counted once.
+
+Usage: python -m analytics.lap_percentiles PATH [--lap best_lap_time] [--session RACE] [--percentiles 5 50 95]
+PATH is the directory or s3://bucket/prefix the results were exported under.
+"""
+
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+#Columns which identify a row, used to drop rows exported more than once
+#The driver name tells apart rows without a customer id, e.g. teams
+ROW_KEY = ('subsession_id', 'simsession_name', 'cust_id', 'driver')
+
+def load_laps(source, lap_column='best_lap_time', session='RACE'):
+    """
+    Read the lap times of one session type from the exported results
+
+    Args:
+        source (string) : directory or s3://bucket/prefix the results were exported under
+        lap_column      : the lap time column to read
+        session         : simsession_name of the rows to keep, every row if None
+    Returns:
+        pyarrow Table of car_class, track and lap time columns, without rows lacking a lap time
+    """
+    #The track and week partitions are only for layout, every file holds its own track and end_time columns
+    dataset = ds.dataset(source, format='parquet')
+    condition = pc.field(lap_column).is_valid()
+    if session:
+        condition = condition & (pc.field('simsession_name') == session)
+    table = dataset.to_table(columns=list(ROW_KEY) + ['car_class', 'track', lap_column], filter=condition)
+    return drop_duplicate_rows(table).select(['car_class', 'track', lap_column])
+
+def drop_duplicate_rows(table):
+    """returns the table with only the first of any rows sharing the same ROW_KEY"""
+    if table.num_rows == 0:
+        return table
+    #Each key column is replaced by its dictionary code, missing values taking a code of their own
+    #The codes are combined a column at a time and renumbered, so the combined key never overflows
+    key = None
+    for name in ROW_KEY:
+        encoded = table.column(name).combine_chunks().dictionary_encode()
+        codes = pc.fill_null(encoded.indices, len(encoded.dictionary)).to_numpy().astype(np.int64)
+        if key is None:
+            key = codes
+        else:
+            key = np.unique(key * (len(encoded.dictionary) + 1) + codes, return_inverse=True)[1]
+    _, first = np.unique(key, return_index=True)
+    return table.take(pa.array(np.sort(first)))
+
+def group_percentiles(groups, values, percentiles):
+    """
+    Compute percentiles of values for each group, interpolating linearly as numpy.percentile does
+
+    Args:
+        groups      : integer numpy array of the group of each value
+        values      : float numpy array
+        percentiles : sequence of percentiles between 0 and 100
+    Returns:
+        (group ids, counts, array of shape (number of groups, number of percentiles))
+    """
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    counts = np.diff(np.r_[starts, len(groups)])
+
+    positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(percentiles, dtype=float)[None, :] / 100)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    fraction = positions - lower
+    result = values[lower] + (values[upper] - values[lower]) * fraction
+    return groups[starts], counts, result
+
+def lap_percentiles(table, lap_column='best_lap_time', percentiles=(5, 25, 50, 75, 95)):
+    """
+    Lap time percentiles for every car class and track combination in the table
+
+    Args:
+        table       : pyarrow Table with car_class, track and lap_column columns, as returned by load_laps
+        lap_column  : the lap time column
+        percentiles : sequence of percentiles between 0 and 100
+    Returns:
+        dict of (car_class, track) -> {'count': int, percentile: lap time in seconds}
+    """
+    if table.num_rows == 0:
+        return {}
+    car_classes = table.column('car_class').combine_chunks().dictionary_encode()
+    tracks = table.column('track').combine_chunks().dictionary_encode()
+    class_codes = car_classes.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    track_codes = tracks.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    groups = class_codes * len(tracks.dictionary) + track_codes
+    values = table.column(lap_column).to_numpy()
+
+    group_ids, counts, result = group_percentiles(groups, values, percentiles)
+
+    class_names = car_classes.dictionary.to_pylist()
+    track_names = tracks.dictionary.to_pylist()
+    ret = {}
+    for group, count, row in zip(group_ids, counts, result):
+        key = (class_names[group // len(track_names)], track_names[group % len(track_names)])
+        ret[key] = {'count': int(count)}
+        ret[key].update((p, float(v)) for p, v in zip(percentiles, row))
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--lap', default='best_lap_time', choices=('best_lap_time', 'best_qual_lap_time', 'average_lap'))
+    parser.add_argument('--session', default='RACE', help='simsession_name of the rows to use, empty for all')
+    parser.add_argument('--percentiles', type=float, nargs='+', default=[5, 25, 50, 75, 95])
+    args = parser.parse_args()
+
+    table = load_laps(args.path, args.lap, args.session or None)
+    results = lap_percentiles(table, args.lap, args.percentiles)
+    print(f"{'class':<30} {'track':<45} {'laps':>8} " + ' '.join(f"{'p' + format(p, 'g'):>9}" for p in args.percentiles))
+    for (car_class, track), stats in sorted(results.items()):
+        print(f"{car_class:<30} {track:<45} {stats['count']:>8} "
+              + ' '.join(f"{stats[p]:>9.3f}" for p in args.percentiles))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Compares sequential chunk downloads with concurrent and streamed downloads over a pooled session
+
+A local stub server serves N chunks of search results, each delayed by an artificial latency.
+The sequential approach opens a new connection for every chunk. The concurrent approach fetches
+whole chunks at once over the downloader's shared keep-alive session, as the downloader did before
+it streamed. The streaming rows consume items one at a time from iterChunkItems, as the query
+function does. Peak memory is measured with tracemalloc.
+
+Usage: python -m benchmarks.bench_chunk_download [num_chunks] [latency_ms]
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.common import add_function_path
+from benchmarks.stub_server import StubServer
+
+add_function_path('run_iRacing_query')
+
+import chunkDownloader  # pylint: disable=wrong-import-position
+
+def make_routes(num_chunks, items_per_chunk=500):
+    routes = {}
+    for n in range(num_chunks):
+        chunk = [
+            {'subsession_id': n * items_per_chunk + i, 'end_time': '2022-08-14T10:34:55Z'}
+            for i in range(items_per_chunk)
+        ]
+        body = json.dumps(chunk)
+        routes[f'/chunk_{n}.json'] = lambda handler, body=body: (200, {'Content-Type': 'application/json'}, body)
+    return routes
+
+def sequential(base_url, names):
+    """the original approach, a bare requests.get per chunk"""
+    ret = []
+    for j in names:
+        r2 = requests.get(f"{base_url}{j}")
+        for k in json.loads(r2.text):
+            ret.append(k)
+    return ret
+
+def download_chunk(url):
+    r = chunkDownloader.getSession().get(url)
+    r.raise_for_status()
+    return json.loads(r.text)
+
+def concurrent(base_url, names, workers):
+    """downloads and decodes whole chunks, up to workers at once, keeping every item"""
+    urls = [f"{base_url}{j}" for j in names]
+    if workers <= 1:
+        chunks = [download_chunk(url) for url in urls]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(download_chunk, urls))
+    ret = []
+    for data in chunks:
+        ret.extend(data)
+    return ret
+
+def streamed(base_url, names, workers):
+    """consumes every item as it arrives, keeping only a count and the latest end_time"""
+    count = 0
+    latest = ''
+    for item in chunkDownloader.iterChunkItems(base_url, names, workers=workers):
+        count += 1
+        latest = max(latest, item['end_time'])
+    return count
+
+def measure(func, *args):
+    """returns the result, duration and peak traced memory of func(*args)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, duration, peak
+
+def main():
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    names = [f'chunk_{n}.json' for n in range(num_chunks)]
+
+    with StubServer(make_routes(num_chunks), latency=latency) as server:
+        base_url = f"{server.url}/"
+        expected, duration, peak = measure(sequential, base_url, names)
+        print(f"{'sequential':>22} {duration * 1000:>9.0f} ms {peak / 2**20:>8.1f} MiB peak "
+              f"{server.connections:>4} new connections")
+
+        for workers in (1, 4, 8, 16):
+            connections = server.connections
+            result, duration, peak = measure(concurrent, base_url, names, workers)
+            assert result == expected
+            print(f"{f'{workers} workers':>22} {duration * 1000:>9.0f} ms {peak / 2**20:>8.1f} MiB peak "
+                  f"{server.connections - connections:>4} new connections")
+
+        for workers in (1, 8):
+            connections = server.connections
+            count, duration, peak = measure(streamed, base_url, names, workers)
+            assert count == len(expected)
+            print(f"{f'{workers} workers, streamed':>22} {duration * 1000:>9.0f} ms {peak / 2**20:>8.1f} MiB peak "
+                  f"{server.connections - connections:>4} new connections")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Compares the per class aggregation in process_iracing_data with the single pass aggregation
+
+The sample subsession in events/iRDataTest.JSON is scaled up to multiclass fields of
+increasing size. The per class approach re-scans the results once for every class,
+the single pass approach should stay flat as the number of classes grows.
+
+Usage: python -m benchmarks.bench_class_aggregation
+"""
+
+import os
+
+from benchmarks.common import add_function_path, load_sample_results, scale_results, time_call
+
+os.environ.setdefault('table_name', 'irstats_iRacing_Data')
+add_function_path('process_iRacing_data')
+
+import process_iracing_data  # pylint: disable=wrong-import-position
+
+def per_class(data):
+    """the original approach, one pass over the results for every class"""
+    return {
+        car_class: process_iracing_data.generate_class_specific_data(car_class, data)
+        for car_class in process_iracing_data.get_car_class_list(data)
+    }
+
+def main():
+    sample = load_sample_results()
+    print(f"{'classes':>8} {'drivers':>8} {'per class (ms)':>15} {'single pass (ms)':>17} {'speedup':>8}")
+    for field_size in (60, 600):
+        for num_classes in (1, 2, 6, 12, 30):
+            data = scale_results(sample, num_classes, field_size // num_classes)
+            assert per_class(data) == process_iracing_data.generate_all_class_data(data)
+            old = time_call(per_class, data, number=20)
+            new = time_call(process_iracing_data.generate_all_class_data, data, number=20)
+            print(f"{num_classes:>8} {field_size:>8} {old * 1000:>15.3f} {new * 1000:>17.3f} {old / new:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
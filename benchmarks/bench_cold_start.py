@@ -0,0 +1,158 @@
+"""
+Measures the import time and cold start of each Lambda function
+
+Every measurement runs in a fresh interpreter, as a cold Lambda container would.
+  import only   : importing the handler module with no AWS available, as Lambda's init phase
+                  sees it before any AWS call succeeds. Modules which call AWS at import fail here.
+  cold start    : importing the module and running its first invocation against moto,
+                  counting the AWS calls made. GetQueueUrl lookups are the extra round trips
+                  a real cold start pays for.
+
+Pass --baseline with a git ref to measure that revision of the tree alongside the working tree.
+
+Usage: python -m benchmarks.bench_cold_start --baseline HEAD~1
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from benchmarks.common import ROOT, SAMPLE_FILE
+
+FUNCTIONS = (
+    ('generate_session_list_query', 'GenerateSessionListQuery'),
+    ('run_iRacing_query', 'RuniRacingQuery'),
+    ('process_iRacing_data', 'process_iracing_data'),
+)
+
+ENVIRONMENT = {
+    'table_name': 'irStats_Generate_Session_List_Parameters',
+    'queue_name': 'irStats_iRacingApiQueryQueue',
+    'default_time': '2022-08-15T00:00Z',
+    'category_ids': '2',
+    'event_types': '5',
+    'official_only': 'true',
+    'bucket_name': 'irstats-storage',
+    'cookie_file_name': 'iRCookieJar.json',
+    'api_queue_name': 'irStats_iRacingApiQueryQueue',
+    'data_queue_name': 'irStats_iRacingDataProcessingQueue',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_DEFAULT_REGION': 'eu-west-2',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+}
+
+#Run in the child interpreter, prints a JSON line with the measurements
+CHILD = r'''
+import json, os, sys, time
+tree, function_dir, module_name, mode, sample_file = sys.argv[1:6]
+for path in (os.path.join(tree, 'common'), os.path.join(tree, function_dir)):
+    sys.path.insert(0, path)
+result = {}
+if mode == 'import':
+    start = time.perf_counter()
+    try:
+        __import__(module_name)
+        result['import_ms'] = (time.perf_counter() - start) * 1000
+    except Exception as e:
+        result['error'] = type(e).__name__
+    print(json.dumps(result))
+    sys.exit(0)
+
+import boto3, botocore.client
+from moto import mock_aws
+calls = []
+make_api_call = botocore.client.BaseClient._make_api_call
+def counting_make_api_call(self, operation_name, api_params):
+    calls.append(operation_name)
+    return make_api_call(self, operation_name, api_params)
+botocore.client.BaseClient._make_api_call = counting_make_api_call
+
+with mock_aws():
+    session = boto3.session.Session(region_name='eu-west-2')
+    sqs = session.resource('sqs')
+    urls = {name: sqs.create_queue(QueueName=name).url for name in (os.environ['api_queue_name'], os.environ['data_queue_name'])}
+    if os.environ.get('with_queue_urls'):
+        os.environ['queue_url'] = os.environ['api_queue_url'] = urls[os.environ['api_queue_name']]
+        os.environ['data_queue_url'] = urls[os.environ['data_queue_name']]
+    dynamodb = session.resource('dynamodb')
+    dynamodb.create_table(TableName='irStats_Generate_Session_List_Parameters',
+        KeySchema=[{'AttributeName': 'Parameter', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'Parameter', 'AttributeType': 'S'}], BillingMode='PAY_PER_REQUEST')
+    dynamodb.create_table(TableName='irstats_iRacing_Data',
+        KeySchema=[{'AttributeName': 'CarClass', 'KeyType': 'HASH'}, {'AttributeName': 'TrackName', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'CarClass', 'AttributeType': 'S'}, {'AttributeName': 'TrackName', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    if module_name == 'process_iracing_data':
+        os.environ['table_name'] = 'irstats_iRacing_Data'
+    del calls[:]
+    start = time.perf_counter()
+    module = __import__(module_name)
+    result['import_ms'] = (time.perf_counter() - start) * 1000
+    result['import_calls'] = list(calls)
+    del calls[:]
+    start = time.perf_counter()
+    if module_name == 'GenerateSessionListQuery':
+        module.lambda_handler({}, None)
+    elif module_name == 'process_iracing_data':
+        with open(sample_file, encoding='utf-8') as f:
+            module.lambda_handler(json.load(f), None)
+    result['invoke_ms'] = (time.perf_counter() - start) * 1000
+    result['invoke_calls'] = list(calls)
+print(json.dumps(result))
+'''
+
+def measure(tree, function_dir, module_name, mode, repeat, env):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD, tree, function_dir, module_name, mode, SAMPLE_FILE],
+            env=env, capture_output=True, text=True, check=True, timeout=120,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    result = dict(runs[0])
+    for key in ('import_ms', 'invoke_ms'):
+        if key in result:
+            result[key] = statistics.median(run[key] for run in runs)
+    return result
+
+def export_tree(ref, directory):
+    """writes the tree at a git ref into directory"""
+    archive = os.path.join(directory, 'tree.tar')
+    subprocess.run(['git', 'archive', '--format=tar', '-o', archive, ref], cwd=ROOT, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(directory)
+    return directory
+
+def report(label, tree, repeat):
+    env = dict(os.environ, **ENVIRONMENT)
+    #Nothing listens here, any AWS call made while importing fails straight away
+    env['AWS_ENDPOINT_URL'] = 'http://127.0.0.1:9'
+    moto_env = dict(os.environ, **ENVIRONMENT, with_queue_urls='1')
+    print(label)
+    print(f"  {'function':<26} {'import only':>14} {'cold import':>12} {'first invoke':>13}  AWS calls on cold start")
+    for function_dir, module_name in FUNCTIONS:
+        imported = measure(tree, function_dir, module_name, 'import', repeat, env)
+        cold = measure(tree, function_dir, module_name, 'cold', repeat, moto_env)
+        import_only = f"{imported['import_ms']:.0f} ms" if 'import_ms' in imported else f"fails ({imported['error']})"
+        calls = cold['import_calls'] + cold['invoke_calls']
+        summary = ', '.join(f"{name} x{calls.count(name)}" for name in dict.fromkeys(calls)) or 'none'
+        print(f"  {module_name:<26} {import_only:>14.40} {cold['import_ms']:>9.0f} ms {cold['invoke_ms']:>10.0f} ms  {summary}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--baseline', help='git ref to compare the working tree with')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as directory:
+            report(f"baseline ({args.baseline})", export_tree(args.baseline, directory), args.repeat)
+    report('working tree', ROOT, args.repeat)
+
+if __name__ == '__main__':
+    main()
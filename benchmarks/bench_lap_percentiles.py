@@ -0,0 +1,87 @@
+"""
+Times the lap time percentiles of analytics.lap_percentiles over millions of exported rows
+
+Synthetic results are written in the layout results_export produces, spread over a number
+of car classes, tracks and weeks, then read back and reduced to percentiles for every class
+and track. The result is checked against numpy.percentile on each group.
+
+Usage: python -m benchmarks.bench_lap_percentiles [--rows 5000000]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pyarrow as pa
+
+from benchmarks.common import add_function_path
+
+os.environ.setdefault('table_name', 'irstats_iRacing_Data')
+add_function_path('process_iRacing_data')
+
+import results_export  # pylint: disable=wrong-import-position
+from analytics import lap_percentiles  # pylint: disable=wrong-import-position
+
+def write_rows(destination, num_rows, num_classes, num_tracks, rows_per_file=250000):
+    """writes num_rows synthetic driver rows under destination, returns the number of files"""
+    rng = np.random.default_rng(1)
+    schema = results_export.get_schema()
+    start = datetime(2022, 1, 3, tzinfo=timezone.utc)
+    files = 0
+    for offset in range(0, num_rows, rows_per_file):
+        n = min(rows_per_file, num_rows - offset)
+        car_class = rng.integers(0, num_classes, n)
+        track = rng.integers(0, num_tracks, n)
+        columns = {
+            'subsession_id': np.arange(offset, offset + n) // 20,
+            'end_time': [start + timedelta(weeks=files % 12)] * n,
+            'track': [f"Track {t}" for t in track],
+            'simsession_name': ['RACE'] * n,
+            'car_class': [f"Class {c}" for c in car_class],
+            'cust_id': np.arange(offset, offset + n) % 20,
+            'driver': ['Driver'] * n,
+            'car': ['Car'] * n,
+            'best_lap_time': 60 + track * 5 + car_class + rng.gamma(2.0, 0.8, n),
+            'best_qual_lap_time': [None] * n,
+            'average_lap': [None] * n,
+            'irating': rng.integers(500, 8000, n).astype(np.int32),
+            'temp': rng.uniform(5, 35, n),
+        }
+        table = pa.Table.from_pydict(columns, schema=schema)
+        results_export.write_parquet(table, os.path.join(destination, f"part-{files}.parquet"))
+        files += 1
+    return files
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000000)
+    parser.add_argument('--classes', type=int, default=8)
+    parser.add_argument('--tracks', type=int, default=40)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as destination:
+        files = write_rows(destination, args.rows, args.classes, args.tracks)
+
+        start = time.perf_counter()
+        table = lap_percentiles.load_laps(destination)
+        loaded = time.perf_counter()
+        results = lap_percentiles.lap_percentiles(table)
+        finished = time.perf_counter()
+
+        #the same percentiles computed one group at a time with numpy
+        laps = table.column('best_lap_time').to_numpy()
+        classes = np.array(table.column('car_class').to_pylist())
+        tracks = np.array(table.column('track').to_pylist())
+        for (car_class, track), stats in list(results.items())[:10]:
+            expected = np.percentile(laps[(classes == car_class) & (tracks == track)], [5, 25, 50, 75, 95])
+            assert np.allclose([stats[p] for p in (5, 25, 50, 75, 95)], expected)
+
+    print(f"{args.rows} rows in {files} files, {len(results)} class and track groups")
+    print(f"read {loaded - start:.2f}s, percentiles {finished - loaded:.2f}s, "
+          f"{args.rows / (finished - start) / 1e6:.1f}M rows/s")
+
+if __name__ == '__main__':
+    main()
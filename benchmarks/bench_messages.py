@@ -0,0 +1,110 @@
+"""
+Compares the size and encode/decode speed of the messages passed between pipeline stages
+
+The version 1 messages were JSON objects, the results being the projected dict in an envelope
+and the fetches {'type': 'RetrieveData', ...}. The versioned schema sends both as JSON arrays
+without field names, encoded with orjson when it is installed and the json module otherwise.
+Encoding includes projecting the raw results, decoding includes turning them back into the
+dict read by process_iracing_data, so each figure is the whole cost to a stage.
+
+Usage: python -m benchmarks.bench_messages [--classes 3] [--drivers-per-class 15]
+"""
+
+import argparse
+import json
+
+from benchmarks.common import add_function_path, load_sample_results, scale_results, time_call
+
+add_function_path('common')
+
+from irstats_common import messages  # pylint: disable=wrong-import-position
+from irstats_common.messages import (  # pylint: disable=wrong-import-position
+    DRIVER_FIELDS, RESULT_FIELDS, SESSION_FIELDS, TRACK_FIELDS, WEATHER_FIELDS,
+)
+
+def _pick(data, fields):
+    return {k: data[k] for k in fields if k in data}
+
+def project_results_v1(data):
+    #The projection the version 1 envelope carried, a copy of the raw results with only the fields processing reads
+    ret = _pick(data, RESULT_FIELDS)
+    if isinstance(ret.get('track'), dict):
+        ret['track'] = _pick(ret['track'], TRACK_FIELDS)
+    if isinstance(ret.get('weather'), dict):
+        ret['weather'] = _pick(ret['weather'], WEATHER_FIELDS)
+    if 'session_results' in ret:
+        ret['session_results'] = [
+            dict(_pick(session, SESSION_FIELDS), results=[_pick(j, DRIVER_FIELDS) for j in session['results']])
+            for session in ret['session_results']
+        ]
+    return ret
+
+def encode_results_v1(raw):
+    return json.dumps({'envelope': 1, 'inline': project_results_v1(raw)}, separators=(',', ':'))
+
+def decode_results_v1(body):
+    return json.loads(body)['inline']
+
+def encode_fetch_v1(fetch):
+    return json.dumps({'type': 'RetrieveData', 'url': fetch.url, 'subsession_id': fetch.subsession_id, 'end_time': fetch.end_time})
+
+def decode_fetch_v1(body):
+    return json.loads(body)
+
+def encode_results_v2(raw):
+    return messages.Results.from_results(raw).encode()
+
+def decode_results_v2(body):
+    return messages.decode(body, (messages.Results,)).to_dict()
+
+def encode_fetch_v2(fetch):
+    return fetch.encode()
+
+def decode_fetch_v2(body):
+    return messages.decode_task(body)
+
+def measure(encode, decode, value, number):
+    body = encode(value)
+    return {
+        'bytes': len(body.encode('utf-8')),
+        'encode': time_call(encode, value, number=number),
+        'decode': time_call(decode, body, number=number),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=int, default=3)
+    parser.add_argument('--drivers-per-class', type=int, default=15)
+    args = parser.parse_args()
+
+    raw = scale_results(load_sample_results(), args.classes, args.drivers_per_class)
+    fetch = messages.ResultsFetch(
+        f"https://members-ng.iracing.com/data/results/get?subsession_id={raw['subsession_id']}",
+        raw['subsession_id'], raw['end_time'],
+    )
+    assert decode_results_v2(encode_results_v2(raw)) == decode_results_v1(encode_results_v1(raw))
+
+    orjson = messages.orjson
+    formats = [('v1 json', encode_results_v1, decode_results_v1, encode_fetch_v1, decode_fetch_v1)]
+    formats.append(('v2 json', encode_results_v2, decode_results_v2, encode_fetch_v2, decode_fetch_v2))
+    if orjson is not None:
+        formats.append(('v2 orjson', encode_results_v2, decode_results_v2, encode_fetch_v2, decode_fetch_v2))
+
+    rows = []
+    for name, encode_results, decode_results, encode_fetch, decode_fetch in formats:
+        messages.orjson = orjson if name.endswith('orjson') else None
+        rows.append((name, 'Results', measure(encode_results, decode_results, raw, 20)))
+        rows.append((name, 'RetrieveData', measure(encode_fetch, decode_fetch, fetch, 2000)))
+    messages.orjson = orjson
+
+    drivers = sum(len(session['results']) for session in raw['session_results'])
+    print(f"{drivers} driver rows per result, orjson {'installed' if orjson is not None else 'not installed'}")
+    print(f"{'format':>10} {'message':>13} {'bytes':>8} {'encode (us)':>12} {'decode (us)':>12} {'vs v1 (size/enc/dec)':>22}")
+    baseline = {message: values for name, message, values in rows if name == 'v1 json'}
+    for name, message, values in rows:
+        base = baseline[message]
+        print(f"{name:>10} {message:>13} {values['bytes']:>8} {values['encode'] * 1e6:>12.1f} {values['decode'] * 1e6:>12.1f} "
+              f"{base['bytes'] / values['bytes']:>8.2f}x {base['encode'] / values['encode']:>5.2f}x {base['decode'] / values['decode']:>5.2f}x")
+
+if __name__ == '__main__':
+    main()
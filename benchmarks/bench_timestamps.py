@@ -0,0 +1,71 @@
+"""
+Compares ways of finding the latest end_time of the subsessions returned by a search
+
+handleGenerateSessionID used to parse every end_time with dateutil to keep the latest.
+iRacing's times are in a single fixed form, so they can instead be parsed with
+datetime.fromisoformat, or compared as strings with only the latest parsed.
+
+Usage: python -m benchmarks.bench_timestamps [--sessions 50000]
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+
+from dateutil.parser import parse
+
+from benchmarks.common import add_function_path, time_call
+
+add_function_path('common')
+
+from irstats_common import timestamps  # pylint: disable=wrong-import-position
+
+def latest_dateutil(values):
+    """the original approach, every time parsed with dateutil"""
+    maxtime = parse("2000-01-01T00:00:00Z")
+    for value in values:
+        t = parse(value)
+        if t > maxtime:
+            maxtime = t
+    return maxtime
+
+def latest_fromisoformat(values):
+    """every time parsed on the fast path"""
+    maxtime = None
+    for value in values:
+        t = timestamps.parse_time(value)
+        if maxtime is None or t > maxtime:
+            maxtime = t
+    return maxtime
+
+def latest_strings(values):
+    """times compared as strings, only the latest is parsed"""
+    return timestamps.parse_time(timestamps.latest(values))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=50000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    start = datetime(2022, 8, 1, tzinfo=timezone.utc)
+    values = [
+        (start + timedelta(seconds=rng.randrange(14 * 86400))).strftime('%Y-%m-%dT%H:%M:%SZ')
+        for _ in range(args.sessions)
+    ]
+
+    expected = latest_dateutil(values)
+    results = {}
+    for name, func in (('dateutil', latest_dateutil), ('fromisoformat', latest_fromisoformat),
+                       ('string max', latest_strings)):
+        assert func(values) == expected
+        results[name] = time_call(func, values, repeat=3)
+
+    print(f"{args.sessions} end times")
+    print(f"{'approach':>14} {'total (ms)':>11} {'per time (us)':>14} {'speedup':>8}")
+    for name, duration in results.items():
+        print(f"{name:>14} {duration * 1000:>11.1f} {duration / args.sessions * 1e6:>14.2f} "
+              f"{results['dateutil'] / duration:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
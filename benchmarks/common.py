@@ -0,0 +1,62 @@
+"""Helpers shared by the benchmark scripts"""
+
+import copy
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_FILE = os.path.join(ROOT, 'events', 'iRDataTest.JSON')
+
+def add_function_path(function_dir):
+    """
+    Make the modules of a Lambda function importable the same way Lambda imports them
+
+    The common layer is deployed alongside every function, so it is made importable too
+    """
+    for name in ('common', function_dir):
+        path = os.path.join(ROOT, name)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+def load_sample_results():
+    """returns the raw subsession results stored in events/iRDataTest.JSON"""
+    with open(SAMPLE_FILE, encoding='utf-8') as f:
+        return json.load(f)['Records'][0]['body']
+
+def scale_results(data, num_classes, drivers_per_class):
+    """
+    Returns a copy of the subsession results with a larger multiclass field
+
+    Drivers are cloned from the sample results of each session, spread across num_classes classes
+    and given slightly different lap times so every class has a distinct pole and fastest lap
+    """
+    scaled = copy.deepcopy(data)
+    for session in scaled['session_results']:
+        template = session['results']
+        results = []
+        for c in range(num_classes):
+            for d in range(drivers_per_class):
+                driver = dict(template[(c * drivers_per_class + d) % len(template)])
+                driver['car_class_name'] = f"Class {c}"
+                driver['display_name'] = f"Driver {c}-{d}"
+                driver['cust_id'] = c * drivers_per_class + d
+                offset = (c * 7919 + d * 104729) % 50000
+                for field in ('best_lap_time', 'best_qual_lap_time'):
+                    if driver[field] > 0:
+                        driver[field] += offset
+                results.append(driver)
+        session['results'] = results
+    return scaled
+
+def time_call(func, *args, repeat=5, number=1):
+    """returns the best per call duration in seconds of func(*args) over repeat runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        duration = (time.perf_counter() - start) / number
+        best = duration if best is None else min(best, duration)
+    return best
@@ -0,0 +1,300 @@
+"""
+Runs the whole pipeline in-process against local stand-ins, as a throughput benchmark
+
+GenerateSessionListQuery -> RuniRacingQuery -> process_iracing_data are invoked the way Lambda
+invokes them, with SQS, DynamoDB and S3 provided by moto and the iRacing API by a local stub
+server. The stub serves chunked search results and subsession results generated from
+events/iRDataTest.JSON at a configurable scale.
+
+The report gives subsessions per second, p50/p99 latency per stage, the AWS calls made by
+the handlers and the peak RSS of the process. Run it once per process, the handler modules
+keep their state between invocations as they would in a warm Lambda container.
+
+Usage: python -m benchmarks.pipeline_runner --subsessions 500 --classes 4 --drivers-per-class 15
+"""
+
+import argparse
+import collections
+import json
+import os
+import resource
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.common import add_function_path, load_sample_results, scale_results
+from benchmarks.stub_server import StubServer
+
+#Names used by the functions in template.yaml
+PARAMETERS_TABLE = 'irStats_Generate_Session_List_Parameters'
+DATA_TABLE = 'irstats_iRacing_Data'
+PROCESSED_TABLE = 'irStats_Processed_Subsessions'
+LEADERBOARD_TABLE = 'irStats_Leaderboards'
+API_QUEUE = 'irStats_iRacingApiQueryQueue'
+BACKLOG_QUEUE = 'irStats_iRacingBacklogQueue'
+DATA_QUEUE = 'irStats_iRacingDataProcessingQueue'
+BUCKET = 'irstats-storage'
+
+TRACKS = ('Summit Point Raceway', 'Lime Rock Park', 'Okayama International Circuit', 'Oulton Park Circuit')
+
+class FakeiRacing:
+    """
+    Routes for a StubServer imitating the parts of the iRacing data API used by the pipeline
+
+    Every search returns num_subsessions subsessions split into chunks of chunk_size,
+    finishing session_interval apart going back from now, so the older ones are backlog.
+    Each subsession's results are the sample results scaled to num_classes classes of
+    drivers_per_class drivers, at one of a few tracks.
+    """
+
+    def __init__(self, num_subsessions, chunk_size, num_classes, drivers_per_class, session_interval=timedelta(minutes=20)):
+        self.num_subsessions = num_subsessions
+        self.chunk_size = chunk_size
+        self.session_interval = session_interval
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.base_url = None
+        sample = load_sample_results()
+        self.templates = []
+        for track in TRACKS:
+            data = scale_results(sample, num_classes, drivers_per_class)
+            data['track'] = dict(data['track'], track_name=track)
+            data['subsession_id'] = 'SUBSESSION_ID'
+            self.templates.append(json.dumps(data).replace('"SUBSESSION_ID"', 'SUBSESSION_ID'))
+
+    def routes(self):
+        return {
+            '/auth': lambda handler: (200, {'Set-Cookie': 'authtoken_members=local'}, '{}'),
+            '/data/results/search_series': self.search_series,
+            '/chunks': self.chunk,
+            '/data/results/get': self.results_link,
+            '/results': self.results,
+        }
+
+    def search_series(self, handler):
+        num_chunks = -(-self.num_subsessions // self.chunk_size)
+        return 200, {}, json.dumps({'type': 'search_series', 'data': {'success': True, 'chunk_info': {
+            'chunk_size': self.chunk_size,
+            'num_chunks': num_chunks,
+            'rows': self.num_subsessions,
+            'base_download_url': f"{self.base_url}/chunks?n=",
+            'chunk_file_names': [str(n) for n in range(num_chunks)],
+        }}})
+
+    def chunk(self, handler):
+        n = int(parse_qs(urlparse(handler.path).query)['n'][0])
+        start = n * self.chunk_size
+        return 200, {}, json.dumps([
+            {'subsession_id': 60000000 + i, 'end_time': (self.now - i * self.session_interval).strftime('%Y-%m-%dT%H:%M:%SZ')}
+            for i in range(start, min(start + self.chunk_size, self.num_subsessions))
+        ])
+
+    def results_link(self, handler):
+        subsession_id = parse_qs(urlparse(handler.path).query)['subsession_id'][0]
+        return 200, {}, json.dumps({'link': f"{self.base_url}/results?subsession_id={subsession_id}"})
+
+    def results(self, handler):
+        subsession_id = int(parse_qs(urlparse(handler.path).query)['subsession_id'][0])
+        return 200, {}, self.templates[subsession_id % len(self.templates)].replace('SUBSESSION_ID', str(subsession_id), 1)
+
+def create_aws_resources(session):
+    """creates the tables, queues and bucket used by the functions"""
+    dynamodb = session.resource('dynamodb', region_name='eu-west-2')
+    dynamodb.create_table(
+        TableName=PARAMETERS_TABLE,
+        KeySchema=[{'AttributeName': 'Parameter', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'Parameter', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    for name in (DATA_TABLE, LEADERBOARD_TABLE):
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': 'CarClass', 'KeyType': 'HASH'}, {'AttributeName': 'TrackName', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'CarClass', 'AttributeType': 'S'},
+                {'AttributeName': 'TrackName', 'AttributeType': 'S'},
+            ],
+            BillingMode='PAY_PER_REQUEST',
+        )
+    dynamodb.create_table(
+        TableName=PROCESSED_TABLE,
+        KeySchema=[{'AttributeName': 'SubsessionId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'SubsessionId', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    sqs = session.resource('sqs', region_name='eu-west-2')
+    queues = {name: sqs.create_queue(QueueName=name) for name in (API_QUEUE, BACKLOG_QUEUE, DATA_QUEUE)}
+    s3 = session.client('s3', region_name='eu-west-2')
+    s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    s3.put_object(Bucket=BUCKET, Key='credentials.json', Body=json.dumps({'email': 'local', 'password': 'local'}))
+    return dynamodb, queues
+
+def import_handlers(base_url, write_mode, queues):
+    """imports the three handler modules with the environment each function has in template.yaml"""
+    common_env = {'iracing_base_url': base_url, 'AWS_DEFAULT_REGION': 'eu-west-2'}
+    os.environ.update(common_env)
+    add_function_path('common')
+
+    os.environ.update({
+        'table_name': PARAMETERS_TABLE, 'queue_name': API_QUEUE, 'queue_url': queues[API_QUEUE].url,
+        'backlog_queue_name': BACKLOG_QUEUE, 'backlog_queue_url': queues[BACKLOG_QUEUE].url,
+        #a day behind, so the search is planned as a single window
+        'default_time': (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%dT%H:%MZ'),
+        'category_ids': '2', 'event_types': '5', 'official_only': 'true',
+    })
+    add_function_path('generate_session_list_query')
+    import GenerateSessionListQuery  # pylint: disable=import-outside-toplevel
+
+    os.environ.update({
+        'bucket_name': BUCKET, 'cookie_file_name': 'iRCookieJar.json', 'table_name': PARAMETERS_TABLE,
+        'api_queue_name': API_QUEUE, 'data_queue_name': DATA_QUEUE, 'processed_table_name': PROCESSED_TABLE,
+        'api_queue_url': queues[API_QUEUE].url, 'data_queue_url': queues[DATA_QUEUE].url,
+        'backlog_queue_name': BACKLOG_QUEUE, 'backlog_queue_url': queues[BACKLOG_QUEUE].url,
+    })
+    add_function_path('run_iRacing_query')
+    import RuniRacingQuery  # pylint: disable=import-outside-toplevel
+
+    os.environ.update({'table_name': DATA_TABLE, 'write_mode': write_mode, 'leaderboard_table_name': LEADERBOARD_TABLE})
+    add_function_path('process_iRacing_data')
+    import process_iracing_data  # pylint: disable=import-outside-toplevel
+
+    return GenerateSessionListQuery, RuniRacingQuery, process_iracing_data
+
+def receive_batch(queue, batch_size):
+    """returns an SQS event of up to batch_size messages from the queue, as Lambda would deliver it"""
+    messages = []
+    while len(messages) < batch_size:
+        received = queue.receive_messages(MaxNumberOfMessages=min(10, batch_size - len(messages)))
+        if not received:
+            break
+        messages.extend(received)
+    event = {'Records': [
+        {'messageId': m.message_id, 'body': m.body, 'eventSource': 'aws:sqs'} for m in messages
+    ]}
+    return event, {m.message_id: m for m in messages}
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1]
+
+def run_pipeline(num_subsessions=200, chunk_size=50, num_classes=3, drivers_per_class=15,
+                 query_batch_size=10, process_batch_size=50, write_mode='conditional', latency=0.0):
+    """
+    Runs every stage of the pipeline until the queues are empty
+
+    Returns:
+        dict report of the run, see print_report
+    """
+    import boto3  # pylint: disable=import-outside-toplevel
+    from moto import mock_aws  # pylint: disable=import-outside-toplevel
+
+    for key in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(key, 'testing')
+
+    fake = FakeiRacing(num_subsessions, chunk_size, num_classes, drivers_per_class)
+    aws_calls = collections.Counter()
+    latencies = collections.defaultdict(list)
+    failures = collections.Counter()
+
+    with mock_aws(), StubServer(fake.routes(), latency=latency) as server:
+        fake.base_url = server.url
+        #The harness drives the queues through its own session so only the handlers' calls are counted
+        harness = boto3.session.Session(region_name='eu-west-2')
+        dynamodb, queues = create_aws_resources(harness)
+
+        generate, query, process = import_handlers(server.url, write_mode, queues)
+        from irstats_common import aws  # pylint: disable=import-outside-toplevel
+        aws.reset()
+        aws.get_session().events.register(
+            'before-call', lambda model, **kwargs: aws_calls.update([f"{model.service_model.service_name}.{model.name}"])
+        )
+
+        start = time.perf_counter()
+        t = time.perf_counter()
+        generate.lambda_handler({}, None)
+        latencies['generate'].append(time.perf_counter() - t)
+
+        stages = (
+            ('query', queues[API_QUEUE], query.lambda_handler, query_batch_size),
+            ('backlog', queues[BACKLOG_QUEUE], query.lambda_handler, query_batch_size),
+            ('process', queues[DATA_QUEUE], process.lambda_handler, process_batch_size),
+        )
+        idle = False
+        while not idle:
+            idle = True
+            for stage, queue, handler, batch_size in stages:
+                event, messages = receive_batch(queue, batch_size)
+                if not messages:
+                    continue
+                idle = False
+                t = time.perf_counter()
+                ret = handler(event, None)
+                latencies[stage].append(time.perf_counter() - t)
+                #Failed messages stay invisible until the visibility timeout, they are counted rather than retried
+                failed = {f['itemIdentifier'] for f in (ret or {}).get('batchItemFailures', [])}
+                failures[stage] += len(failed)
+                done = [m for message_id, m in messages.items() if message_id not in failed]
+                for n in range(0, len(done), 10):
+                    queue.delete_messages(Entries=[
+                        {'Id': str(i), 'ReceiptHandle': m.receipt_handle} for i, m in enumerate(done[n:n + 10])
+                    ])
+        duration = time.perf_counter() - start
+        records = dynamodb.Table(DATA_TABLE).scan(Select='COUNT')['Count']
+        api_requests = server.requests
+
+    return {
+        'subsessions': num_subsessions,
+        'duration': duration,
+        'subsessions_per_second': num_subsessions / duration,
+        'latency': {
+            stage: {'invocations': len(values), 'p50': percentile(values, 50), 'p99': percentile(values, 99)}
+            for stage, values in latencies.items()
+        },
+        'failures': dict(failures),
+        'aws_calls': dict(sorted(aws_calls.items())),
+        'iracing_requests': api_requests,
+        'records': records,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def print_report(report):
+    print(f"{report['subsessions']} subsessions in {report['duration']:.2f}s, "
+          f"{report['subsessions_per_second']:.1f} subsessions/s")
+    print(f"{'stage':>10} {'invocations':>12} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for stage, values in report['latency'].items():
+        print(f"{stage:>10} {values['invocations']:>12} {values['p50'] * 1000:>10.1f} {values['p99'] * 1000:>10.1f}")
+    print(f"failed records: {report['failures']}")
+    print(f"iRacing requests: {report['iracing_requests']}")
+    print("AWS calls:")
+    for call, count in report['aws_calls'].items():
+        print(f"  {call:<40} {count:>7} {count / report['subsessions']:>8.2f} per subsession")
+    print(f"class records: {report['records']}")
+    print(f"peak RSS: {report['peak_rss_mb']:.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--subsessions', type=int, default=200)
+    parser.add_argument('--chunk-size', type=int, default=50)
+    parser.add_argument('--classes', type=int, default=3)
+    parser.add_argument('--drivers-per-class', type=int, default=15)
+    parser.add_argument('--query-batch-size', type=int, default=10)
+    parser.add_argument('--process-batch-size', type=int, default=50)
+    parser.add_argument('--write-mode', choices=('batch', 'conditional'), default='conditional')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added to every iRacing API response')
+    parser.add_argument('--output', help='also write the report to this file as JSON')
+    args = parser.parse_args()
+    report = run_pipeline(
+        num_subsessions=args.subsessions, chunk_size=args.chunk_size, num_classes=args.classes,
+        drivers_per_class=args.drivers_per_class, query_batch_size=args.query_batch_size,
+        process_batch_size=args.process_batch_size, write_mode=args.write_mode, latency=args.latency_ms / 1000,
+    )
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
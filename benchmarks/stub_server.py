@@ -0,0 +1,82 @@
+"""A local HTTP server used as a stand-in for the iRacing API and its chunk downloads"""
+
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubServer:
+    """
+    Serves fixed responses from a background thread
+
+    Routes map a path to a function called with the request handler, returning
+    a (status, headers, body) tuple. Every response is delayed by latency seconds
+    to imitate the round trip to a remote server.
+    """
+
+    def __init__(self, routes=None, latency=0.0):
+        self.routes = routes if routes is not None else {}
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """the base url of the server, without a trailing slash"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                #headers and body are written separately, avoid Nagle delays on kept-alive connections
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stub._lock:
+                    stub.connections += 1
+
+            def _respond(self):
+                with stub._lock:
+                    stub.requests += 1
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                route = stub.routes.get(self.path.split('?')[0])
+                if route is None:
+                    status, headers, body = 404, {}, b'not found'
+                else:
+                    status, headers, body = route(self)
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1 @@
+"""Code shared by the irStats Lambda functions, deployed to each of them as a Lambda layer"""
@@ -0,0 +1,74 @@
+"""
+Lazily created boto3 sessions, clients and resources, shared by everything in a Lambda container
+
+Nothing is created until it is first used, so importing a function's module does no AWS set up
+and does not need AWS access. Everything created is kept for later invocations of the same container.
+"""
+
+import threading
+
+REGION = 'eu-west-2'
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_resources = {}
+_tables = {}
+_queues = {}
+
+def get_session():
+    """returns the boto3 session, boto3 itself is only imported on first use"""
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3  # pylint: disable=import-outside-toplevel
+            _session = boto3.session.Session(region_name=REGION)
+        return _session
+
+def get_client(service_name):
+    """returns the shared client for an AWS service, clients are thread safe"""
+    with _lock:
+        if service_name not in _clients:
+            _clients[service_name] = get_session().client(service_name)
+        return _clients[service_name]
+
+def get_resource(service_name):
+    """returns the shared resource for an AWS service"""
+    with _lock:
+        if service_name not in _resources:
+            _resources[service_name] = get_session().resource(service_name)
+        return _resources[service_name]
+
+def get_table(table_name):
+    """returns a DynamoDB Table resource, no request is made to create it"""
+    with _lock:
+        if table_name not in _tables:
+            _tables[table_name] = get_resource('dynamodb').Table(table_name)
+        return _tables[table_name]
+
+def get_queue(queue_name, queue_url=None):
+    """
+    returns an SQS Queue resource
+
+    Args:
+        queue_name (string) : name of the queue, looked up with GetQueueUrl if no url is given
+        queue_url (string)  : url of the queue, when known the lookup is skipped
+    """
+    with _lock:
+        if queue_name not in _queues:
+            sqs = get_resource('sqs')
+            if queue_url:
+                _queues[queue_name] = sqs.Queue(queue_url)
+            else:
+                _queues[queue_name] = sqs.get_queue_by_name(QueueName=queue_name)
+        return _queues[queue_name]
+
+def reset():
+    """forget everything created so far, the next use creates it again"""
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources.clear()
+        _tables.clear()
+        _queues.clear()
@@ -0,0 +1,254 @@
+"""
+Plans searches for subsessions as windows of time which can be queried in parallel
+
+A long period, such as a backfill of several months, is split into non-overlapping windows,
+each of which is searched by its own GenerateSessionID message. The windows are recorded in
+the parameters table under a single item and each is marked done once its subsessions have
+been queued. The finish_range_begin watermark only advances over a window once every earlier
+window is done, so a window that fails is searched again rather than skipped over.
+
+A window is timed out from when the search for it started running, so windows waiting their
+turn on the backlog queue are not queued again while they wait.
+"""
+
+from datetime import timedelta
+
+from irstats_common import timestamps
+
+#Format of the times used by the iRacing API and stored in the parameters table
+TIME_FORMAT = '%Y-%m-%dT%H:%MZ'
+
+#The iRacing API does not allow a search to cover more than 90 days
+MAX_SEARCH = timedelta(days=90)
+
+#A search also takes in sessions which started this long before its window, so even 24H races are found
+START_LOOKBACK = timedelta(days=1.5)
+
+#Longest window whose search, including the start range before it, the API allows
+MAX_WINDOW = MAX_SEARCH - START_LOOKBACK
+
+WATERMARK_PARAMETER = 'finish_range_begin'
+PLAN_PARAMETER = 'backfill_windows'
+
+#Windows are added to or removed from the plan this many at a time, keeping each update expression small
+RECORD_BATCH_SIZE = 25
+
+def parse_time(value):
+    """
+    Args:
+        value: str time in TIME_FORMAT
+    Returns:
+        timezone aware datetime
+    """
+    return timestamps.parse_time(value)
+
+def format_time(value):
+    return value.strftime(TIME_FORMAT)
+
+def plan_windows(begin, end, window):
+    """
+    Splits the time between begin and end into consecutive windows
+
+    Args:
+        begin: datetime the first window starts at
+        end: datetime the last window finishes at
+        window: timedelta longest window, capped at MAX_WINDOW
+    Returns:
+        list of (begin, end) str tuples, empty if end is not after begin
+    """
+    window = min(window, MAX_WINDOW)
+    windows = []
+    while begin < end:
+        finish = min(begin + window, end)
+        windows.append((format_time(begin), format_time(finish)))
+        begin = finish
+    return windows
+
+def load_plan(table):
+    """
+    Args:
+        table: boto3 DynamoDB Table resource for the parameters table
+    Returns:
+        (planned_until, windows) where planned_until is the str end of the last window planned,
+        or None if nothing has been planned, and windows maps the begin of each outstanding
+        window to its entry
+    """
+    response = table.get_item(Key={'Parameter': PLAN_PARAMETER}, ConsistentRead=True)
+    item = response.get('Item', {})
+    return item.get('PlannedUntil'), item.get('Windows', {})
+
+def record_windows(table, windows, queued_at):
+    """
+    Adds windows to the plan, to be marked done by complete_window
+
+    Args:
+        table: boto3 DynamoDB Table resource for the parameters table
+        windows: list of (begin, end) str tuples from plan_windows
+        queued_at: int epoch time the windows are queued at
+    """
+    if not windows:
+        return
+    #Windows are added one map entry at a time so they never overwrite a window being completed
+    table.update_item(
+        Key={'Parameter': PLAN_PARAMETER},
+        ExpressionAttributeNames={'#windows': 'Windows'},
+        ExpressionAttributeValues={':empty': {}},
+        UpdateExpression='SET #windows = if_not_exists(#windows, :empty)'
+    )
+    for start in range(0, len(windows), RECORD_BATCH_SIZE):
+        batch = windows[start:start + RECORD_BATCH_SIZE]
+        names = {'#windows': 'Windows', '#until': 'PlannedUntil'}
+        values = {':until': batch[-1][1]}
+        updates = ['#until = :until']
+        for n, (begin, end) in enumerate(batch):
+            names[f'#w{n}'] = begin
+            values[f':w{n}'] = {'End': end, 'Done': False, 'QueuedAt': queued_at}
+            updates.append(f'#windows.#w{n} = :w{n}')
+        table.update_item(
+            Key={'Parameter': PLAN_PARAMETER},
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            UpdateExpression='SET ' + ', '.join(updates)
+        )
+
+def stale_windows(windows, now, retry_after, queue_timeout):
+    """
+    Args:
+        windows: dict of outstanding windows from load_plan
+        now: int epoch time
+        retry_after: int seconds a window may run for, from when its search started, before it is queued again
+        queue_timeout: int seconds a window may wait on its queue without starting before it is queued again
+    Returns:
+        list of (begin, end) str tuples of the windows which are not done and should be queued again
+    """
+    stale = []
+    for begin, entry in sorted(windows.items()):
+        if entry['Done']:
+            continue
+        if entry.get('StartedAt') is not None:
+            expires = int(entry['StartedAt']) + retry_after
+        else:
+            expires = int(entry['QueuedAt']) + queue_timeout
+        if expires <= now:
+            stale.append((begin, entry['End']))
+    return stale
+
+def mark_queued(table, windows, queued_at):
+    """Records that windows already in the plan have been queued again, and have not started since"""
+    for begin, _ in windows:
+        try:
+            table.update_item(
+                Key={'Parameter': PLAN_PARAMETER},
+                ExpressionAttributeNames={'#windows': 'Windows', '#w': begin, '#queued': 'QueuedAt',
+                                          '#started': 'StartedAt'},
+                ExpressionAttributeValues={':queued': queued_at},
+                UpdateExpression='SET #windows.#w.#queued = :queued REMOVE #windows.#w.#started',
+                ConditionExpression='attribute_exists(#windows.#w)'
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            #Completed and removed from the plan in the meantime
+            pass
+
+def start_window(table, begin, started_at):
+    """
+    Records that the search for a window has started running, its timeout is counted from now on
+
+    Args:
+        table: boto3 DynamoDB Table resource for the parameters table
+        begin: str begin of the window, as given to record_windows
+        started_at: int epoch time the search started at
+    """
+    try:
+        table.update_item(
+            Key={'Parameter': PLAN_PARAMETER},
+            ExpressionAttributeNames={'#windows': 'Windows', '#w': begin, '#started': 'StartedAt'},
+            ExpressionAttributeValues={':started': started_at},
+            UpdateExpression='SET #windows.#w.#started = :started',
+            ConditionExpression='attribute_exists(#windows.#w)'
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        #A window delivered twice may already have been completed and removed
+        pass
+
+def set_watermark(table, value):
+    """
+    Moves the finish_range_begin watermark forward to value, never back
+
+    Returns:
+        bool whether the watermark was changed
+    """
+    try:
+        table.update_item(
+            Key={'Parameter': WATERMARK_PARAMETER},
+            ExpressionAttributeNames={'#value': 'Value'},
+            ExpressionAttributeValues={':nv': value},
+            UpdateExpression='SET #value = :nv',
+            ConditionExpression='attribute_not_exists(#value) OR #value < :nv'
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def complete_window(table, begin, found_until=None):
+    """
+    Marks a window done and advances the watermark over every completed window before it
+
+    Args:
+        table: boto3 DynamoDB Table resource for the parameters table
+        begin: str begin of the window, as given to record_windows
+        found_until: str latest finish time of the subsessions the window found, if any
+    Returns:
+        str the watermark was advanced to, or None if it was not advanced
+    """
+    names = {'#windows': 'Windows', '#w': begin, '#done': 'Done'}
+    values = {':done': True}
+    update = 'SET #windows.#w.#done = :done'
+    if found_until:
+        names['#found'] = 'FoundUntil'
+        values[':found'] = found_until
+        update += ', #windows.#w.#found = :found'
+    try:
+        table.update_item(
+            Key={'Parameter': PLAN_PARAMETER},
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            UpdateExpression=update,
+            ConditionExpression='attribute_exists(#windows.#w)'
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        #A window delivered twice may already have been completed and removed
+        pass
+    return advance_watermark(table)
+
+def advance_watermark(table):
+    """
+    Moves the watermark to the latest finish time found by the completed windows at the start
+    of the plan, then removes those windows from the plan
+
+    Returns:
+        str the watermark was advanced to, or None if it was not advanced
+    """
+    _, windows = load_plan(table)
+    prefix = []
+    for begin in sorted(windows):
+        if not windows[begin]['Done']:
+            break
+        prefix.append(begin)
+    if not prefix:
+        return None
+    found = [windows[begin]['FoundUntil'] for begin in prefix if windows[begin].get('FoundUntil')]
+    advanced = None
+    if found and set_watermark(table, max(found)):
+        advanced = max(found)
+    #The watermark is stored before the windows are removed, so a failure in between only repeats this step
+    for start in range(0, len(prefix), RECORD_BATCH_SIZE):
+        batch = prefix[start:start + RECORD_BATCH_SIZE]
+        names = {'#windows': 'Windows'}
+        for n, begin in enumerate(batch):
+            names[f'#w{n}'] = begin
+        table.update_item(
+            Key={'Parameter': PLAN_PARAMETER},
+            ExpressionAttributeNames=names,
+            UpdateExpression='REMOVE ' + ', '.join(f'#windows.#w{n}' for n in range(len(batch)))
+        )
+    return advanced
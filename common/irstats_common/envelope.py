@@ -0,0 +1,115 @@
+"""
+Envelope format for subsession results passed between pipeline stages through SQS
+
+Results are sent as a Results message, see messages.py. Results too large to fit in an SQS
+message are compressed into S3 and only a ResultsPointer to them is queued, the claim check
+pattern. Messages in the version 1 envelope, {"envelope": 1, ...}, and messages without an
+envelope, the raw results, are still read, as queued before the versioned schema existed.
+"""
+
+import gzip
+import json
+import os
+import uuid
+from irstats_common import messages
+from irstats_common.messages import Results, ResultsPointer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#Version of the envelope used before the versioned schema, still accepted when decoding
+ENVELOPE_VERSION = 1
+
+#Payloads larger than this many bytes are offloaded to S3
+#This leaves headroom below the 256KB SQS message limit for the envelope and batching
+INLINE_LIMIT = int(os.environ.get('inline_payload_limit', str(200 * 1024)))
+
+#Compression used for offloaded payloads, gzip or zstd
+#zstd needs the zstandard package and falls back to gzip without it
+PAYLOAD_ENCODING = os.environ.get('payload_encoding', 'gzip')
+
+#Prefix of the S3 keys offloaded payloads are stored under
+KEY_PREFIX = 'payloads/'
+
+FILE_EXTENSIONS = {'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+def compress(raw, encoding):
+    """Compress bytes with the named encoding, returning the data and the encoding actually used"""
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(raw), 'zstd'
+    return gzip.compress(raw), 'gzip'
+
+def decompress(data, encoding):
+    """Reverse compress for the named encoding"""
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd encoded payloads")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown payload encoding {encoding}")
+
+def encode_payload(payload, s3_client, bucket, encoding=None, inline_limit=None):
+    """
+    Turn results into an SQS message body
+
+    Args:
+        payload             : Results, or the raw results as a dict which are projected to Results
+        s3_client           : boto3 S3 client used to store payloads too large to send inline
+        bucket (string)     : bucket offloaded payloads are stored in
+        encoding (string)   : compression for offloaded payloads, defaults to PAYLOAD_ENCODING
+        inline_limit (int)  : size in bytes above which payloads are offloaded, defaults to INLINE_LIMIT
+    Returns:
+        The message body as a string
+    """
+    inline_limit = INLINE_LIMIT if inline_limit is None else inline_limit
+    results = payload if isinstance(payload, Results) else Results.from_results(payload)
+    body = results.encode()
+    raw = body.encode('utf-8')
+    if len(raw) <= inline_limit:
+        return body
+
+    data, encoding = compress(raw, encoding or PAYLOAD_ENCODING)
+    #Keyed by subsession so retries overwrite the same object rather than leaving copies behind
+    name = results.subsession_id or uuid.uuid4().hex
+    key = f"{KEY_PREFIX}{name}{FILE_EXTENSIONS[encoding]}"
+    s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType='application/json', ContentEncoding=encoding)
+    return ResultsPointer(bucket, key, encoding).encode()
+
+def decode_payload(body, s3_client):
+    """
+    Returns the results of an SQS message body, fetching them from S3 if they were offloaded
+
+    Args:
+        body (string or dict)   : the message body, a Results or ResultsPointer message, a version 1
+                                  envelope or the raw results
+        s3_client               : boto3 S3 client used to fetch offloaded payloads
+    Returns:
+        the results as a dict, in the form given by the API
+    Raises:
+        messages.MessageError if the body does not match the schema
+    """
+    if isinstance(body, (str, bytes)):
+        try:
+            body = messages.loads(body)
+        except ValueError as e:
+            raise messages.MessageError(f"Message is not valid JSON: {e}") from e
+    if isinstance(body, list):
+        message = messages.decode(body, (Results, ResultsPointer))
+        if isinstance(message, ResultsPointer):
+            data = s3_client.get_object(Bucket=message.bucket, Key=message.key)['Body'].read()
+            message = messages.decode(decompress(data, message.encoding), (Results,))
+        return message.to_dict()
+    if not isinstance(body, dict):
+        raise messages.MessageError("Message is neither results nor an envelope")
+    if 'envelope' not in body:
+        return body
+    if body['envelope'] != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version {body['envelope']}")
+    if 'inline' in body:
+        return body['inline']
+    pointer = body['s3']
+    data = s3_client.get_object(Bucket=pointer['bucket'], Key=pointer['key'])['Body'].read()
+    return json.loads(decompress(data, pointer['encoding']))
@@ -0,0 +1,198 @@
+"""
+Timings and counters for the Lambda functions, logged in CloudWatch Embedded Metric Format
+
+Timers and counters are accumulated in memory and logged as a single EMF JSON line when the
+handler returns, from which CloudWatch extracts the metrics without any API calls. Recording
+a value is a dictionary update under a lock, cheap enough to leave on around every I/O call.
+
+Setting the profile environment variable to 1 also runs each invocation under cProfile,
+logging the slowest functions and dumping the full stats to /tmp.
+"""
+
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+#Namespace the metrics are published under in CloudWatch
+NAMESPACE = os.environ.get('metrics_namespace', 'irStats')
+
+#Whether invocations are run under cProfile
+PROFILE = os.environ.get('profile', '') not in ('', '0', 'false')
+
+#Number of functions listed in the log when profiling
+PROFILE_TOP = 25
+
+#CloudWatch accepts at most 100 metrics per EMF directive
+MAX_METRICS = 100
+
+class Metrics:
+    """
+    Accumulates timers and counters until flushed
+
+    Safe to use from several threads at once.
+    """
+
+    def __init__(self, namespace=NAMESPACE, dimensions=None, clock=time.perf_counter):
+        self.namespace = namespace
+        self.dimensions = dimensions if dimensions is not None else {}
+        self.clock = clock
+        self.properties = {}
+        #name -> count
+        self.counters = {}
+        #name -> [total seconds, calls]
+        self.timers = {}
+        #name -> (highest value, unit)
+        self.maxima = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        """Add value to the counter name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        """Add a duration to the timer name, reported in milliseconds along with the number of calls"""
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [seconds, 1]
+            else:
+                timer[0] += seconds
+                timer[1] += 1
+
+    def maximum(self, name, value, unit='Seconds'):
+        """Record value under name if it is the highest recorded since the last flush"""
+        with self._lock:
+            current = self.maxima.get(name)
+            if current is None or value > current[0]:
+                self.maxima[name] = (value, unit)
+
+    def timer(self, name):
+        """Time the body of a with block, even if it raises"""
+        return _Timer(self, name)
+
+    def timed(self, name):
+        """Decorator timing every call of a function"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = self.clock()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add_time(name, self.clock() - start)
+            return wrapper
+        return decorator
+
+    def set_property(self, name, value):
+        """Add a value to the log line which is searchable in the logs but not a metric"""
+        with self._lock:
+            self.properties[name] = value
+
+    def _units(self):
+        """returns name -> (value, unit) of everything recorded"""
+        with self._lock:
+            values = {name: (value, 'Count') for name, value in self.counters.items()}
+            for name, (seconds, calls) in self.timers.items():
+                values[name] = (seconds * 1000, 'Milliseconds')
+                values[f"{name}Calls"] = (calls, 'Count')
+            values.update(self.maxima)
+            return values
+
+    def snapshot(self):
+        """returns name -> value of everything recorded since the last flush"""
+        return {name: value for name, (value, _) in self._units().items()}
+
+    def to_emf(self, timestamp=None):
+        """returns the EMF document for everything recorded since the last flush"""
+        values = self._units()
+        with self._lock:
+            properties = dict(self.properties)
+        names = sorted(values)[:MAX_METRICS]
+        document = dict(properties)
+        document.update(self.dimensions)
+        document['_aws'] = {
+            'Timestamp': int((timestamp if timestamp is not None else time.time()) * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [list(self.dimensions)],
+                'Metrics': [{'Name': name, 'Unit': values[name][1]} for name in names],
+            }],
+        }
+        for name in names:
+            document[name] = values[name][0]
+        return document
+
+    def flush(self):
+        """Log everything recorded as one EMF line and start again"""
+        if self.counters or self.timers or self.maxima:
+            print (json.dumps(self.to_emf(), default=str))
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+            self.maxima = {}
+            self.properties = {}
+
+class _Timer:
+    """Context manager returned by Metrics.timer, a plain class as it is cheaper to enter than a generator"""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, self.metrics.clock() - self.start)
+
+_lock = threading.Lock()
+_metrics = None
+
+def get_metrics():
+    """returns the Metrics of this function, dimensioned by its name"""
+    global _metrics
+    with _lock:
+        if _metrics is None:
+            _metrics = Metrics(dimensions={'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')})
+    return _metrics
+
+def profile_call(func, *args, **kwargs):
+    """Run func under cProfile, logging the slowest functions and dumping the stats to /tmp"""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        path = os.path.join('/tmp', f"{func.__module__}-{int(time.time() * 1000)}.prof")
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        print (f"Profile written to {path}\n{out.getvalue()}")
+
+def instrument_handler(handler):
+    """
+    Decorator for a lambda_handler, timing each invocation and flushing the metrics when it returns
+
+    Invocations are profiled when the profile environment variable is set
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        metrics = get_metrics()
+        metrics.count('Invocations')
+        try:
+            with metrics.timer('Handler'):
+                if PROFILE:
+                    return profile_call(handler, event, context)
+                return handler(event, context)
+        finally:
+            metrics.flush()
+    return wrapper
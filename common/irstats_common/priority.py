@@ -0,0 +1,44 @@
+"""
+Priority tiers of the work queued for the iRacing API
+
+Work on sessions which finished recently is fresh, anything older is backlog. Each tier
+has its own queue, so a search for new sessions never waits behind thousands of backfill
+fetches, and its own concurrency and share of the API budget, set in template.yaml.
+
+The age of a message is measured from the finish time it carries, end_time, which is the
+end of the search window for a search and the finish time of the subsession for a fetch.
+"""
+
+import os
+from datetime import datetime, timezone
+from irstats_common import timestamps
+
+FRESH = 'fresh'
+BACKLOG = 'backlog'
+TIERS = (FRESH, BACKLOG)
+
+#Work on sessions which finished longer ago than this is backlog
+FRESH_MAX_AGE = float(os.environ.get('fresh_max_age_minutes', '360')) * 60
+
+def age_seconds(end_time, now=None):
+    """
+    returns how long ago a finish time was, in seconds
+
+    Args:
+        end_time (string)   : ISO 8601 finish time, as given by the iRacing API
+        now (datetime)      : timezone aware time to measure from, the current time if None
+    """
+    now = now if now is not None else datetime.now(timezone.utc)
+    return (now - timestamps.parse_time(end_time)).total_seconds()
+
+def tier_for(end_time, now=None, max_age=None):
+    """
+    returns the tier of work on sessions which finished at end_time
+
+    Work without a finish time, e.g. messages queued before tiers were introduced, is fresh
+    so that it is never starved
+    """
+    if not end_time:
+        return FRESH
+    max_age = FRESH_MAX_AGE if max_age is None else max_age
+    return FRESH if age_seconds(end_time, now) <= max_age else BACKLOG
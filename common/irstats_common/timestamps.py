@@ -0,0 +1,63 @@
+"""
+Fast handling of the ISO 8601 times used by the iRacing API
+
+iRacing gives times in one fixed form, 2022-08-14T10:34:55Z. Times in that form are parsed
+with datetime.fromisoformat, and compare in time order as plain strings, so the latest of many
+can be found without parsing them at all. Anything else falls back to dateutil, which is only
+imported when it is needed.
+"""
+
+from datetime import datetime, timezone
+
+#The form iRacing gives times in
+CANONICAL_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def is_canonical(value):
+    """returns whether value is a UTC time in CANONICAL_FORMAT, checked by shape alone"""
+    return (
+        len(value) == 20 and value[19] == 'Z' and value[10] == 'T'
+        and value[4] == '-' and value[7] == '-' and value[13] == ':' and value[16] == ':'
+    )
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 time
+
+    Args:
+        value (string)  : the time, as given by the iRacing API
+    Returns:
+        timezone aware datetime, times without an offset are taken as UTC
+    """
+    candidate = value[:-1] + '+00:00' if value.endswith('Z') else value
+    try:
+        parsed = datetime.fromisoformat(candidate)
+    except ValueError:
+        #Not a form fromisoformat understands, e.g. a space before the offset or odd precision
+        from dateutil.parser import isoparse  # pylint: disable=import-outside-toplevel
+        try:
+            parsed = isoparse(value)
+        except ValueError:
+            from dateutil.parser import parse  # pylint: disable=import-outside-toplevel
+            parsed = parse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def canonical(value):
+    """returns value in CANONICAL_FORMAT, so that times compare in time order as strings"""
+    if is_canonical(value):
+        return value
+    return parse_time(value).astimezone(timezone.utc).strftime(CANONICAL_FORMAT)
+
+def latest(values):
+    """
+    returns the latest of an iterable of times as a string in CANONICAL_FORMAT, None if it is empty
+
+    Only times not already in CANONICAL_FORMAT are parsed
+    """
+    ret = None
+    for value in values:
+        value = canonical(value)
+        if ret is None or value > ret:
+            ret = value
+    return ret
@@ -1,16 +1,19 @@
-import json
-import boto3
 import os
-from dateutil.parser import parse
-from datetime import timedelta
+import time
+from datetime import datetime, timedelta, timezone
+from irstats_common import aws, backfill, priority, timestamps
+from irstats_common.messages import SessionSearch
+from irstats_common.metrics import get_metrics, instrument_handler
 
 ### Reads the most recently used time from the DynamoDB table and constructs a Query to get all race events since this time
 ### Query string is added to an SQS Queue to be processed by another Lambda function
+### Long periods, e.g. when backfilling or after falling behind, are split into windows which are queried in parallel
+### Windows of recent sessions are queued on the API query queue, older windows on the backlog queue so they never hold up new sessions
 
 def get_prev_time_from_dynamoDB():
     #Pull the finish time from the specific table, if it exists return it
     #If it doesn't exist, return the environment variable containing the default value
-    response = table.get_item(
+    response = get_table().get_item(
         Key={
            'Parameter': 'finish_range_begin' 
         }
@@ -23,33 +26,100 @@ def get_prev_time_from_dynamoDB():
 def get_start_time_from_finish_time(finish_time):
     #Return a string formatted time 1.5 days before the start date
     #1.5 days ensures that even 24H race sessions are picked up
-    x = parse(finish_time)
-    y = x - timedelta(days=1.5)
+    x = timestamps.parse_time(finish_time)
+    y = x - backfill.START_LOOKBACK
     return y.strftime('%Y-%m-%dT%H:%MZ')
 
-dynamodb = boto3.resource("dynamodb", region_name='eu-west-2')
-table = dynamodb.Table(os.environ['table_name'])
+#iRacing API, overridden to run against a local stand-in
+iracing_base_url = os.environ.get('iracing_base_url', 'https://members-ng.iracing.com')
 
-sqs = boto3.resource('sqs', region_name='eu-west-2')
-queue = sqs.get_queue_by_name(QueueName=os.environ['queue_name'])
+#AWS resources are only created when first used
+#The queue URLs come from the environment when set, so a cold start does not have to look them up
+table_name = os.environ['table_name']
+queue_name = os.environ['queue_name']
+queue_url = os.environ.get('queue_url')
+backlog_queue_name = os.environ.get('backlog_queue_name')
+backlog_queue_url = os.environ.get('backlog_queue_url')
 
-def lambda_handler(event, context):
+def get_table():
+    return aws.get_table(table_name)
+
+def get_queue(tier=priority.FRESH):
+    #Backlog windows share the API query queue if there is no backlog queue
+    if tier == priority.BACKLOG and backlog_queue_name:
+        return aws.get_queue(backlog_queue_name, backlog_queue_url)
+    return aws.get_queue(queue_name, queue_url)
 
+#Each window searches at most this many hours of finish times
+window_hours = float(os.environ.get('backfill_window_hours', '24'))
+#No more than this many new windows are queued by a single run, the rest are planned by the following runs
+max_windows = int(os.environ.get('backfill_max_windows', '50'))
+#Windows end this long before now, giving iRacing time to make recently finished sessions searchable
+settle_minutes = float(os.environ.get('backfill_settle_minutes', '15'))
+#A window whose search started this long ago without being completed is queued again
+retry_minutes = float(os.environ.get('backfill_retry_minutes', '30'))
+#A window queued for this long whose search has not started is queued again, backlog windows may wait a long time for their turn
+queue_timeout_hours = float(os.environ.get('backfill_queue_timeout_hours', '24'))
+
+def get_window_url(begin, end):
+    #Sessions finishing within the window must have started within 1.5 days before it
     official_only = os.environ['official_only']
     event_types = os.environ['event_types']
     category_ids = os.environ['category_ids']
-    finish_range_begin = get_prev_time_from_dynamoDB()
-    start_range_begin = get_start_time_from_finish_time(finish_range_begin)
+    start_range_begin = get_start_time_from_finish_time(begin)
+    return f"{iracing_base_url}/data/results/search_series?official_only={official_only}&event_types={event_types}&category_ids={category_ids}&finish_range_begin={begin}&finish_range_end={end}&start_range_begin={start_range_begin}&start_range_end={end}"
+
+def send_windows(windows):
+    #Each window is queued for the tier of its end, windows are sent 10 at a time, the most SQS takes in one batch
+    tiers = {}
+    for begin, end in windows:
+        tiers.setdefault(priority.tier_for(end), []).append((begin, end))
+    failed = []
+    for tier, tier_windows in tiers.items():
+        metrics.count(f"Windows{tier.capitalize()}", len(tier_windows))
+        for start in range(0, len(tier_windows), 10):
+            batch = tier_windows[start:start + 10]
+            entries = []
+            for n, (begin, end) in enumerate(batch):
+                url = get_window_url(begin, end)
+                print (url)
+                entries.append({'Id': str(n), 'MessageBody': SessionSearch(url, begin, end).encode()})
+            with metrics.timer('QueueSendBatch'):
+                response = get_queue(tier).send_messages(Entries=entries)
+            failed.extend(batch[int(f['Id'])] for f in response.get('Failed', []))
+    return failed
+
+#Timings and counters of each invocation, logged as CloudWatch metrics when it returns
+metrics = get_metrics()
+
+@instrument_handler
+def lambda_handler(event, context):
+    #New windows start where the last planned window ended, or at the watermark if nothing is planned
+    table = get_table()
+    with metrics.timer('PlanLoad'):
+        planned_until, windows = backfill.load_plan(table)
+        begin = backfill.parse_time(get_prev_time_from_dynamoDB())
+    if planned_until:
+        begin = max(begin, backfill.parse_time(planned_until))
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0) - timedelta(minutes=settle_minutes)
+    new_windows = backfill.plan_windows(begin, end, timedelta(hours=window_hours))[:max_windows]
 
-    url = f"https://members-ng.iracing.com/data/results/search_series?official_only={official_only}&event_types={event_types}&category_ids={category_ids}&finish_range_begin={finish_range_begin}&start_range_begin={start_range_begin}"
+    now = int(time.time())
+    retry_windows = backfill.stale_windows(windows, now, retry_minutes * 60, queue_timeout_hours * 3600)
 
-    print (url)
-    
-    payload = {
-        'type': 'GenerateSessionID',
-        'url' : url
-    }
+    #Windows are recorded before they are queued, so they can always be marked done
+    with metrics.timer('PlanRecord'):
+        backfill.record_windows(table, new_windows, now)
+        backfill.mark_queued(table, retry_windows, now)
+    failed = send_windows(new_windows + retry_windows)
+    metrics.count('WindowsQueued', len(new_windows))
+    metrics.count('WindowsRetried', len(retry_windows))
+    metrics.count('WindowsFailed', len(failed))
+    print (f"Queued {len(new_windows)} new and {len(retry_windows)} retried windows")
 
-    queue.send_message(MessageBody=json.dumps(payload))
+    #Windows that were not queued stay in the plan and are queued again by the next run
+    if failed:
+        backfill.mark_queued(table, failed, 0)
+        raise RuntimeError(f"{len(failed)} windows could not be queued")
 
-    return None
\ No newline at end of file
+    return None
@@ -0,0 +1,99 @@
+"""
+Per container cache of the best pole and fastest lap stored for each car class and track
+
+The laps stored in a class record only ever get faster, so a cached lap is never faster than
+the one stored. A new lap no faster than the cached one cannot beat the stored one either and
+is dropped without reading or writing DynamoDB. Laps which beat the cached one are checked
+against the table as before, in conditional mode by the condition of the update, so a stale
+entry costs at most a wasted attempt and never a wrong record.
+
+Entries expire after CACHE_TTL seconds, so records changed outside the pipeline, e.g. reset
+by hand, are seen again. Setting it to 0 disables the cache.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from irstats_common.metrics import get_metrics
+
+#Seconds an entry is trusted for after it was read or written
+CACHE_TTL = float(os.environ.get('best_lap_cache_ttl_seconds', '300'))
+
+#Most car class and track combinations cached, the least recently updated are evicted first
+CACHE_MAX_ENTRIES = int(os.environ.get('best_lap_cache_max_entries', '5000'))
+
+def as_decimal(lap):
+    """returns a lap time in the form DynamoDB stores it, so it compares exactly with stored laps"""
+    return Decimal(str(lap)) if isinstance(lap, float) else lap
+
+class BestLapCache:
+    """
+    (car_class, track) -> {lap field: best lap stored, None if the record has no lap}
+
+    Lookups are counted as the BestLapCacheHits, BestLapCacheMisses and BestLapCacheBeaten metrics.
+    Safe to use from several threads at once.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        #key -> (expiry time, laps), in the order the keys were last updated
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key):
+        """returns the laps cached for key, None if nothing is cached or the entry has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def store(self, key, laps):
+        """
+        Record laps known to be stored for key, merged with any others cached for it
+
+        Args:
+            key (tuple)     : (car_class, track)
+            laps (dict)     : lap field -> the lap stored, None if the record has no lap
+        """
+        if self.ttl <= 0:
+            return
+        current = self.get(key) or {}
+        merged = dict(current)
+        merged.update((lap_field, as_decimal(lap)) for lap_field, lap in laps.items())
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + self.ttl, merged)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def might_improve(self, key, lap_field, lap):
+        """
+        returns False if lap cannot beat the stored lap, as it is no faster than the cached one
+
+        A missing lap cannot improve a record known to exist. Anything not cached might improve.
+        """
+        laps = self.get(key)
+        if laps is None or lap_field not in laps:
+            get_metrics().count('BestLapCacheMisses')
+            return True
+        best = laps[lap_field]
+        if lap is None or (best is not None and as_decimal(lap) >= best):
+            get_metrics().count('BestLapCacheHits')
+            return False
+        get_metrics().count('BestLapCacheBeaten')
+        return True
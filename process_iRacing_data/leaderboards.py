@@ -0,0 +1,160 @@
+"""Maintains the top lap times for each car class and track, updated incrementally as results arrive"""
+
+import os
+from decimal import Decimal
+
+#Number of drivers kept on each leaderboard
+LEADERBOARD_SIZE = int(os.environ.get('leaderboard_size', '10'))
+
+#Width in degrees C of the temperature bands a best lap is also kept for, 0 to keep none
+TEMP_BAND_WIDTH = float(os.environ.get('leaderboard_temp_band_width', '5'))
+
+#Attempts made to update a leaderboard changed by another writer since it was read
+UPDATE_MAX_ATTEMPTS = 5
+
+#The leaderboards kept for each car class and track, keyed by the session their laps come from
+BOARDS = {'QUALIFY': 'Pole', 'RACE': 'Race'}
+
+#Entries are stored with short keys to keep items small
+#t lap time in seconds, d driver, id customer id, c car, i iRating, w temperature, s subsession, at finish time
+
+def temp_band(temp):
+    """returns the key of the temperature band temp falls in, the lower bound of the band"""
+    return str(int(float(temp) // TEMP_BAND_WIDTH * TEMP_BAND_WIDTH))
+
+def generate_leaderboard_entries(data):
+    """
+    Returns the best qualifying and race lap of every driver in the results, by car class
+
+    Args:
+        data (dict) : the raw results for a subsession
+    Returns:
+        dict of car_class -> {board: list of entries}, where board is a value of BOARDS
+        Each list holds at most one entry per driver and is sorted fastest first
+    """
+    temp = Decimal(str(round((float(data['weather']['temp_value']) - 32) * 0.5556, 1)))
+
+    ret = {}
+    for i in data['session_results']:
+        board = BOARDS.get(i['simsession_name'])
+        if board is None:
+            continue
+        for j in i['results']:
+            lap = j['best_lap_time']
+            if board == 'Pole' and j.get('best_qual_lap_time'):
+                lap = j['best_qual_lap_time']
+            if lap <= 0:
+                continue
+            entry = {
+                't': Decimal(str(lap / 10000)),
+                'd': j['display_name'],
+                #rows without a customer id, e.g. teams, are told apart by name, whether the id is missing or null
+                'id': j.get('cust_id') or j['display_name'],
+                'c': j['car_name'],
+                'i': j['oldi_rating'] if j['oldi_rating'] > 0 else '',
+                'w': temp,
+                's': data.get('subsession_id', ''),
+                'at': data.get('end_time', ''),
+            }
+            ret.setdefault(j['car_class_name'], {}).setdefault(board, []).append(entry)
+
+    return {car_class: {board: merge_entries([], entries) for board, entries in boards.items()}
+            for car_class, boards in ret.items()}
+
+def merge_entries(current, new, size=None):
+    """
+    Combine two lists of entries into one leaderboard
+
+    Args:
+        current (list)  : entries already on the leaderboard
+        new (list)      : entries to add
+        size (int)      : most entries to keep, LEADERBOARD_SIZE if not given
+    Returns:
+        list of the fastest entries, one per driver, sorted fastest first
+        Ties keep the entry set first, so an existing entry is not displaced by an equal lap
+    """
+    best = {}
+    for entry in list(current) + list(new):
+        held = best.get(entry['id'])
+        if held is None or entry['t'] < held['t']:
+            best[entry['id']] = entry
+    return sorted(best.values(), key=lambda e: e['t'])[:size or LEADERBOARD_SIZE]
+
+def merge_boards(current, new):
+    """
+    Combine the leaderboards of two results for the same car class and track
+
+    Args:
+        current (dict)  : board -> entries merged so far, None if there is none yet
+        new (dict)      : board -> entries from another result
+    Returns:
+        dict of board -> entries
+    """
+    if current is None:
+        return new
+    return {board: merge_entries(current.get(board, []), new.get(board, []))
+            for board in dict.fromkeys(list(current) + list(new))}
+
+def merge_leaderboard(item, boards):
+    """
+    Apply new entries to a stored leaderboard item
+
+    Args:
+        item (dict)     : the item currently stored, empty if there is none
+        boards (dict)   : board -> entries, as returned by generate_leaderboard_entries
+    Returns:
+        The item to store, equal to item if none of the entries made a leaderboard
+    """
+    ret = dict(item)
+    for board, entries in boards.items():
+        ret[board] = merge_entries(item.get(board, []), entries)
+        if TEMP_BAND_WIDTH > 0:
+            bands = dict(ret.get('Bands', {}))
+            for entry in entries:
+                key = temp_band(entry['w'])
+                band = dict(bands.get(key, {}))
+                if board not in band or entry['t'] < band[board]['t']:
+                    band[board] = entry
+                    bands[key] = band
+            ret['Bands'] = bands
+    return ret
+
+def update_leaderboard(table, car_class, track, boards):
+    """
+    Add entries to the leaderboards of a car class and track
+
+    The item is read, merged and written back only if no other writer has changed it in
+    the meantime, tracked by its Version attribute. A write that loses the race is retried
+    against the newly stored item. Nothing is written if none of the entries made a leaderboard.
+
+    Args:
+        table           : boto3 DynamoDB Table resource for the leaderboards table
+        car_class (str) : class the car belongs to
+        track (str)     : track the data pertains to
+        boards (dict)   : board -> entries, as returned by generate_leaderboard_entries
+    Returns:
+        True if the leaderboards were updated, False if they were unchanged
+    """
+    key = {'CarClass': car_class, 'TrackName': track}
+    for _ in range(UPDATE_MAX_ATTEMPTS):
+        item = table.get_item(Key=key, ConsistentRead=True).get('Item', {})
+        new_item = merge_leaderboard(item, boards)
+        if item and new_item == item:
+            return False
+        version = item.get('Version', 0)
+        new_item.update(key)
+        new_item['Version'] = version + 1
+        try:
+            if item:
+                table.put_item(
+                    Item=new_item,
+                    ConditionExpression='#version = :version',
+                    ExpressionAttributeNames={'#version': 'Version'},
+                    ExpressionAttributeValues={':version': version},
+                )
+            else:
+                table.put_item(Item=new_item, ConditionExpression='attribute_not_exists(CarClass)')
+            return True
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+    raise RuntimeError(f"Leaderboard for {car_class} at {track} changed on every one of {UPDATE_MAX_ATTEMPTS} attempts")
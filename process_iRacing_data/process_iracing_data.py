@@ -1,12 +1,57 @@
 """This module handles the data from an SQS queue and records the neccassary in a DynamoDB Table"""
 
 import os
+import time
 from decimal import Decimal
 import json
-import boto3
+from irstats_common import aws
+from irstats_common.envelope import decode_payload
+from irstats_common.metrics import get_metrics, instrument_handler
+from best_lap_cache import BestLapCache
+import leaderboards
+import results_export
 
-dynamodb = boto3.resource("dynamodb", region_name='eu-west-2')
-table = dynamodb.Table(os.environ['table_name'])
+TABLE_NAME = os.environ['table_name']
+
+#Table the top laps for each car class and track are kept in, leaderboards are not kept if unset
+LEADERBOARD_TABLE_NAME = os.environ.get('leaderboard_table_name')
+
+#How class records are written
+#batch: read the existing records and write back any that changed
+#conditional: write each lap only if it is faster than the stored one, without reading first
+WRITE_MODE = os.environ.get('write_mode', 'batch')
+
+#The attributes written together for the pole and the fastest lap, keyed by the lap time attribute
+#Each maps the attribute stored in the table to the key of the class data it is taken from
+LAP_GROUPS = {
+    'pole_time': {
+        'pole_time': 'pole_time', 'pole_time_ir': 'pole_ir', 'pole_time_driver': 'pole_driver',
+        'pole_time_car': 'pole_car', 'pole_temp': 'pole_temp',
+    },
+    'fastest_lap': {
+        'fastest_lap': 'fastest_lap', 'fastest_lap_ir': 'fastest_lap_ir', 'fastest_lap_driver': 'fastest_lap_driver',
+        'fastest_lap_car': 'fastest_lap_car', 'fastest_lap_temp': 'fastest_lap_temp',
+    },
+}
+
+#Timings and counters of each invocation, logged as CloudWatch metrics when it returns
+metrics = get_metrics()
+
+#The best laps stored for each car class and track, kept for the life of the container
+best_laps = BestLapCache()
+
+#BatchGetItem accepts at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+#Attempts made to read back keys DynamoDB returns as unprocessed before giving up
+BATCH_GET_MAX_ATTEMPTS = 5
+
+def get_table():
+    """returns the table class records are stored in, created on first use"""
+    return aws.get_table(TABLE_NAME)
+
+def get_leaderboard_table():
+    """returns the table leaderboards are stored in, created on first use"""
+    return aws.get_table(LEADERBOARD_TABLE_NAME)
 
 def get_track_name(data):
     """returns the name of the track, complete with the config name if existing from the raw data"""
@@ -30,19 +75,44 @@ def get_car_class_list(data):
                     class_list.append(j['car_class_name'])
     return class_list
 
-def retrieve_existing_data(car_class, track):
-    """Searches the db for a particular track and carclass combination
-    returns the JSON data associated if it exists
-    Returns a blank object if no record is found"""
-    record = table.get_item(
-        Key={
-            'CarClass'  : car_class,
-            'TrackName' : track
+def retrieve_existing_data_batch(keys):
+    """
+    Searches the db for several track and carclass combinations using BatchGetItem
+    Keys returned as unprocessed by DynamoDB are retried with an exponential backoff
+
+    Args:
+        keys (list) : (car_class, track) tuples to look up
+    Returns:
+        dict of (car_class, track) -> the JSON data associated with it
+        A blank object is returned for any combination without a record
+    """
+    ret = {key: {} for key in keys}
+    unique_keys = list(ret)
+
+    for start in range(0, len(unique_keys), BATCH_GET_MAX_KEYS):
+        request_items = {
+            TABLE_NAME: {
+                'Keys': [
+                    {'CarClass': car_class, 'TrackName': track}
+                    for car_class, track in unique_keys[start:start + BATCH_GET_MAX_KEYS]
+                ]
+            }
         }
-    )
-    if 'Item' in record:
-        return record['Item']
-    return {}
+        attempt = 0
+        while request_items:
+            if attempt == BATCH_GET_MAX_ATTEMPTS:
+                raise RuntimeError(f"Unable to read {request_items} after {attempt} attempts")
+            if attempt:
+                metrics.count('DbReadRetries')
+                time.sleep(0.05 * 2 ** attempt)
+            with metrics.timer('DbBatchGet'):
+                response = aws.get_resource('dynamodb').batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(TABLE_NAME, []):
+                ret[(item['CarClass'], item['TrackName'])] = item
+            request_items = response.get('UnprocessedKeys')
+            attempt += 1
+
+    return ret
 
 def generate_class_specific_data(car_class, data):
     """
@@ -97,53 +167,139 @@ def generate_class_specific_data(car_class, data):
 
     return class_data
 
-def run_db_update(car_class, track, payload):
-    """Update the db table with the payload values for the provided car class and track"""
+@metrics.timed('ClassAggregation')
+def generate_all_class_data(data):
+    """
+    Returns the payload for every car class in the data, keyed by car class
+
+    Unlike calling generate_class_specific_data once per class, the qualifying and
+    race results are only walked once, so the cost does not grow with the number of classes
+
+    Args:
+        data (dict) : the raw results for a subsession
+    Returns:
+        dict of car_class -> class data, in the same shape as generate_class_specific_data
+        Only classes which took part in the race session are included
+    """
+
+    temp = (float(data['weather']['temp_value']) - 32) * 0.5556
+
+    #best qualifying and race laps seen so far, per class
+    best_q_laps = {}
+    best_r_laps = {}
+    #car classes in the order they appear in the race results, as get_car_class_list
+    race_classes = {}
+    all_class_data = {}
+
+    for i in data['session_results']:
+        is_race_session = i['simsession_number'] == 0
+        if i['simsession_name'] == 'QUALIFY':
+            for j in i['results']:
+                car_class = j['car_class_name']
+                if is_race_session:
+                    race_classes[car_class] = None
+                user_q_lap = j['best_qual_lap_time']
+                if not user_q_lap:
+                    user_q_lap = j['best_lap_time']
+                if 0 < user_q_lap < best_q_laps.get(car_class, 99999999):
+                    best_q_laps[car_class] = user_q_lap
+                    class_data = all_class_data.setdefault(car_class, {"pole_time": None, "fastest_lap": None})
+                    class_data['pole_time'] = j['best_lap_time'] / 10000
+                    class_data['pole_ir'] = j['oldi_rating'] if j['oldi_rating'] > 0 else ''
+                    class_data['pole_driver'] = j['display_name']
+                    class_data['pole_car'] = j['car_name']
+                    class_data['pole_temp'] = temp
+        elif i['simsession_name'] == 'RACE':
+            for j in i['results']:
+                car_class = j['car_class_name']
+                if is_race_session:
+                    race_classes[car_class] = None
+                user_r_lap = j['best_lap_time']
+                if 0 < user_r_lap < best_r_laps.get(car_class, 99999999):
+                    best_r_laps[car_class] = user_r_lap
+                    class_data = all_class_data.setdefault(car_class, {"pole_time": None, "fastest_lap": None})
+                    class_data['fastest_lap'] = user_r_lap / 10000
+                    class_data['fastest_lap_ir'] = j['oldi_rating'] if j['oldi_rating'] > 0 else ''
+                    class_data['fastest_lap_driver'] = j['display_name']
+                    class_data['fastest_lap_car'] = j['car_name']
+                    class_data['fastest_lap_temp'] = temp
+        elif is_race_session:
+            for j in i['results']:
+                race_classes[j['car_class_name']] = None
+
+    ret = {}
+    for car_class in race_classes:
+        ret[car_class] = all_class_data.get(car_class, {"pole_time": None, "fastest_lap": None})
+        if ret[car_class]['fastest_lap'] is None:
+            print (f"fastest lap not identified for class {car_class} raw data: {data}")
+
+    return ret
+
+def lap_attributes(class_data, lap_field):
+    """returns the attributes of one lap group of the class data, named as they are stored in the table"""
+    return {attribute: class_data[key] for attribute, key in LAP_GROUPS[lap_field].items() if key in class_data}
+
+def convert_floats_to_decimal(payload):
+    """Replace any float values in the payload with decimals, in place, and return it"""
     #DynamoDB does not support float, use decimal instead
     for key, value in payload.items():
         if isinstance(value, float):
             #the float -> str -> decimal avoids dynamoDB decimal.inexact and decimal.rounded errors
             payload[key] = Decimal(str(value))
+    return payload
 
-    update_expression = f"SET {','.join(f'#{k}=:{k}' for k in payload)}"
-    expression_attribute_values = {f':{k}': v for k, v in payload.items()}
-    expression_attribute_names = {f'#{k}': k for k in payload}
-
-    table.update_item(
-        Key={
-            'CarClass'  : car_class,
-            'TrackName' : track
-        },
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attribute_values,
-        ExpressionAttributeNames=expression_attribute_names,
-        ReturnValues='UPDATED_NEW',
-    )
-
-def add_new_db_entry(car_class, track, payload):
+def run_conditional_update(car_class, track, class_data, lap_field):
     """
-    Enter new data into the db
+    Write one group of lap attributes, only if the lap is faster than the one already stored
+
+    The comparison is made by DynamoDB as part of the update, so no prior read is needed
+    and a slower lap recorded concurrently can never overwrite a faster one
 
     Args:
-        car_class (string): class the car belongs to
-        track (string): track the data pertains to
-        payload (dict): the values to be entered in the data, pertaining to the car_class and track
+        car_class (string)  : class the car belongs to
+        track (string)      : track the data pertains to
+        class_data (dict)   : the values for the car_class, as returned by generate_class_specific_data
+        lap_field (string)  : the lap time attribute of the group to write, a key of LAP_GROUPS
     Returns:
-        Nothing
+        True if the record was updated, False if the stored lap was as fast or faster
     """
-    payload['CarClass'] = car_class
-    payload['TrackName'] = track
+    if class_data.get(lap_field) is None:
+        return False
 
-    #DynamoDB does not support float, use decimal instead
-    for key, value in payload.items():
-        if isinstance(value, float):
-            #the float -> str -> decimal avoids dynamoDB decimal.inexact and decimal.rounded errors
-            payload[key] = Decimal(str(value))
+    payload = convert_floats_to_decimal(lap_attributes(class_data, lap_field))
 
-    table.put_item(
-        Item=payload
-    )
-    return None
+    update_expression = f"SET {','.join(f'#{k}=:{k}' for k in payload)}"
+    expression_attribute_values = {f':{k}': v for k, v in payload.items()}
+    expression_attribute_values[':null'] = 'NULL'
+    expression_attribute_names = {f'#{k}': k for k in payload}
+
+    try:
+        get_table().update_item(
+            Key={
+                'CarClass'  : car_class,
+                'TrackName' : track
+            },
+            UpdateExpression=update_expression,
+            #Records created before a lap was set hold a NULL, which never compares as greater
+            ConditionExpression=(
+                f"attribute_not_exists(#{lap_field}) OR attribute_type(#{lap_field}, :null) "
+                f"OR #{lap_field} > :{lap_field}"
+            ),
+            ExpressionAttributeValues=expression_attribute_values,
+            ExpressionAttributeNames=expression_attribute_names,
+            #The stored record is returned when the condition fails, so the cache learns the lap that won
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+    except get_table().meta.client.exceptions.ConditionalCheckFailedException as e:
+        #The stored lap is as fast or faster, this is the normal outcome
+        stored = e.response.get('Item', {}).get(lap_field)
+        if stored is not None:
+            #Imported here so that boto3 is not loaded at cold start
+            from boto3.dynamodb.types import TypeDeserializer  # pylint: disable=import-outside-toplevel
+            best_laps.store((car_class, track), {lap_field: TypeDeserializer().deserialize(stored)})
+        return False
+    best_laps.store((car_class, track), {lap_field: payload[lap_field]})
+    return True
 
 def generate_db_payload(current, new):
     """
@@ -158,26 +314,22 @@ def generate_db_payload(current, new):
 
     #If there is no existing data, the new data is the payload
     if not current:
-        return new
+        ret_data = {}
+        for lap_field in LAP_GROUPS:
+            ret_data.update(lap_attributes(new, lap_field))
+        return ret_data
 
     #start on the assumption that we will return what is already in the database
-    ret_data = current
+    #copied so that callers can still tell whether anything has changed
+    ret_data = dict(current)
 
     #Check if any of the new data needs to replace the existing values
     #This is only required if the pole or fastest lap are faster (lower vals) than the existing
+    #The attributes written are the same as those written by run_conditional_update
     try:
-        if current['fastest_lap'] is None or new['fastest_lap'] < current['fastest_lap']:
-            #fastest lap data needs to be taken from the new dataset
-            ret_data['fastest_lap'] = new['fastest_lap']
-            ret_data['fastest_lap_ir'] = new['fastest_lap_ir']
-            ret_data['fastest_lap_driver'] = new['fastest_lap_driver']
-            ret_data['fastest_lap_car'] = new['fastest_lap_car']
-        if current['pole_time'] is None or new['pole_time'] < current['pole_time']:
-            #Pole lap data needs to be taken from the new dataset
-            ret_data['pole_time'] = new['pole_time']
-            ret_data['pole_time_ir'] = new['pole_ir']
-            ret_data['pole_time_driver'] = new['pole_driver']
-            ret_data['pole_time_car'] =  new['pole_car']
+        for lap_field in LAP_GROUPS:
+            if new[lap_field] is not None and (current[lap_field] is None or new[lap_field] < current[lap_field]):
+                ret_data.update(lap_attributes(new, lap_field))
     except KeyError:
         print (f"Key Error \n Existing: {current} \n New: {new}")
     except TypeError:
@@ -185,26 +337,191 @@ def generate_db_payload(current, new):
 
     return ret_data
 
+def merge_class_data(current, new):
+    """
+    Combine the class data of two results for the same car class and track
+
+    Args:
+        current (dict)  : the class data merged so far, None if there is none yet
+        new (dict)      : the class data from another result
+    Returns:
+        Class data holding the faster of the two poles and the faster of the two fastest laps
+    """
+    if current is None:
+        return new
+
+    ret_data = dict(current)
+    for lap_field, fields in LAP_GROUPS.items():
+        if new.get(lap_field) is not None and (ret_data.get(lap_field) is None or new[lap_field] < ret_data[lap_field]):
+            for k in fields.values():
+                ret_data.pop(k, None)
+                if k in new:
+                    ret_data[k] = new[k]
+    return ret_data
+
+@metrics.timed('DbWrite')
+def persist_class_records(class_records):
+    """
+    Record the data for several car class and track combinations using batched reads and writes
+
+    All existing records are fetched with BatchGetItem and any new or changed records
+    are written back through a batch writer, so a multiclass subsession costs a fixed
+    number of round trips rather than two per class.
+    Combinations whose laps cannot beat the cached best laps are neither read nor written
+
+    Args:
+        class_records (dict)    : (car_class, track) -> class data
+    Returns:
+        The number of records written
+    """
+    #Every lap group is looked up, so the cache metrics count each of them
+    pending = {
+        key: class_data for key, class_data in class_records.items()
+        if any([best_laps.might_improve(key, lap_field, class_data.get(lap_field)) for lap_field in LAP_GROUPS])
+    }
+    metrics.count('DbReadsSaved', len(class_records) - len(pending))
+    if not pending:
+        return 0
+    existing = retrieve_existing_data_batch(list(pending))
+
+    changed = []
+    #(car_class, track) -> the laps stored once the writes are done
+    stored = {}
+    for (car_class, track), class_data in pending.items():
+        existing_data = existing[(car_class, track)]
+        #converted up front so lap times compare exactly against the decimals already stored
+        payload = generate_db_payload(existing_data, convert_floats_to_decimal(dict(class_data)))
+        if not existing_data or payload != existing_data:
+            payload['CarClass'] = car_class
+            payload['TrackName'] = track
+            changed.append(payload)
+        #if existingData does exist and payload == existingData then no update is required.
+        stored[(car_class, track)] = {lap_field: payload.get(lap_field) for lap_field in LAP_GROUPS}
+
+    if changed:
+        with get_table().batch_writer(overwrite_by_pkeys=['CarClass', 'TrackName']) as batch:
+            for payload in changed:
+                batch.put_item(Item=payload)
+    for key, laps in stored.items():
+        best_laps.store(key, laps)
+    return len(changed)
+
+@metrics.timed('DbWrite')
+def persist_class_records_conditionally(class_records):
+    """
+    Record the data for several car class and track combinations using conditional updates
+
+    The pole and fastest lap of each class are written separately with run_conditional_update,
+    no existing records are read. Laps which cannot beat the cached best laps are not written
+
+    Args:
+        class_records (dict)    : (car_class, track) -> class data
+    Returns:
+        The number of lap groups written
+    """
+    written = 0
+    for (car_class, track), class_data in class_records.items():
+        for lap_field in LAP_GROUPS:
+            lap = class_data.get(lap_field)
+            if lap is not None and not best_laps.might_improve((car_class, track), lap_field, lap):
+                metrics.count('DbUpdatesSaved')
+                continue
+            written += run_conditional_update(car_class, track, class_data, lap_field)
+    return written
+
+@instrument_handler
 def lambda_handler(event, context):
-    """Main trigger for the module when being run from lambda"""
+    """
+    Main trigger for the module when being run from lambda
+
+    Every record in the batch is processed before anything is written. Results for the same
+    car class and track are coalesced, so each record and leaderboard is written at most once per batch.
+    Records which could not be processed or written are reported back to SQS as batch item
+    failures, so only those records are retried.
+    """
     #Unused parameters
     del context
 
+    #(car_class, track) -> class data, merged across every record in the batch
+    class_records = {}
+    #(car_class, track) -> leaderboard entries, merged across every record in the batch
+    board_records = {}
+    #(car_class, track) -> the messageIds of the records which contributed to it
+    contributors = {}
+    #every driver row of the batch, exported together when an export path is set
+    export_columns = None
+    exported_message_ids = []
+    failed_message_ids = []
+
     for record in event['Records']:
-        data = record['body']
-        if not isinstance(data, dict):
-            data = json.loads(data)
-        #Identify car classes and track involved
-        track = get_track_name(data)
-        class_list = get_car_class_list(data)
-
-        for car_class in class_list:
-            #Generate the specific data for this carClass
-            class_data = generate_class_specific_data(car_class, data)
-            existing_data = retrieve_existing_data(car_class, track)
-            payload = generate_db_payload(existing_data, class_data)
-            if existing_data is not None and payload is not None and payload != existing_data:
-                run_db_update(car_class, track, payload)
-            elif not existing_data:
-                add_new_db_entry(car_class, track, payload)
-            #if existingData does exist and payload == existingData then no update is required.
+        metrics.count('Records')
+        try:
+            #Results are either inline in the message or offloaded to S3
+            with metrics.timer('DecodePayload'):
+                data = decode_payload(record['body'], aws.get_client('s3'))
+            #Identify the track and generate the specific data for every carClass in one pass
+            with metrics.timer('Aggregate'):
+                track = get_track_name(data)
+                all_class_data = generate_all_class_data(data)
+                all_boards = leaderboards.generate_leaderboard_entries(data) if LEADERBOARD_TABLE_NAME else {}
+                export_rows = results_export.flatten_results(data, track) if results_export.EXPORT_PATH else None
+        except Exception as e: # pylint: disable=broad-except
+            print (f"Unable to process record {record.get('messageId')} {type(e)}: {str(e)}")
+            failed_message_ids.append(record.get('messageId'))
+            continue
+        for car_class, class_data in all_class_data.items():
+            key = (car_class, track)
+            class_records[key] = merge_class_data(class_records.get(key), class_data)
+            contributors.setdefault(key, []).append(record.get('messageId'))
+        if export_rows:
+            export_columns = results_export.extend_columns(export_columns, export_rows)
+            exported_message_ids.append(record.get('messageId'))
+        for car_class, boards in all_boards.items():
+            key = (car_class, track)
+            board_records[key] = leaderboards.merge_boards(board_records.get(key), boards)
+            contributors.setdefault(key, []).append(record.get('messageId'))
+
+    failed_keys = []
+    if WRITE_MODE == 'conditional':
+        for key, class_data in class_records.items():
+            try:
+                metrics.count('DbWrites', persist_class_records_conditionally({key: class_data}))
+            except Exception as e: # pylint: disable=broad-except
+                print (f"Unable to record {key} {type(e)}: {str(e)}")
+                failed_keys.append(key)
+    elif class_records:
+        try:
+            metrics.count('DbWrites', persist_class_records(class_records))
+        except Exception as e: # pylint: disable=broad-except
+            print (f"Unable to record batch {type(e)}: {str(e)}")
+            failed_keys = list(class_records)
+
+    #Each leaderboard is a single item, updated once per batch
+    for key, boards in board_records.items():
+        try:
+            with metrics.timer('LeaderboardWrite'):
+                written = leaderboards.update_leaderboard(get_leaderboard_table(), key[0], key[1], boards)
+            metrics.count('LeaderboardWrites', written)
+        except Exception as e: # pylint: disable=broad-except
+            print (f"Unable to update leaderboard {key} {type(e)}: {str(e)}")
+            failed_keys.append(key)
+
+    for key in failed_keys:
+        failed_message_ids.extend(contributors[key])
+
+    if export_columns:
+        try:
+            with metrics.timer('Export'):
+                paths = results_export.export_rows(export_columns, results_export.EXPORT_PATH, aws.get_client('s3'))
+            metrics.count('ExportFiles', len(paths))
+        except Exception as e: # pylint: disable=broad-except
+            print (f"Unable to export results {type(e)}: {str(e)}")
+            failed_message_ids.extend(exported_message_ids)
+
+    failed_message_ids = list(dict.fromkeys(failed_message_ids))
+    metrics.count('FailedRecords', len(failed_message_ids))
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': message_id} for message_id in failed_message_ids
+        ]
+    }
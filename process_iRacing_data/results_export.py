@@ -0,0 +1,160 @@
+"""
+Exports every driver row of the processed results as Parquet for historical analysis
+
+Rows are flattened into columns, then written as one Parquet file per track and week
+partition for each batch, laid out as track=<track>/week=<YYYY-Www>/part-<id>.parquet
+under either an s3:// URL or a local directory. Files are written at least once, a batch
+that is retried may write its rows again, see analytics.lap_percentiles for reading them.
+
+pyarrow is optional, it is only imported when results are written. If it is not installed
+exporting is turned off at cold start, with a line in the log.
+"""
+
+import importlib.util
+import io
+import os
+import uuid
+from datetime import timezone
+from urllib.parse import quote
+from irstats_common import timestamps
+
+#Where results are exported to, an s3://bucket/prefix URL or a local directory, nothing is exported if unset
+EXPORT_PATH = os.environ.get('analytics_export_path')
+
+#Without pyarrow every export would fail and its records be retried forever, so exporting is turned off instead
+#Only looked up here, pyarrow itself is imported when results are first written
+if EXPORT_PATH and importlib.util.find_spec('pyarrow') is None:
+    print (f"analytics_export_path is {EXPORT_PATH} but pyarrow is not installed, results are not exported")
+    EXPORT_PATH = None
+
+#Parquet compression codec
+EXPORT_COMPRESSION = os.environ.get('analytics_export_compression', 'zstd')
+
+#Column name -> pyarrow type name, in the order the columns are written
+COLUMNS = {
+    'subsession_id': 'int64',
+    'end_time': 'timestamp',
+    'track': 'string',
+    'simsession_name': 'string',
+    'car_class': 'string',
+    'cust_id': 'int64',
+    'driver': 'string',
+    'car': 'string',
+    'best_lap_time': 'float64',
+    'best_qual_lap_time': 'float64',
+    'average_lap': 'float64',
+    'irating': 'int32',
+    'temp': 'float64',
+}
+
+def parse_end_time(value):
+    """returns the timezone aware finish time of a subsession from the time given by the API"""
+    return timestamps.parse_time(value).astimezone(timezone.utc)
+
+def get_week(end_time):
+    """returns the ISO week a time falls in as YYYY-Www"""
+    year, week, _ = end_time.isocalendar()
+    return f"{year}-W{week:02d}"
+
+def lap_seconds(value):
+    """returns a lap time in 1/10000s of a second as seconds, None if no lap was set"""
+    return value / 10000 if value and value > 0 else None
+
+def flatten_results(data, track):
+    """
+    Returns a row for every driver in every session of the results, as columns
+
+    Args:
+        data (dict)     : the raw results for a subsession
+        track (string)  : the name of the track, as returned by get_track_name
+    Returns:
+        dict of column name -> list of values, every list the same length
+    """
+    columns = {name: [] for name in COLUMNS}
+
+    end_time = parse_end_time(data['end_time'])
+    temp = (float(data['weather']['temp_value']) - 32) * 0.5556
+
+    for i in data['session_results']:
+        for j in i['results']:
+            columns['subsession_id'].append(data['subsession_id'])
+            columns['end_time'].append(end_time)
+            columns['track'].append(track)
+            columns['simsession_name'].append(i['simsession_name'])
+            columns['car_class'].append(j['car_class_name'])
+            columns['cust_id'].append(j.get('cust_id'))
+            columns['driver'].append(j['display_name'])
+            columns['car'].append(j['car_name'])
+            columns['best_lap_time'].append(lap_seconds(j['best_lap_time']))
+            columns['best_qual_lap_time'].append(lap_seconds(j.get('best_qual_lap_time')))
+            columns['average_lap'].append(lap_seconds(j.get('average_lap')))
+            columns['irating'].append(j['oldi_rating'] if j['oldi_rating'] > 0 else None)
+            columns['temp'].append(temp)
+
+    return columns
+
+def extend_columns(columns, rows):
+    """Append the rows of one set of columns to another, returning the combined columns"""
+    if columns is None:
+        return rows
+    for name, values in rows.items():
+        columns[name].extend(values)
+    return columns
+
+def get_schema():
+    """returns the pyarrow schema of the exported rows"""
+    import pyarrow as pa
+    types = {
+        'int64': pa.int64(),
+        'int32': pa.int32(),
+        'float64': pa.float64(),
+        'string': pa.string(),
+        'timestamp': pa.timestamp('us', tz='UTC'),
+    }
+    return pa.schema([(name, types[type_name]) for name, type_name in COLUMNS.items()])
+
+def partition_rows(columns):
+    """
+    Split the rows into their track and week partitions
+
+    Returns:
+        dict of (track, week) -> list of row indexes
+    """
+    partitions = {}
+    for n, (track, end_time) in enumerate(zip(columns['track'], columns['end_time'])):
+        partitions.setdefault((track, get_week(end_time)), []).append(n)
+    return partitions
+
+def write_parquet(table, path, s3_client=None):
+    """Write a pyarrow table to path, an s3:// URL or a local file"""
+    import pyarrow.parquet as pq
+    if path.startswith('s3://'):
+        bucket, key = path[len('s3://'):].split('/', 1)
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression=EXPORT_COMPRESSION)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, path, compression=EXPORT_COMPRESSION)
+
+def export_rows(columns, destination, s3_client=None):
+    """
+    Write the rows as Parquet, one file per track and week
+
+    Args:
+        columns (dict)          : column name -> list of values, as returned by flatten_results
+        destination (string)    : s3://bucket/prefix URL or local directory to write under
+        s3_client               : boto3 S3 client, needed when destination is an s3:// URL
+    Returns:
+        list of the paths written
+    """
+    import pyarrow as pa
+    batch = pa.RecordBatch.from_pydict(columns, schema=get_schema())
+    batch_id = uuid.uuid4().hex
+    paths = []
+    for (track, week), rows in partition_rows(columns).items():
+        #Partition values are URL encoded so any track name makes a valid path
+        path = f"{destination.rstrip('/')}/track={quote(track, safe='')}/week={week}/part-{batch_id}.parquet"
+        write_parquet(pa.Table.from_batches([batch.take(pa.array(rows))]), path, s3_client)
+        paths.append(path)
+    return paths
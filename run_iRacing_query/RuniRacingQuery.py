@@ -1,158 +1,227 @@
-import json
-import boto3
+import math
 import os
-import requests
-from datetime import timedelta
-from dateutil.parser import parse
-import pickle
-
-def doesS3FileExist(bucket, file):
-    #print (f"Checking if {file} exists in {bucket}")
-    results = s3.list_objects(Bucket=bucket, Prefix=file)
-    return 'Contents' in results
-
-def getLoginCredentials(bucket, file):
-    #TODO: Replace this with AWS Secret Manager
-    if doesS3FileExist(bucket, file):
-        return json.loads(s3.get_object(Bucket=bucket, Key=file)["Body"].read())
-    return {}
-    #accessed via dict_name["email"] and dict_name["password"]
-
-def storeCookie(text, bucket, cookieFile):
-    #print ("Storing new cookie file")
-    s3.put_object(Body=text, Bucket=bucket, Key=cookieFile)
-
-def getCookie(bucket, file):
-    if doesS3FileExist(bucket, file):
-        #print ("getting cookie file from s3 bucket")
-        return pickle.loads(s3.get_object(Bucket=bucket, Key=file)["Body"].read())
-    return ""
-
-def authenticate():
-    params = getLoginCredentials(s3_bucket, "credentials.json")
-    response = requests.post("https://members-ng.iracing.com/auth", data=params)
-    if response.status_code == 200:
-        print("Successfully authenticated with iRacing")     
-        storeCookie(pickle.dumps(response.cookies), s3_bucket, cookieFileName)
-        return True
-    return False
-
-def getQueryText(url, cookie):
-    r = requests.get(f"{url}", cookies=cookie)
+import time
+from irstats_common import aws, backfill, messages, priority, timestamps
+from authSession import AuthSession
+from chunkDownloader import iterChunkItems
+from queuePublisher import QueuePublisher
+from irstats_common.envelope import encode_payload
+from irstats_common.messages import Results, ResultsFetch, SessionSearch
+from irstats_common.metrics import get_metrics, instrument_handler
+from rateLimiter import limiter, RateLimited
+from scheduler import Scheduler
+from subsessionIndex import SubsessionIndex
+
+#Timings and counters of each invocation, logged as CloudWatch metrics when it returns
+metrics = get_metrics()
+
+def getQueryText(url):
+    #Requests are paced by the shared rate limiter, which also retries 429 responses
+    #RateLimited is raised if the budget is exhausted so the caller can requeue the work
+    #Backlog work is only given its share of the budget, so it cannot hold up fresh work
+    share = scheduler.rateShare()
+    session, generation = authSession.getSession()
+    r = limiter.get(f"{url}", session=session, share=share)
+    if r.status_code == 401:
+        #Authentication error - re-auth and try again with the fresh session
+        #Only one thread logs in again, however many saw the 401
+        metrics.count('Api401s')
+        session, _ = authSession.refresh(generation)
+        r = limiter.get(f"{url}", session=session, share=share)
     if r: 
         return r.text
-    elif r.status_code == 401:
-        #Authentication error - re-auth and try again
-        authenticate()
-        getQueryText(url, cookie)
-    elif r.status_code == 429:
-        #print for logs and return blank
-        print ("We are rate limited")
-        return ""
     else: 
         #Other error, print for logs and return
+        metrics.count('ApiErrors')
         print (f"iRacing Status Code Error {r.status_code}")
         print (r.text)
         return ""
 
-def getSessionIDListQueryResult(url, cookie):
-    #Returns a list of results
+def iterSessionIDListQueryResult(url):
+    #Yields the results one at a time
     #Used for queries that can be expected to return a JSON array
-    ret = []
-    responseText = getQueryText(url, cookie)
+    #Each chunk's response is streamed and parsed incrementally, so the full list is never held in memory
+    responseText = getQueryText(url)
     if responseText:
-        i = json.loads(responseText)
+        i = messages.loads(responseText)
         if (i['data']['chunk_info']) and ('base_download_url' in i['data']['chunk_info']) and ('chunk_file_names' in i['data']['chunk_info']):
-            for j in i['data']['chunk_info']['chunk_file_names']:
-                r2 = requests.get(f"{i['data']['chunk_info']['base_download_url']}{j}")
-                #At this stage each iteration of r2.text is a a plain text encoded JSON array
-                #Each array is terminated after each instance of r2 (which are chunks of raw data)
-                #We want to return a single python list from this function
-                data = json.loads(r2.text)
-                for k in data:
-                   ret.append(k)    
-        return ret
-
-def handleGenerateSessionID(url, cookie):
-    #For GenerateSessionID - run the query, isolate the subsession IDs and add them back to the SQS Queue to be run by a subsequent invocation
-    #Record the highest finish time and record this to the DB, this is fed into the GenerateSessionID query by the function which generates that
-    sessionList = getSessionIDListQueryResult(url, cookie)
-    if sessionList:
-        maxtime = parse("2000-01-01T00:00:00Z")
-        for i in sessionList:
-            t = parse(i['end_time'])
-            if t > maxtime:
+            yield from iterChunkItems(i['data']['chunk_info']['base_download_url'], i['data']['chunk_info']['chunk_file_names'])
+
+def handleGenerateSessionID(url, window=None):
+    #For GenerateSessionID - run the query and queue a fetch for each subsession not already queued or processed
+    #The highest finish time found is recorded to the DB, as the watermark or against the window searched
+    if window:
+        backfill.start_window(getTable(), window, int(time.time()))
+    found = False
+    maxtime = None
+    with scheduler.publisher() as publisher:
+        for i in iterSessionIDListQueryResult(url):
+            found = True
+            metrics.count('SubsessionsFound')
+            t = timestamps.canonical(i['end_time'])
+            if maxtime is None or t > maxtime:
                 maxtime = t
-            newUrl = f"https://members-ng.iracing.com/data/results/get?subsession_id={i['subsession_id']}"
-            payload = {
-                'type': 'RetrieveData',
-                'url' : newUrl
-            }
+            with metrics.timer('IndexClaim'):
+                claimed = getSubsessionIndex().claim(i['subsession_id'])
+            if not claimed:
+                metrics.count('SubsessionsSkipped')
+                continue
+            newUrl = f"{iRacingBaseUrl}/data/results/get?subsession_id={i['subsession_id']}"
+            fetch = ResultsFetch(newUrl, i['subsession_id'], i['end_time'])
+            tier = scheduler.tierOf(fetch)
+            metrics.count(f"Queued{tier.capitalize()}")
             #Disable this line to stop thousands of invocations while testing
-            apiQueue.send_message(MessageBody=json.dumps(payload))
-        table.update_item(
-            Key={
-            'Parameter': 'finish_range_begin'
-            },
-            ExpressionAttributeNames={
-                '#value': 'Value'
-            },
-            ExpressionAttributeValues={
-                ':nv': maxtime.strftime('%Y-%m-%dT%H:%MZ')
-            },
-            UpdateExpression='SET #value = :nv',
-            ReturnValues='UPDATED_NEW'
-        )
-        return True
-    return False
-
-def handleRetrieveDataQuery(url, cookie):
+            publisher.send(fetch.encode(), tier, tag=i['subsession_id'])
+        failedIds = publisher.flush()
+    #Subsessions which could not be queued are released so the next search queues them again
+    for subsessionId in failedIds:
+        getSubsessionIndex().release(subsessionId)
+    if failedIds:
+        raise RuntimeError(f"{len(failedIds)} subsessions could not be queued")
+    foundUntil = timestamps.parse_time(maxtime).strftime(backfill.TIME_FORMAT) if found else None
+    with metrics.timer('WatermarkUpdate'):
+        if window:
+            backfill.complete_window(getTable(), window, foundUntil)
+        elif found:
+            backfill.set_watermark(getTable(), foundUntil)
+    return found
+
+@metrics.timed('EncodePayload')
+def encodeResults(text):
+    #Projects the downloaded results to a Results message, offloading it to S3 if too large to queue
+    results = Results.from_results(messages.loads(text))
+    return encode_payload(results, aws.get_client("s3"), s3_bucket)
+
+def handleRetrieveDataQuery(url, publisher=None, tag=None):
     #For Retrieve Data we simply run the API query to get a link to the data
-    #The data is then added to the SQS queue as JSON for further processing
+    #The data is then queued as a Results message for further processing, through publisher if given
     payload = {}
-    i = getQueryText(url, cookie)
+    i = getQueryText(url)
     try:
-        payload = json.loads(i)
+        payload = messages.loads(i)
         if 'link' in payload:
-            j = getQueryText(payload['link'] ,cookie)
-            payload = json.loads(j)
-            dataQueue.send_message(MessageBody=json.dumps(payload))
+            j = getQueryText(payload['link'])
+            body = encodeResults(j)
+            if publisher:
+                publisher.send(body, tag=tag)
+            else:
+                getDataQueue().send_message(MessageBody=body)
             return True
+    except RateLimited:
+        raise
     except Exception as e:
         print (f"{type(e)}: {str(e)}")
         return False
 
+#iRacing API, overridden to run against a local stand-in
+iRacingBaseUrl = os.environ.get('iracing_base_url', 'https://members-ng.iracing.com')
+
 #S3 Details
-s3 = boto3.client("s3")
 s3_bucket = os.environ['bucket_name']
 
 cookieFileName = os.environ['cookie_file_name']
 
+#AWS clients and resources are only created when first used
+
 #SQS Details
-sqs = boto3.resource('sqs', region_name='eu-west-2')
-apiQueue = sqs.get_queue_by_name(QueueName=os.environ['api_queue_name'])
-dataQueue = sqs.get_queue_by_name(QueueName=os.environ['data_queue_name'])
+#Queue URLs come from the environment when set, so a cold start does not have to look them up
+#Fresh work is queued on the API queue, backlog work on the backlog queue if there is one
+apiQueueName = os.environ['api_queue_name']
+apiQueueUrl = os.environ.get('api_queue_url')
+backlogQueueName = os.environ.get('backlog_queue_name')
+backlogQueueUrl = os.environ.get('backlog_queue_url')
+dataQueueName = os.environ['data_queue_name']
+dataQueueUrl = os.environ.get('data_queue_url')
+
+def getApiQueue():
+    return aws.get_queue(apiQueueName, apiQueueUrl)
+
+def getBacklogQueue():
+    return aws.get_queue(backlogQueueName, backlogQueueUrl)
+
+def getDataQueue():
+    return aws.get_queue(dataQueueName, dataQueueUrl)
 
 #dynamoDB Details
-dynamodb = boto3.resource("dynamodb", region_name='eu-west-2')
-table = dynamodb.Table(os.environ['table_name'])
+tableName = os.environ['table_name']
+
+def getTable():
+    return aws.get_table(tableName)
+
+#Subsessions already queued or processed, disabled if no table is configured
+processedTableName = os.environ.get('processed_table_name')
+_subsessionIndex = None
 
+def getSubsessionIndex():
+    global _subsessionIndex
+    if _subsessionIndex is None:
+        _subsessionIndex = SubsessionIndex(aws.get_table(processedTableName) if processedTableName else None)
+    return _subsessionIndex
 
+#Routes work between the fresh and backlog tiers
+scheduler = Scheduler({priority.FRESH: getApiQueue, priority.BACKLOG: getBacklogQueue if backlogQueueName else None})
 
-cookie = None
+#A live login to iRacing, kept for the life of the container
+authSession = AuthSession(iRacingBaseUrl, s3_bucket, cookieFileName)
 
+#SQS does not allow a message to be delayed by more than 15 minutes
+maxRequeueDelay = 900
+
+@instrument_handler
 def lambda_handler(event, context):
-        #Iterate through events, each event should only contain one record but this covers if not
-    global cookie
-    if not cookie:
-        cookie = getCookie(s3_bucket, cookieFileName)
-    
+    #Each record is handled on its own, only the records which fail are reported back to SQS for a retry
+    #Results from every record in the batch are sent to the data queue together
+    dataPublisher = QueuePublisher(getDataQueue())
+    #(messageId, subsession_id) of every record whose results were added to dataPublisher
+    retrieved = []
+    batchItemFailures = []
     for record in event['Records']:
-        a = record['body']
-        a = json.loads(a)
-        if a['type'] == 'GenerateSessionID':
-            handleGenerateSessionID(a['url'], cookie)
-        elif a['type'] == 'RetrieveData':
-            handleRetrieveDataQuery(a['url'], cookie)
-
-    return None
\ No newline at end of file
+        metrics.count('Records')
+        try:
+            #Messages are checked against the schema, anything else fails here rather than part way through
+            a = messages.decode_task(record['body'])
+            tier = scheduler.tierOf(a)
+            metrics.count(f"{tier.capitalize()}Records")
+            if a.end_time:
+                metrics.maximum(f"{tier.capitalize()}Age", priority.age_seconds(a.end_time))
+            with scheduler.running(tier):
+                if isinstance(a, SessionSearch):
+                    handleGenerateSessionID(a.url, a.window)
+                elif isinstance(a, ResultsFetch):
+                    #A subsession already processed, e.g. from a message delivered twice, is not fetched again
+                    if getSubsessionIndex().isDone(a.subsession_id):
+                        continue
+                    #Nothing is queued if the data could not be retrieved, retry it rather than lose the subsession
+                    if not handleRetrieveDataQuery(a.url, dataPublisher, record.get('messageId')):
+                        raise RuntimeError(f"Unable to retrieve data from {a.url}")
+                    retrieved.append((record.get('messageId'), a.subsession_id))
+        except RateLimited as e:
+            #The API budget is exhausted, put the work back on the queue to run once it has reset rather than dropping it
+            try:
+                delay = min(maxRequeueDelay, max(1, math.ceil(e.retryAfter)))
+                scheduler.queue(tier).send_message(MessageBody=a.encode(), DelaySeconds=delay)
+                metrics.count('RateLimitedRequeues')
+                print (f"Record {record.get('messageId')} rate limited, requeued with a {delay}s delay")
+            except Exception as e2:
+                print (f"Record {record.get('messageId')} failed to requeue {type(e2)}: {str(e2)}")
+                batchItemFailures.append({'itemIdentifier': record.get('messageId')})
+        except Exception as e:
+            print (f"Record {record.get('messageId')} failed {type(e)}: {str(e)}")
+            batchItemFailures.append({'itemIdentifier': record.get('messageId')})
+
+    #Records whose results could not be queued are retried
+    try:
+        failedIds = dataPublisher.flush()
+    finally:
+        dataPublisher.close()
+    for messageId in failedIds:
+        if {'itemIdentifier': messageId} not in batchItemFailures:
+            batchItemFailures.append({'itemIdentifier': messageId})
+    #Only subsessions whose results have actually been queued are marked as done
+    with metrics.timer('IndexMarkDone'):
+        for messageId, subsessionId in retrieved:
+            if messageId not in failedIds:
+                getSubsessionIndex().markDone(subsessionId)
+    metrics.count('FailedRecords', len(batchItemFailures))
+
+    return {'batchItemFailures': batchItemFailures}
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+import requests
+from requests.cookies import create_cookie
+from irstats_common import aws
+from irstats_common.metrics import get_metrics
+
+### Keeps a live, authenticated requests.Session for the iRacing API, shared by every thread in the container
+### The session cookies are persisted to S3 as JSON so a new container can reuse them rather than log in again
+### Credentials are refreshed before they expire, and only one thread authenticates at a time
+
+#Longest a login is trusted for when iRacing does not give its cookies an expiry
+maxAge = int(os.environ.get('auth_max_age_seconds', '3600'))
+#Re-authenticate this many seconds before the login expires
+refreshMargin = int(os.environ.get('auth_refresh_margin_seconds', '120'))
+
+class AuthenticationError(Exception):
+    pass
+
+class AuthSession:
+
+    def __init__(self, baseUrl, bucket, cookieFile, credentialsFile='credentials.json', maxAge=maxAge,
+                 refreshMargin=refreshMargin, clock=time.time):
+        self.baseUrl = baseUrl
+        self.bucket = bucket
+        self.cookieFile = cookieFile
+        self.credentialsFile = credentialsFile
+        self.maxAge = maxAge
+        self.refreshMargin = refreshMargin
+        self.clock = clock
+        self.session = None
+        self.expires = 0
+        #Incremented on every login, used to tell whether a failed request used a session which has since been replaced
+        self.generation = 0
+        self.authentications = 0
+        self._lock = threading.Lock()
+
+    def _readS3Json(self, key):
+        #Returns None if the object does not exist, no separate existence check is made
+        s3 = aws.get_client('s3')
+        try:
+            body = s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            #e.g. a cookie jar pickled by an earlier version, log in again instead
+            print (f"Ignoring unreadable s3://{self.bucket}/{key}")
+            return None
+
+    def _newSession(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=20)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _load(self):
+        stored = self._readS3Json(self.cookieFile)
+        if not stored or stored.get('expires', 0) - self.refreshMargin <= self.clock():
+            return False
+        session = self._newSession()
+        for c in stored['cookies']:
+            session.cookies.set_cookie(create_cookie(**c))
+        self.session = session
+        self.expires = stored['expires']
+        self.generation += 1
+        return True
+
+    def _store(self):
+        cookies = [
+            {'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires, 'secure': c.secure}
+            for c in self.session.cookies
+        ]
+        aws.get_client('s3').put_object(
+            Bucket=self.bucket,
+            Key=self.cookieFile,
+            Body=json.dumps({'expires': self.expires, 'cookies': cookies}),
+            ContentType='application/json'
+        )
+
+    def _authenticate(self):
+        #TODO: Replace this with AWS Secret Manager
+        #accessed via dict_name["email"] and dict_name["password"]
+        params = self._readS3Json(self.credentialsFile) or {}
+        session = self._newSession()
+        get_metrics().count('AuthLogins')
+        with get_metrics().timer('AuthLogin'):
+            response = session.post(f"{self.baseUrl}/auth", data=params)
+        if response.status_code != 200:
+            raise AuthenticationError(f"iRacing authentication failed with status {response.status_code}")
+        print("Successfully authenticated with iRacing")
+        now = self.clock()
+        cookieExpiry = [c.expires for c in session.cookies if c.expires]
+        self.expires = min(cookieExpiry + [now + self.maxAge])
+        self.session = session
+        self.generation += 1
+        self.authentications += 1
+        self._store()
+
+    def getSession(self):
+        #Returns the current session and its generation, logging in first if there is no valid session
+        with self._lock:
+            if self.session is None:
+                with get_metrics().timer('AuthLoad'):
+                    self._load()
+            if self.session is None or self.expires - self.refreshMargin <= self.clock():
+                self._authenticate()
+            return self.session, self.generation
+
+    def refresh(self, staleGeneration):
+        #Called after a 401 from a session of staleGeneration
+        #If another thread has already logged in since that session was handed out, its login is reused
+        with self._lock:
+            if self.generation == staleGeneration:
+                self._authenticate()
+            return self.session, self.generation
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from irstats_common.metrics import get_metrics
+
+### Downloads the chunk files returned by iRacing queries which produce large result sets
+### Chunks are fetched concurrently over a shared keep-alive session and their items streamed one at a time in their original order
+### so a large result set never has to be held in memory
+
+#Number of chunk files downloaded at once, 1 downloads them one after another
+defaultWorkers = int(os.environ.get('chunk_download_workers', '8'))
+
+#Size of the pieces read from a streamed chunk response
+streamReadSize = 64 * 1024
+
+_whitespace = ' \t\n\r'
+
+#Characters which may continue a number, e.g. 1 followed by e5, a number followed by any of them is not yet complete
+_numberContinuation = '0123456789.eE+-'
+
+_session = None
+_sessionLock = threading.Lock()
+
+def getSession():
+    #A pooled session, shared between threads and kept across warm invocations
+    #so each chunk reuses an open connection instead of paying for a new TCP and TLS handshake
+    global _session
+    with _sessionLock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(defaultWorkers, 10))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+def iterJsonArray(pieces):
+    #Incrementally decodes a JSON array from an iterable of text pieces
+    #Each element is yielded as soon as it is complete, only the unparsed remainder is kept in memory
+    decoder = json.JSONDecoder()
+    buf = ''
+    started = False
+    finished = False
+    pieces = iter(pieces)
+    while not finished:
+        piece = next(pieces, None)
+        final = piece is None
+        if not final:
+            buf += piece
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in _whitespace:
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f"Expected a JSON array, found {buf[pos:pos + 20]!r}")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                finished = True
+                break
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                #The element continues in the next piece
+                break
+            if not final and (end == len(buf) or buf[end] in _numberContinuation):
+                #A number ending at, or just before, the end of the piece may still continue in the next one
+                #e.g. [1e then 5] decodes as 1 with e left over, so it is held back until what follows it is known
+                break
+            yield item
+            pos = end
+        buf = buf[pos:]
+        if final and not finished:
+            raise ValueError("JSON array was not terminated")
+
+def openChunk(url):
+    #Sends the request for a chunk, the body is left unread to be streamed by the caller
+    #Only the time to the response headers is timed, reading the body overlaps with handling its items
+    get_metrics().count('ChunkDownloads')
+    with get_metrics().timer('ChunkOpen'):
+        r = getSession().get(url, stream=True)
+    r.raise_for_status()
+    #chunks are JSON, which is always utf-8 if the server does not say otherwise
+    r.encoding = r.encoding or 'utf-8'
+    return r
+
+def iterResponseItems(r):
+    try:
+        yield from iterJsonArray(r.iter_content(chunk_size=streamReadSize, decode_unicode=True))
+    finally:
+        r.close()
+
+def iterChunkItems(baseUrl, chunkFileNames, workers=None):
+    #Yields the items of every chunk one at a time, in the same order as chunkFileNames
+    #Up to workers chunk requests are opened ahead of the chunk being read, so downloads still overlap
+    #while only the response being streamed and the item being handled are held in memory
+    workers = defaultWorkers if workers is None else workers
+    urls = iter([f"{baseUrl}{j}" for j in chunkFileNames])
+    if workers <= 1:
+        for url in urls:
+            yield from iterResponseItems(openChunk(url))
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for url in urls:
+                pending.append(executor.submit(openChunk, url))
+                if len(pending) == workers:
+                    break
+            while pending:
+                r = pending.popleft().result()
+                url = next(urls, None)
+                if url is not None:
+                    pending.append(executor.submit(openChunk, url))
+                yield from iterResponseItems(r)
+        finally:
+            #Release the connections of any chunks opened but not read, if the caller stopped early
+            for future in pending:
+                if not future.cancel() and future.exception() is None:
+                    future.result().close()
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from irstats_common.metrics import get_metrics
+
+### Buffers messages for an SQS queue and sends them in SendMessageBatch calls
+### rather than one SendMessage call per message
+
+#Limits of a single SendMessageBatch call
+maxBatchEntries = 10
+maxBatchBytes = 256 * 1024
+
+#Attempts made to send the entries of a batch which SQS reports as failed
+maxAttempts = 4
+
+#Number of batches which may be in flight at once, 1 sends them one after another
+defaultParallelism = int(os.environ.get('sqs_publish_parallelism', '1'))
+
+#Batches which may be waiting to be sent, per batch in flight, before send() waits for the oldest
+#Keeps memory bounded when messages are produced faster than SQS takes them
+maxQueuedPerWorker = 2
+
+class QueuePublisher:
+    #Messages are buffered until a batch is full, by entry count or by size, then sent
+    #Entries which fail are retried on their own, everything left is sent by flush()
+    #Use as a context manager to flush on exit
+
+    def __init__(self, queue, parallelism=None):
+        #queue is a boto3 SQS Queue resource, batches are sent through its thread safe client
+        self.client = queue.meta.client
+        self.queueUrl = queue.url
+        self.parallelism = defaultParallelism if parallelism is None else parallelism
+        self.messages = 0
+        self.calls = 0
+        self.retries = 0
+        self._buffer = []
+        self._bufferBytes = 0
+        self._nextId = 0
+        self._failedTags = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.parallelism) if self.parallelism > 1 else None
+        self._futures = []
+
+    def send(self, body, delaySeconds=0, tag=None):
+        #tag identifies the message to the caller in the list returned by flush() if it cannot be sent
+        size = len(body.encode('utf-8'))
+        if size > maxBatchBytes:
+            raise ValueError(f"Message of {size} bytes is larger than the SQS limit of {maxBatchBytes}")
+        if len(self._buffer) == maxBatchEntries or self._bufferBytes + size > maxBatchBytes:
+            self._dispatch()
+        entry = {'Id': str(self._nextId), 'MessageBody': body}
+        if delaySeconds:
+            entry['DelaySeconds'] = delaySeconds
+        self._nextId += 1
+        self._buffer.append((entry, tag))
+        self._bufferBytes += size
+        self.messages += 1
+
+    def flush(self):
+        #Sends everything buffered and waits for any batches in flight
+        #Returns the tags of the messages which could not be sent
+        if self._buffer:
+            self._dispatch()
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        with self._lock:
+            failedTags, self._failedTags = self._failedTags, []
+        return failedTags
+
+    def metrics(self):
+        return {
+            'messages': self.messages,
+            'calls': self.calls,
+            'retries': self.retries,
+            'callsPerMessage': self.calls / self.messages if self.messages else 0,
+        }
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            failedTags = self.flush()
+            if failedTags and exc[0] is None:
+                raise RuntimeError(f"{len(failedTags)} messages could not be sent to {self.queueUrl}")
+        finally:
+            self.close()
+
+    def _dispatch(self):
+        batch = self._buffer
+        self._buffer = []
+        self._bufferBytes = 0
+        if self._executor:
+            if len(self._futures) >= self.parallelism * maxQueuedPerWorker:
+                self._futures.pop(0).result()
+            self._futures.append(self._executor.submit(self._sendBatch, batch))
+        else:
+            self._sendBatch(batch)
+
+    def _sendBatch(self, batch):
+        pending = batch
+        for attempt in range(maxAttempts):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            with self._lock:
+                self.calls += 1
+                self.retries += bool(attempt)
+            metrics = get_metrics()
+            metrics.count('QueueCalls')
+            metrics.count('QueueMessages', len(pending))
+            metrics.count('QueueRetries', bool(attempt))
+            try:
+                with metrics.timer('QueueSendBatch'):
+                    response = self.client.send_message_batch(
+                        QueueUrl=self.queueUrl,
+                        Entries=[entry for entry, _ in pending]
+                    )
+            except Exception as e:
+                #The whole call failed, retry every entry
+                print (f"SendMessageBatch failed {type(e)}: {str(e)}")
+                continue
+            failed = {f['Id']: f for f in response.get('Failed', [])}
+            retry = []
+            for entry, tag in pending:
+                if entry['Id'] not in failed:
+                    continue
+                if failed[entry['Id']].get('SenderFault'):
+                    #The message itself was rejected, sending it again will not help
+                    print (f"SQS rejected message {failed[entry['Id']]}")
+                    with self._lock:
+                        self._failedTags.append(tag)
+                else:
+                    retry.append((entry, tag))
+            pending = retry
+            if not pending:
+                return
+        with self._lock:
+            self._failedTags.extend(tag for _, tag in pending)
@@ -0,0 +1,141 @@
+import os
+import random
+import threading
+import time
+import requests
+from irstats_common.metrics import get_metrics
+
+### Client side rate limiting for the iRacing data API
+### iRacing reports the request budget of the current window in the x-ratelimit-* response headers
+### Requests are paced so the remaining budget is spread across the window instead of being spent in a burst
+### A request may be given a share of the budget, it then waits once the rest is all that remains
+
+#Requests which may be sent back to back before pacing applies
+burst = int(os.environ.get('rate_limit_burst', '5'))
+#Longest a request will wait for budget, beyond this RateLimited is raised so the work can be requeued
+maxWait = float(os.environ.get('rate_limit_max_wait', '20'))
+#Retries after a 429 before giving up
+maxRetries = int(os.environ.get('rate_limit_max_retries', '4'))
+#Backoff after a 429 is a random delay of up to baseBackoff * 2 ** attempt, capped at maxBackoff
+baseBackoff = 0.5
+maxBackoff = 8.0
+
+class RateLimited(Exception):
+    #Raised when the budget is exhausted for longer than we are prepared to wait
+    def __init__(self, retryAfter):
+        super().__init__(f"Rate limited, budget available again in {retryAfter:.0f}s")
+        self.retryAfter = retryAfter
+
+class RateLimiter:
+    #A token bucket refilled at the rate which spreads the remaining budget evenly until the window resets
+    #Shared by every thread in the container
+
+    def __init__(self, burst=burst, maxWait=maxWait, clock=time.time, sleep=time.sleep):
+        self.burst = burst
+        self.maxWait = maxWait
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.rate = None
+        self.remaining = None
+        #Budget of the whole window, from x-ratelimit-limit or else the most remaining seen in the window
+        self.limit = None
+        self.reset = None
+        self.updated = clock()
+        self.throttledCount = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.reset is not None and now >= self.reset:
+            #The window has reset, the budget is unknown until the next response
+            self.remaining = None
+            self.limit = None
+            self.reset = None
+            self.rate = None
+            self.tokens = float(self.burst)
+        elif self.rate:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retryAfter(self):
+        with self._lock:
+            if self.reset is None:
+                return 0.0
+            return max(0.0, self.reset - self.clock())
+
+    def acquire(self, share=1.0):
+        #Blocks until a request may be sent
+        #share is the fraction of the window's budget the request may use, the rest is kept for requests with a larger share
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                reserve = (1 - share) * self.limit if self.limit else 0
+                if self.remaining is not None and self.remaining <= reserve:
+                    wait = self.reset - now
+                elif self.tokens >= 1 or not self.rate:
+                    self.tokens = max(0.0, self.tokens - 1)
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            if wait > self.maxWait:
+                raise RateLimited(wait)
+            with get_metrics().timer('RateLimitWait'):
+                self.sleep(wait)
+
+    def update(self, headers):
+        #Reads the budget reported by iRacing, x-ratelimit-reset is the epoch time the window resets
+        try:
+            remaining = int(headers['x-ratelimit-remaining'])
+            reset = float(headers['x-ratelimit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        try:
+            limit = int(headers['x-ratelimit-limit'])
+        except (KeyError, TypeError, ValueError):
+            limit = None
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.limit = limit if limit is not None else max(self.limit or 0, remaining)
+            self.remaining = remaining
+            self.reset = reset
+            self.rate = remaining / (reset - now) if reset > now else None
+
+    def throttled(self, headers):
+        #Called on a 429, nothing more is sent until the window resets
+        with self._lock:
+            self.throttledCount += 1
+            now = self.clock()
+            try:
+                reset = float(headers['x-ratelimit-reset'])
+            except (KeyError, TypeError, ValueError):
+                reset = now + float(headers.get('retry-after') or baseBackoff)
+            self.remaining = 0
+            self.reset = max(reset, now)
+            self.updated = now
+
+    def get(self, url, session=requests, share=1.0, **kwargs):
+        #Sends a GET request within the budget, retrying 429s with a jittered exponential backoff
+        #Raises RateLimited if the budget does not come back soon enough to retry
+        for attempt in range(maxRetries + 1):
+            self.acquire(share)
+            metrics = get_metrics()
+            metrics.count('ApiCalls')
+            metrics.count('ApiRetries', bool(attempt))
+            with metrics.timer('ApiRequest'):
+                r = session.get(url, **kwargs)
+            if r.status_code != 429:
+                self.update(r.headers)
+                return r
+            metrics.count('Api429s')
+            self.throttled(r.headers)
+            if attempt < maxRetries:
+                with metrics.timer('RateLimitBackoff'):
+                    self.sleep(random.uniform(0, min(maxBackoff, baseBackoff * 2 ** attempt)))
+        raise RateLimited(self.retryAfter())
+
+#The limiter shared by every request to the iRacing API from this container
+limiter = RateLimiter()
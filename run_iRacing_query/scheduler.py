@@ -0,0 +1,90 @@
+import contextlib
+import os
+import threading
+from irstats_common import priority
+from queuePublisher import QueuePublisher
+
+### Routes work for the iRacing API to the queue of its priority tier
+### Recent sessions are fresh and go to the API query queue, older ones are backlog and go to a queue of their own
+### Each queue has its own event source, so each tier has its own concurrency, see template.yaml
+### Requests made while handling backlog only use their share of the rate limit, keeping the rest for fresh work
+
+#Fraction of each rate limit window's budget which backlog requests may use
+backlogRateShare = float(os.environ.get('backlog_rate_share', '0.5'))
+
+class Scheduler:
+    #queues maps each tier to a function returning its boto3 SQS Queue, the fresh queue is used for any tier without one
+
+    def __init__(self, queues, rateShares=None, maxAge=None):
+        self.queues = queues
+        self.rateShares = rateShares if rateShares is not None else {priority.FRESH: 1.0, priority.BACKLOG: backlogRateShare}
+        self.maxAge = maxAge
+        self._local = threading.local()
+
+    def tierOf(self, message, now=None):
+        #message is a SessionSearch or ResultsFetch
+        #The tier is worked out from the age of the message, so it is the same whichever queue delivered it
+        return priority.tier_for(message.end_time, now, self.maxAge)
+
+    def queue(self, tier):
+        return (self.queues.get(tier) or self.queues[priority.FRESH])()
+
+    @contextlib.contextmanager
+    def running(self, tier):
+        #Requests made by this thread within the block are made on behalf of tier
+        previous = getattr(self._local, 'tier', None)
+        self._local.tier = tier
+        try:
+            yield
+        finally:
+            self._local.tier = previous
+
+    def currentTier(self):
+        return getattr(self._local, 'tier', None) or priority.FRESH
+
+    def rateShare(self):
+        #Share of the rate limit available to the work this thread is running
+        return self.rateShares.get(self.currentTier(), 1.0)
+
+    def publisher(self, parallelism=None):
+        return TieredPublisher(self, parallelism)
+
+class TieredPublisher:
+    #A QueuePublisher for each tier, created when a message is first sent to the tier
+    #Use as a context manager to flush on exit
+
+    def __init__(self, scheduler, parallelism=None):
+        self.scheduler = scheduler
+        self.parallelism = parallelism
+        self.publishers = {}
+
+    def send(self, body, tier, delaySeconds=0, tag=None):
+        publisher = self.publishers.get(tier)
+        if publisher is None:
+            publisher = self.publishers[tier] = QueuePublisher(self.scheduler.queue(tier), self.parallelism)
+        publisher.send(body, delaySeconds, tag)
+
+    def flush(self):
+        #Returns the tags of the messages which could not be sent, whatever their tier
+        failedTags = []
+        for publisher in self.publishers.values():
+            failedTags.extend(publisher.flush())
+        return failedTags
+
+    def metrics(self):
+        return {tier: publisher.metrics() for tier, publisher in self.publishers.items()}
+
+    def close(self):
+        for publisher in self.publishers.values():
+            publisher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            failedTags = self.flush()
+            if failedTags and exc[0] is None:
+                raise RuntimeError(f"{len(failedTags)} messages could not be queued")
+        finally:
+            self.close()
@@ -0,0 +1,131 @@
+import os
+import time
+from collections import OrderedDict
+from irstats_common.metrics import get_metrics
+
+### Records which subsessions have already been queued or processed
+### The search for new sessions looks back 1.5 days on every run, so almost every subsession it finds has been seen before
+### Checking the index before queueing or fetching stops the same subsession being fetched and processed again
+### Claims record when they were made, a subsession queued longer ago than claimTimeoutSeconds may be claimed again
+
+#How long a subsession is remembered for, this must be longer than the search looks back
+ttlSeconds = int(float(os.environ.get('processed_ttl_days', '3')) * 86400)
+
+#How long a subsession stays claimed as queued before a search may queue it again
+#A claim is made before its fetch is sent, so if the sender dies in between the claim has to lapse for the subsession to be fetched
+#A fetch still waiting in its queue is only sent twice, the second is skipped once the first has marked the subsession done
+claimTimeoutSeconds = int(float(os.environ.get('processed_claim_timeout_hours', '6')) * 3600)
+
+#Number of subsession IDs remembered in memory, kept warm across invocations of the same container
+maxLocalEntries = int(os.environ.get('processed_cache_size', '100000'))
+
+QUEUED = 'queued'
+DONE = 'done'
+
+class SubsessionIndex:
+    #Backed by a DynamoDB table keyed on SubsessionId with a TTL on ExpiresAt, fronted by an in memory LRU
+    #With no table every subsession is treated as new
+    #Lookups are counted as the IndexLocalHits, IndexTableHits and IndexMisses metrics
+
+    def __init__(self, table, ttlSeconds=ttlSeconds, maxLocalEntries=maxLocalEntries, clock=time.time,
+                 claimTimeoutSeconds=claimTimeoutSeconds):
+        self.table = table
+        self.ttlSeconds = ttlSeconds
+        self.claimTimeoutSeconds = claimTimeoutSeconds
+        self.maxLocalEntries = maxLocalEntries
+        self.clock = clock
+        #subsession ID -> (status, when it was claimed)
+        self.local = OrderedDict()
+        self.localHits = 0
+        self.tableHits = 0
+        self.misses = 0
+
+    def _count(self, outcome):
+        #outcome is localHits, tableHits or misses
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        get_metrics().count('Index' + outcome[0].upper() + outcome[1:])
+
+    def _remember(self, subsessionId, status, claimedAt=None):
+        self.local[subsessionId] = (status, claimedAt)
+        self.local.move_to_end(subsessionId)
+        while len(self.local) > self.maxLocalEntries:
+            self.local.popitem(last=False)
+
+    def _put(self, subsessionId, status, now, **kwargs):
+        item = {
+            'SubsessionId': subsessionId,
+            'Status': status,
+            'ExpiresAt': int(now + self.ttlSeconds),
+        }
+        if status == QUEUED:
+            item['ClaimedAt'] = int(now)
+        self.table.put_item(Item=item, **kwargs)
+
+    def _isStale(self, status, claimedAt, now):
+        return status == QUEUED and claimedAt is not None and claimedAt <= now - self.claimTimeoutSeconds
+
+    def claim(self, subsessionId):
+        #Returns True if the subsession has not been seen before, or its claim has lapsed, and is now marked as queued
+        #Returns False if it is already queued or done
+        if self.table is None:
+            return True
+        now = self.clock()
+        if subsessionId in self.local and not self._isStale(*self.local[subsessionId], now):
+            self._count('localHits')
+            self.local.move_to_end(subsessionId)
+            return False
+        try:
+            #Claims made before ClaimedAt was recorded are treated as lapsed
+            self._put(
+                subsessionId, QUEUED, now,
+                ConditionExpression='attribute_not_exists(SubsessionId) OR '
+                    '(#status = :queued AND (attribute_not_exists(ClaimedAt) OR ClaimedAt <= :lapsed))',
+                ExpressionAttributeNames={'#status': 'Status'},
+                ExpressionAttributeValues={':queued': QUEUED, ':lapsed': int(now - self.claimTimeoutSeconds)},
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            #The claim found is not known to lapse any earlier than one made now
+            self._count('tableHits')
+            self._remember(subsessionId, QUEUED, now)
+            return False
+        self._count('misses')
+        self._remember(subsessionId, QUEUED, now)
+        return True
+
+    def release(self, subsessionId):
+        #Forget a claimed subsession which could not be queued, so the next search picks it up again
+        if self.table is None:
+            return
+        self.local.pop(subsessionId, None)
+        self.table.delete_item(Key={'SubsessionId': subsessionId})
+
+    def isDone(self, subsessionId):
+        #Returns True if the results of the subsession have already been fetched and queued for processing
+        if self.table is None or subsessionId is None:
+            return False
+        if self.local.get(subsessionId, (None,))[0] == DONE:
+            self._count('localHits')
+            return True
+        item = self.table.get_item(Key={'SubsessionId': subsessionId}).get('Item')
+        if item and item['Status'] == DONE:
+            self._count('tableHits')
+            self._remember(subsessionId, DONE)
+            return True
+        self._count('misses')
+        return False
+
+    def markDone(self, subsessionId):
+        if self.table is None or subsessionId is None:
+            return
+        self._put(subsessionId, DONE, self.clock())
+        self._remember(subsessionId, DONE)
+
+    def metrics(self):
+        hits = self.localHits + self.tableHits
+        lookups = hits + self.misses
+        return {
+            'localHits': self.localHits,
+            'tableHits': self.tableHits,
+            'misses': self.misses,
+            'hitRate': hits / lookups if lookups else 0,
+        }
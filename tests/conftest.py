@@ -0,0 +1,92 @@
+"""Shared pytest configuration
+
+Each Lambda function is deployed from its own directory, where its modules are imported
+as top level modules, with the shared common layer alongside them. The same layout is
+reproduced here by putting those directories on the path, along with the environment
+each function expects at import time.
+
+The sample results and the local stand-ins for AWS used across the unit tests are defined
+here as fixtures.
+"""
+
+import copy
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for function_dir in ('common', 'process_iRacing_data', 'run_iRacing_query', 'generate_session_list_query'):
+    path = os.path.join(ROOT, function_dir)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+os.environ.setdefault('table_name', 'irstats_iRacing_Data')
+
+from irstats_common import aws  # pylint: disable=wrong-import-position
+
+EVENTS_DIR = os.path.join(ROOT, 'events')
+
+
+@pytest.fixture()
+def results():
+    """ The raw subsession results from the sample event"""
+    with open(os.path.join(EVENTS_DIR, 'iRDataTest.JSON'), encoding='utf-8') as f:
+        return json.load(f)['Records'][0]['body']
+
+
+@pytest.fixture()
+def multiclass_results(results):
+    """ The sample results split across three car classes"""
+    data = copy.deepcopy(results)
+    for session in data['session_results']:
+        for n, driver in enumerate(session['results']):
+            driver['car_class_name'] = f"Class {n % 3}"
+    return data
+
+
+@pytest.fixture()
+def mock_aws():
+    """ Local stand-ins for every AWS service, the shared clients in irstats_common.aws are created against them"""
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        aws.reset()
+        yield
+        aws.reset()
+
+
+@pytest.fixture()
+def count_calls():
+    """ Returns a function which makes a boto3 client or resource record the name of each request it makes in .calls"""
+    def count(target):
+        client = getattr(target.meta, 'client', target)
+        target.calls = []
+        client.meta.events.register(
+            f'before-call.{client.meta.service_model.service_name}', lambda model, **kwargs: target.calls.append(model.name)
+        )
+        return target
+    return count
+
+
+@pytest.fixture()
+def class_table(mock_aws):  # pylint: disable=redefined-outer-name,unused-argument
+    """ Returns a function creating a local table keyed on CarClass and TrackName, as irstats_iRacing_Data is"""
+    def create(name='irstats_iRacing_Data'):
+        return aws.get_resource('dynamodb').create_table(
+            TableName=name,
+            KeySchema=[
+                {'AttributeName': 'CarClass', 'KeyType': 'HASH'},
+                {'AttributeName': 'TrackName', 'KeyType': 'RANGE'},
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'CarClass', 'AttributeType': 'S'},
+                {'AttributeName': 'TrackName', 'AttributeType': 'S'},
+            ],
+            BillingMode='PAY_PER_REQUEST',
+        )
+    return create
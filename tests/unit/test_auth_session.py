@@ -0,0 +1,96 @@
+import json
+import threading
+
+import pytest
+
+import authSession
+from benchmarks.stub_server import StubServer
+from irstats_common import aws
+
+BUCKET = 'irstats-storage'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def s3(mock_aws, count_calls):  # pylint: disable=unused-argument
+    """ A local bucket holding the iRacing credentials, counting the requests made to it"""
+    client = aws.get_client('s3')
+    client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    client.put_object(Bucket=BUCKET, Key='credentials.json', Body=json.dumps({'email': 'a@b.c', 'password': 'x'}))
+    return count_calls(client)
+
+
+@pytest.fixture()
+def server():
+    routes = {
+        '/auth': lambda handler: (200, {'Set-Cookie': 'authtoken_members=local; Path=/'}, '{}'),
+        '/data': lambda handler: (200, {}, handler.headers.get('Cookie', '')),
+    }
+    with StubServer(routes) as stub:
+        yield stub
+
+
+def test_session_is_reused_and_refreshed_before_expiry(s3, server):
+    clock = FakeClock()
+    auth = authSession.AuthSession(server.url, BUCKET, 'iRCookieJar.json', maxAge=600, refreshMargin=60, clock=clock)
+
+    session, generation = auth.getSession()
+    assert session.get(f"{server.url}/data").text == 'authtoken_members=local'
+    assert auth.getSession() == (session, generation)
+    assert auth.authentications == 1
+    #no separate existence checks, a missing cookie file is just a failed get
+    assert s3.calls == ['GetObject', 'GetObject', 'PutObject']
+
+    clock.now += 541
+    assert auth.getSession()[1] == generation + 1
+    assert auth.authentications == 2
+
+
+def test_stored_cookies_are_used_by_a_new_container(s3, server):
+    clock = FakeClock()
+    authSession.AuthSession(server.url, BUCKET, 'iRCookieJar.json', clock=clock).getSession()
+    stored = json.loads(s3.get_object(Bucket=BUCKET, Key='iRCookieJar.json')['Body'].read())
+    assert stored['cookies'][0]['name'] == 'authtoken_members'
+
+    auth = authSession.AuthSession(server.url, BUCKET, 'iRCookieJar.json', clock=clock)
+    session, _ = auth.getSession()
+    assert auth.authentications == 0
+    assert session.get(f"{server.url}/data").text == 'authtoken_members=local'
+
+
+def test_unreadable_cookie_file_logs_in_again(s3, server):
+    s3.put_object(Bucket=BUCKET, Key='iRCookieJar.json', Body=b'\x80\x04pickled')
+    auth = authSession.AuthSession(server.url, BUCKET, 'iRCookieJar.json')
+
+    auth.getSession()
+
+    assert auth.authentications == 1
+
+
+def test_concurrent_refreshes_log_in_once(s3, server):
+    auth = authSession.AuthSession(server.url, BUCKET, 'iRCookieJar.json')
+    _, generation = auth.getSession()
+    requests_before = server.requests
+
+    threads = [threading.Thread(target=auth.refresh, args=(generation,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert auth.authentications == 2
+    assert server.requests == requests_before + 1
+
+
+def test_failed_login_raises(s3):
+    with StubServer({'/auth': lambda handler: (401, {}, 'bad credentials')}) as stub:
+        auth = authSession.AuthSession(stub.url, BUCKET, 'iRCookieJar.json')
+        with pytest.raises(authSession.AuthenticationError):
+            auth.getSession()
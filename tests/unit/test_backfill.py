@@ -0,0 +1,136 @@
+import importlib
+from datetime import timedelta
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from irstats_common import aws, backfill
+from irstats_common.messages import decode
+
+
+@pytest.fixture()
+def table(mock_aws):  # pylint: disable=unused-argument
+    """ A local irStats_Generate_Session_List_Parameters table"""
+    return aws.get_resource('dynamodb').create_table(
+        TableName='irStats_Generate_Session_List_Parameters',
+        KeySchema=[{'AttributeName': 'Parameter', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'Parameter', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+
+
+def get_watermark(table):
+    return table.get_item(Key={'Parameter': 'finish_range_begin'}).get('Item', {}).get('Value')
+
+
+def test_windows_cover_the_range_without_overlapping():
+    windows = backfill.plan_windows(
+        backfill.parse_time('2022-08-01T00:00Z'), backfill.parse_time('2022-08-03T12:00Z'), timedelta(days=1)
+    )
+
+    assert windows == [
+        ('2022-08-01T00:00Z', '2022-08-02T00:00Z'),
+        ('2022-08-02T00:00Z', '2022-08-03T00:00Z'),
+        ('2022-08-03T00:00Z', '2022-08-03T12:00Z'),
+    ]
+
+
+def test_windows_are_no_longer_than_the_api_allows():
+    windows = backfill.plan_windows(
+        backfill.parse_time('2022-01-01T00:00Z'), backfill.parse_time('2022-12-01T00:00Z'), timedelta(days=365)
+    )
+
+    assert len(windows) == 4
+    assert all(backfill.parse_time(end) - backfill.parse_time(begin) <= backfill.MAX_WINDOW for begin, end in windows)
+
+
+def test_watermark_only_advances_over_a_completed_prefix(table):
+    windows = [('2022-08-01T00:00Z', '2022-08-02T00:00Z'), ('2022-08-02T00:00Z', '2022-08-03T00:00Z'),
+               ('2022-08-03T00:00Z', '2022-08-04T00:00Z')]
+    backfill.record_windows(table, windows, 1000)
+
+    #later windows finishing first leave the watermark alone
+    assert backfill.complete_window(table, '2022-08-03T00:00Z', '2022-08-03T23:10Z') is None
+    assert backfill.complete_window(table, '2022-08-02T00:00Z') is None
+    assert get_watermark(table) is None
+
+    assert backfill.complete_window(table, '2022-08-01T00:00Z', '2022-08-01T22:00Z') == '2022-08-03T23:10Z'
+    assert get_watermark(table) == '2022-08-03T23:10Z'
+    assert backfill.load_plan(table) == ('2022-08-04T00:00Z', {})
+
+    #a window delivered twice does not move the watermark back
+    assert backfill.complete_window(table, '2022-08-01T00:00Z', '2022-08-01T22:00Z') is None
+    assert get_watermark(table) == '2022-08-03T23:10Z'
+
+
+def test_stale_windows_are_queued_again(table):
+    backfill.record_windows(table, [('2022-08-01T00:00Z', '2022-08-02T00:00Z'),
+                                    ('2022-08-02T00:00Z', '2022-08-03T00:00Z')], 1000)
+    backfill.complete_window(table, '2022-08-02T00:00Z')
+    _, windows = backfill.load_plan(table)
+
+    assert backfill.stale_windows(windows, 1000 + 1799, 1800, 1800) == []
+    assert backfill.stale_windows(windows, 1000 + 1800, 1800, 1800) == [('2022-08-01T00:00Z', '2022-08-02T00:00Z')]
+
+
+def test_windows_waiting_to_start_are_timed_out_from_when_they_start(table):
+    backfill.record_windows(table, [('2022-08-01T00:00Z', '2022-08-02T00:00Z')], 1000)
+    #waiting on the backlog queue for longer than a search may run for
+    assert backfill.stale_windows(backfill.load_plan(table)[1], 1000 + 7200, 1800, 86400) == []
+
+    backfill.start_window(table, '2022-08-01T00:00Z', 1000 + 7200)
+    _, windows = backfill.load_plan(table)
+    assert backfill.stale_windows(windows, 1000 + 7200 + 1799, 1800, 86400) == []
+    assert backfill.stale_windows(windows, 1000 + 7200 + 1800, 1800, 86400) == [('2022-08-01T00:00Z', '2022-08-02T00:00Z')]
+
+    #queued again, the window waits for its new search to start
+    backfill.mark_queued(table, [('2022-08-01T00:00Z', '2022-08-02T00:00Z')], 1000 + 9000)
+    assert backfill.stale_windows(backfill.load_plan(table)[1], 1000 + 9000 + 1800, 1800, 86400) == []
+
+
+def test_searches_cover_no_more_than_the_api_allows(table, monkeypatch):
+    generate, _ = load_generate(table, monkeypatch)
+    windows = backfill.plan_windows(
+        backfill.parse_time('2022-01-01T00:00Z'), backfill.parse_time('2022-12-01T00:00Z'), timedelta(days=365)
+    )
+
+    start_ranges = []
+    for begin, end in windows:
+        query = parse_qs(urlparse(generate.get_window_url(begin, end)).query)
+        assert query['finish_range_begin'] == [begin] and query['finish_range_end'] == [end]
+        start_ranges.append(backfill.parse_time(query['start_range_end'][0]) - backfill.parse_time(query['start_range_begin'][0]))
+    #the start range of a full window reaches back the whole 90 days, and no further
+    assert max(start_ranges) == timedelta(days=90)
+
+
+def load_generate(table, monkeypatch):
+    """ The GenerateSessionListQuery module configured to use the local table, and the local queue it sends to"""
+    queue = aws.get_resource('sqs').create_queue(QueueName='irStats_iRacingApiQueryQueue')
+    monkeypatch.setenv('queue_name', 'irStats_iRacingApiQueryQueue')
+    monkeypatch.setenv('queue_url', queue.url)
+    monkeypatch.setenv('table_name', table.name)
+    monkeypatch.setenv('default_time', '2022-08-01T00:00Z')
+    for key, value in (('official_only', 'true'), ('event_types', '5'), ('category_ids', '2')):
+        monkeypatch.setenv(key, value)
+    monkeypatch.setenv('backfill_window_hours', '24')
+    monkeypatch.setenv('backfill_max_windows', '12')
+    import GenerateSessionListQuery  # pylint: disable=import-outside-toplevel
+    generate = importlib.reload(GenerateSessionListQuery)
+    return generate, queue
+
+
+def test_handler_plans_each_range_once(table, monkeypatch):
+    generate, queue = load_generate(table, monkeypatch)
+
+    generate.lambda_handler({}, None)
+    generate.lambda_handler({}, None)
+
+    messages = []
+    while True:
+        received = queue.receive_messages(MaxNumberOfMessages=10)
+        if not received:
+            break
+        messages.extend(decode(m.body) for m in received)
+    assert [m.window for m in messages] == [f"2022-08-{day:02d}T00:00Z" for day in range(1, 25)]
+    assert 'finish_range_begin=2022-08-01T00:00Z&finish_range_end=2022-08-02T00:00Z' in messages[0].url
+    assert backfill.load_plan(table)[0] == '2022-08-25T00:00Z'
@@ -0,0 +1,67 @@
+from decimal import Decimal
+
+from best_lap_cache import BestLapCache
+from irstats_common import metrics as metrics_module
+
+KEY = ('GT3', 'Spa')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_only_faster_laps_might_improve():
+    cache = BestLapCache(ttl=60)
+    assert cache.might_improve(KEY, 'fastest_lap', 137.5)
+
+    cache.store(KEY, {'fastest_lap': 137.5, 'pole_time': None})
+
+    #floats compare exactly with the decimal stored in DynamoDB
+    assert cache.get(KEY) == {'fastest_lap': Decimal('137.5'), 'pole_time': None}
+    assert not cache.might_improve(KEY, 'fastest_lap', 137.5)
+    assert not cache.might_improve(KEY, 'fastest_lap', 140.1)
+    assert cache.might_improve(KEY, 'fastest_lap', 137.4999)
+    #a record without a lap is beaten by any lap, but a missing lap improves nothing
+    assert cache.might_improve(KEY, 'pole_time', 200.0)
+    assert not cache.might_improve(KEY, 'pole_time', None)
+
+
+def test_lookups_are_counted(monkeypatch):
+    metrics = metrics_module.Metrics()
+    monkeypatch.setattr(metrics_module, '_metrics', metrics)
+    cache = BestLapCache(ttl=60)
+    cache.might_improve(KEY, 'fastest_lap', 137.5)
+    cache.store(KEY, {'fastest_lap': 137.5})
+    cache.might_improve(KEY, 'fastest_lap', 138.0)
+    cache.might_improve(KEY, 'fastest_lap', 136.0)
+
+    assert metrics.snapshot() == {'BestLapCacheMisses': 1, 'BestLapCacheHits': 1, 'BestLapCacheBeaten': 1}
+
+
+def test_entries_expire_and_the_oldest_are_evicted():
+    clock = FakeClock()
+    cache = BestLapCache(ttl=60, max_entries=2, clock=clock)
+    cache.store(KEY, {'fastest_lap': 137.5})
+    clock.now += 30
+    cache.store(('GT4', 'Spa'), {'fastest_lap': 150.0})
+    cache.store(('GT4', 'Monza'), {'fastest_lap': 120.0})
+
+    assert cache.get(KEY) is None
+    assert len(cache) == 2
+    clock.now += 60
+    assert cache.get(('GT4', 'Spa')) is None
+
+
+def test_stored_laps_are_merged_and_a_zero_ttl_disables_the_cache():
+    cache = BestLapCache(ttl=60)
+    cache.store(KEY, {'fastest_lap': 137.5})
+    cache.store(KEY, {'pole_time': 135.0})
+    assert cache.get(KEY) == {'fastest_lap': Decimal('137.5'), 'pole_time': Decimal('135.0')}
+
+    disabled = BestLapCache(ttl=0)
+    disabled.store(KEY, {'fastest_lap': 137.5})
+    assert disabled.get(KEY) is None
@@ -0,0 +1,68 @@
+import json
+import time
+
+import pytest
+
+import chunkDownloader
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.encoding = None
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size, decode_unicode):
+        for start in range(0, len(self.text), 7):
+            yield self.text[start:start + 7]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """ Answers later chunks first, so results complete out of order"""
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        n = int(url.rsplit('_', 1)[1])
+        time.sleep((10 - n) * 0.002)
+        return FakeResponse(json.dumps([{'subsession_id': n}]))
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_iter_chunk_items_streams_in_chunk_order(monkeypatch, workers):
+    session = FakeSession()
+    monkeypatch.setattr(chunkDownloader, 'getSession', lambda: session)
+
+    items = chunkDownloader.iterChunkItems('https://example.com/chunk_', [str(n) for n in range(10)], workers=workers)
+
+    assert next(items) == {'subsession_id': 0}
+    assert list(items) == [{'subsession_id': n} for n in range(1, 10)]
+
+
+def test_iter_json_array_across_every_split():
+    data = [{'a': '[1, 2]', 'b': [1.5, -2e3, None]}, 12345, "x,]y", True, [], {}, 1e+25, -2.5e-07, 0]
+    text = ' [ ' + ', '.join(json.dumps(d) for d in data) + ' ] '
+    for split in range(1, len(text)):
+        assert list(chunkDownloader.iterJsonArray([text[:split], text[split:]])) == data
+    assert list(chunkDownloader.iterJsonArray(iter(text))) == data
+
+
+def test_iter_json_array_numbers_split_within_them():
+    assert list(chunkDownloader.iterJsonArray(['[1e', '5]'])) == [1e5]
+    assert list(chunkDownloader.iterJsonArray(['[1', '.5,2E', '+', '3]'])) == [1.5, 2e3]
+    assert list(chunkDownloader.iterJsonArray(['[-', '7', ']'])) == [-7]
+
+
+def test_iter_json_array_empty_and_invalid():
+    assert not list(chunkDownloader.iterJsonArray(['[', ' ]']))
+    with pytest.raises(ValueError):
+        list(chunkDownloader.iterJsonArray(['[1, 2']))
+    with pytest.raises(ValueError):
+        list(chunkDownloader.iterJsonArray(['{"a": 1}']))
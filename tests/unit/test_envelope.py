@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from irstats_common import aws, envelope, messages
+
+
+@pytest.fixture()
+def s3(mock_aws):  # pylint: disable=unused-argument
+    """ A local S3 bucket"""
+    client = aws.get_client('s3')
+    client.create_bucket(Bucket='irstats-storage', CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    return client
+
+
+def test_small_payloads_stay_inline(results, s3):
+    body = envelope.encode_payload(messages.Results.from_results(results), s3, 'irstats-storage')
+
+    assert messages.decode(body) == messages.Results.from_results(results)
+    assert 'Contents' not in s3.list_objects_v2(Bucket='irstats-storage')
+    assert envelope.decode_payload(body, s3) == messages.Results.from_results(results).to_dict()
+
+
+def test_large_payloads_are_offloaded_to_s3(results, s3):
+    body = envelope.encode_payload(results, s3, 'irstats-storage', inline_limit=1024)
+
+    assert len(body) < 1024
+    assert messages.decode(body) == messages.ResultsPointer('irstats-storage', 'payloads/50374456.json.gz', 'gzip')
+    assert envelope.decode_payload(body, s3) == messages.Results.from_results(results).to_dict()
+
+
+def test_version_1_envelopes_are_still_read(results, s3):
+    projected = messages.Results.from_results(results).to_dict()
+
+    assert envelope.decode_payload(json.dumps({'envelope': 1, 'inline': projected}), s3) == projected
+
+
+def test_messages_without_an_envelope_are_raw_results(results, s3):
+    assert envelope.decode_payload(json.dumps(results), s3) == results
+    assert envelope.decode_payload(results, s3) == results
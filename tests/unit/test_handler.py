@@ -1,73 +1,43 @@
 import json
+import os
+import subprocess
+import sys
 
 import pytest
 
-from hello_world import app
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
-@pytest.fixture()
-def apigw_event():
-    """ Generates API GW Event"""
+@pytest.fixture(scope='module')
+def pipeline_report(tmp_path_factory):
+    """ Runs all three handlers end to end against local stand-ins
 
-    return {
-        "body": '{ "test": "body"}',
-        "resource": "/{proxy+}",
-        "requestContext": {
-            "resourceId": "123456",
-            "apiId": "1234567890",
-            "resourcePath": "/{proxy+}",
-            "httpMethod": "POST",
-            "requestId": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
-            "accountId": "123456789012",
-            "identity": {
-                "apiKey": "",
-                "userArn": "",
-                "cognitoAuthenticationType": "",
-                "caller": "",
-                "userAgent": "Custom User Agent String",
-                "user": "",
-                "cognitoIdentityPoolId": "",
-                "cognitoIdentityId": "",
-                "cognitoAuthenticationProvider": "",
-                "sourceIp": "127.0.0.1",
-                "accountId": "",
-            },
-            "stage": "prod",
-        },
-        "queryStringParameters": {"foo": "bar"},
-        "headers": {
-            "Via": "1.1 08f323deadbeefa7af34d5feb414ce27.cloudfront.net (CloudFront)",
-            "Accept-Language": "en-US,en;q=0.8",
-            "CloudFront-Is-Desktop-Viewer": "true",
-            "CloudFront-Is-SmartTV-Viewer": "false",
-            "CloudFront-Is-Mobile-Viewer": "false",
-            "X-Forwarded-For": "127.0.0.1, 127.0.0.2",
-            "CloudFront-Viewer-Country": "US",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Upgrade-Insecure-Requests": "1",
-            "X-Forwarded-Port": "443",
-            "Host": "1234567890.execute-api.us-east-1.amazonaws.com",
-            "X-Forwarded-Proto": "https",
-            "X-Amz-Cf-Id": "aaaaaaaaaae3VYQb9jd-nvCd-de396Uhbp027Y2JvkCPNLmGJHqlaA==",
-            "CloudFront-Is-Tablet-Viewer": "false",
-            "Cache-Control": "max-age=0",
-            "User-Agent": "Custom User Agent String",
-            "CloudFront-Forwarded-Proto": "https",
-            "Accept-Encoding": "gzip, deflate, sdch",
-        },
-        "pathParameters": {"proxy": "/examplepath"},
-        "httpMethod": "POST",
-        "stageVariables": {"baz": "qux"},
-        "path": "/examplepath",
-    }
+    The pipeline runner imports the handler modules with the environment of each function,
+    so it is run in its own process"""
+    pytest.importorskip('moto')
+    output = tmp_path_factory.mktemp('pipeline') / 'report.json'
+    subprocess.run(
+        [sys.executable, '-m', 'benchmarks.pipeline_runner', '--subsessions', '30', '--chunk-size', '8',
+         '--classes', '3', '--process-batch-size', '20', '--output', str(output)],
+        cwd=ROOT, check=True, stdout=subprocess.DEVNULL, timeout=300,
+    )
+    return json.loads(output.read_text())
 
 
-def test_lambda_handler(apigw_event, mocker):
+def test_lambda_handlers_process_every_subsession(pipeline_report):
+    assert pipeline_report['failures'] == {'query': 0, 'backlog': 0, 'process': 0}
+    assert pipeline_report['latency']['generate']['invocations'] == 1
+    #subsessions finish 20 minutes apart, those over 6 hours old are fetched from the backlog queue
+    assert pipeline_report['latency']['backlog']['invocations'] == 2
+    #3 classes at each of the 4 tracks the fake iRacing API spreads subsessions over
+    assert pipeline_report['records'] == 12
 
-    ret = app.lambda_handler(apigw_event, "")
-    data = json.loads(ret["body"])
 
-    assert ret["statusCode"] == 200
-    assert "message" in ret["body"]
-    assert data["message"] == "hello world"
-    # assert "location" in data.dict_keys()
+def test_lambda_handlers_batch_their_aws_calls(pipeline_report):
+    calls = pipeline_report['aws_calls']
+
+    assert 'sqs.SendMessage' not in calls or calls['sqs.SendMessage'] == 1
+    #the search windows are queued in one batch, then the subsessions and results of each tier in batches of 10
+    assert calls['sqs.SendMessageBatch'] <= 1 + 2 * (-(-18 // 10) + -(-12 // 10))
+    #a single login is shared by every request the query function makes
+    assert pipeline_report['iracing_requests'] == 1 + 1 + 4 + 2 * 30
@@ -0,0 +1,112 @@
+import copy
+import json
+from decimal import Decimal
+
+import pytest
+
+import leaderboards
+import process_iracing_data
+from irstats_common import aws
+from irstats_common.messages import Results
+
+TRACK = 'Summit Point Raceway - Jefferson Circuit'
+
+
+@pytest.fixture()
+def tables(class_table, monkeypatch):
+    """ Local stand-ins for the irstats_iRacing_Data and irStats_Leaderboards tables"""
+    monkeypatch.setattr(process_iracing_data, 'LEADERBOARD_TABLE_NAME', 'irStats_Leaderboards')
+    return {name: class_table(name) for name in ('irstats_iRacing_Data', 'irStats_Leaderboards')}
+
+
+def sqs_event(*bodies):
+    return {'Records': [{'messageId': str(n), 'body': json.dumps(body)} for n, body in enumerate(bodies)]}
+
+
+def race_results(data):
+    return [s for s in data['session_results'] if s['simsession_name'] == 'RACE'][0]['results']
+
+
+def test_entries_hold_each_drivers_best_lap_fastest_first(results):
+    boards = leaderboards.generate_leaderboard_entries(results)['Mazda MX-5 Cup 2016']
+
+    race = [j for j in race_results(results) if j['best_lap_time'] > 0]
+    laps = sorted(Decimal(str(j['best_lap_time'] / 10000)) for j in race)
+    assert [e['t'] for e in boards['Race']] == laps[:leaderboards.LEADERBOARD_SIZE]
+    assert len({e['id'] for e in boards['Race']}) == len(boards['Race'])
+    assert boards['Race'][0]['s'] == results['subsession_id']
+
+
+def test_rows_without_a_customer_id_stay_apart_through_the_message_schema(results):
+    for session in results['session_results']:
+        for driver in session['results']:
+            del driver['cust_id']
+    expected = leaderboards.generate_leaderboard_entries(results)
+
+    #the schema sends the missing ids as null
+    decoded = Results.from_results(results).to_dict()
+    boards = leaderboards.generate_leaderboard_entries(decoded)
+
+    assert boards == expected
+    for board in boards['Mazda MX-5 Cup 2016'].values():
+        assert len(board) > 1
+        assert len({e['id'] for e in board}) == len(board)
+
+
+def test_merge_entries_keeps_top_n_one_per_driver():
+    current = [{'id': n, 't': Decimal(60 + n)} for n in range(3)]
+    new = [{'id': 2, 't': Decimal(59)}, {'id': 9, 't': Decimal(70)}]
+
+    merged = leaderboards.merge_entries(current, new, size=3)
+
+    assert [(e['id'], e['t']) for e in merged] == [(2, 59), (0, 60), (1, 61)]
+
+
+def test_leaderboard_is_one_item_and_only_rewritten_when_it_changes(tables, results):
+    board_table = tables['irStats_Leaderboards']
+    calls = []
+    aws.get_resource('dynamodb').meta.client.meta.events.register(
+        'provide-client-params.dynamodb.*', lambda model, params, **kwargs: calls.append((model.name, params.get('TableName')))
+    )
+
+    process_iracing_data.lambda_handler(sqs_event(results), None)
+    item = board_table.get_item(Key={'CarClass': 'Mazda MX-5 Cup 2016', 'TrackName': TRACK})['Item']
+    assert item['Version'] == 1
+    assert len(item['Race']) == min(leaderboards.LEADERBOARD_SIZE, len(race_results(results)))
+    band = leaderboards.temp_band(item['Race'][0]['w'])
+    assert item['Bands'][band]['Race'] == item['Race'][0]
+
+    #the same results again leave the leaderboard as it is
+    calls.clear()
+    process_iracing_data.lambda_handler(sqs_event(results), None)
+    assert [c for c in calls if c[1] == 'irStats_Leaderboards'] == [('GetItem', 'irStats_Leaderboards')]
+
+    #a faster lap moves to the top
+    faster = copy.deepcopy(results)
+    race_results(faster)[-1]['best_lap_time'] = 500000
+    process_iracing_data.lambda_handler(sqs_event(faster), None)
+    item = board_table.get_item(Key={'CarClass': 'Mazda MX-5 Cup 2016', 'TrackName': TRACK})['Item']
+    assert item['Version'] == 2
+    assert item['Race'][0]['t'] == Decimal('50.0')
+    assert item['Race'][0]['d'] == race_results(faster)[-1]['display_name']
+
+
+def test_update_retries_when_another_writer_wins(tables, results):
+    board_table = tables['irStats_Leaderboards']
+    boards = leaderboards.generate_leaderboard_entries(results)['Mazda MX-5 Cup 2016']
+    real_get_item = board_table.get_item
+    reads = []
+
+    def racing_get_item(**kwargs):
+        response = real_get_item(**kwargs)
+        if not reads:
+            #another writer stores the leaderboard between this read and the write
+            board_table.put_item(Item={'CarClass': 'Mazda MX-5 Cup 2016', 'TrackName': TRACK, 'Version': 7})
+        reads.append(response)
+        return response
+
+    board_table.get_item = racing_get_item
+
+    assert leaderboards.update_leaderboard(board_table, 'Mazda MX-5 Cup 2016', TRACK, boards)
+    assert len(reads) == 2
+    assert real_get_item(Key={'CarClass': 'Mazda MX-5 Cup 2016', 'TrackName': TRACK})['Item']['Version'] == 8
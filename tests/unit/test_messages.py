@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import process_iracing_data
+from irstats_common import messages
+from irstats_common.messages import MessageError, Results, ResultsFetch, SessionSearch
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_messages_round_trip(results, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(messages, 'orjson', None)
+    sent = [
+        SessionSearch('https://members-ng.iracing.com/data/results/search_series', '2022-08-14T00:00Z', '2022-08-15T00:00Z'),
+        ResultsFetch('https://members-ng.iracing.com/data/results/get?subsession_id=1', 1, '2022-08-14T10:34:55Z'),
+        Results.from_results(results),
+    ]
+
+    for message in sent:
+        assert messages.decode(message.encode()) == message
+    assert json.loads(sent[1].encode()) == [2, 'RetrieveData', sent[1].url, 1, '2022-08-14T10:34:55Z']
+
+
+def test_results_are_smaller_and_process_identically(results):
+    message = Results.from_results(results)
+    decoded = messages.decode(message.encode()).to_dict()
+
+    assert len(message.encode()) < len(json.dumps(results)) / 8
+    assert process_iracing_data.get_track_name(decoded) == process_iracing_data.get_track_name(results)
+    assert process_iracing_data.generate_all_class_data(decoded) == process_iracing_data.generate_all_class_data(results)
+
+
+@pytest.mark.parametrize('body', [
+    'not json',
+    '{"type": "RetrieveData"}',
+    '[1, "RetrieveData", "url", 1, null]',
+    '[2, "Unknown", "url"]',
+    '[2, "RetrieveData", "url", 1]',
+    '[2, "RetrieveData", 5, 1, null]',
+    '[2, "Results", 1, null, "2022-08-14T10:34:55Z", [1, "Track", ""], ["F", 80], [[0, "RACE", [["too short"]]]]]',
+])
+def test_messages_not_matching_the_schema_are_rejected(body):
+    with pytest.raises(MessageError):
+        messages.decode(body)
+
+
+def test_results_missing_fields_are_rejected_where_they_enter(results):
+    del results['session_results']
+
+    with pytest.raises(MessageError):
+        Results.from_results(results)
+
+
+def test_tasks_queued_before_the_schema_are_read():
+    legacy = {'type': 'RetrieveData', 'url': 'https://members-ng.iracing.com/data/results/get?subsession_id=1', 'subsession_id': 1}
+
+    assert messages.decode_task(json.dumps(legacy)) == ResultsFetch(legacy['url'], 1, None)
+    assert messages.decode_task({'type': 'GenerateSessionID', 'url': 'search'}) == SessionSearch('search', None, None)
+    with pytest.raises(MessageError):
+        messages.decode_task(Results(1, None, '2022-08-14T10:34:55Z', [1, 'Track', ''], ['F', 80], []).encode())
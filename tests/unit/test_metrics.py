@@ -0,0 +1,98 @@
+import json
+import os
+
+from irstats_common import metrics as metrics_module
+from irstats_common.metrics import Metrics, instrument_handler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_timers_and_counters_accumulate_until_flushed(capsys):
+    clock = FakeClock()
+    metrics = Metrics(namespace='irStats', dimensions={'FunctionName': 'test'}, clock=clock)
+
+    for _ in range(3):
+        with metrics.timer('ApiRequest'):
+            clock.now += 0.25
+    metrics.count('Api429s')
+    metrics.count('QueueMessages', 10)
+
+    @metrics.timed('Parse')
+    def parse():
+        clock.now += 0.5
+        raise ValueError()
+
+    try:
+        parse()
+    except ValueError:
+        pass
+
+    assert metrics.snapshot() == {
+        'ApiRequest': 750.0, 'ApiRequestCalls': 3, 'Api429s': 1, 'QueueMessages': 10, 'Parse': 500.0, 'ParseCalls': 1,
+    }
+
+    metrics.flush()
+    document = json.loads(capsys.readouterr().out)
+    directive = document['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'irStats'
+    assert directive['Dimensions'] == [['FunctionName']]
+    assert {'Name': 'ApiRequest', 'Unit': 'Milliseconds'} in directive['Metrics']
+    assert {'Name': 'Api429s', 'Unit': 'Count'} in directive['Metrics']
+    assert document['FunctionName'] == 'test'
+    assert document['ApiRequest'] == 750.0
+    assert metrics.snapshot() == {}
+
+
+def test_maximum_keeps_the_highest_value(capsys):
+    metrics = Metrics(dimensions={'FunctionName': 'test'})
+    for age in (120, 3600, 45):
+        metrics.maximum('BacklogAge', age)
+
+    assert metrics.snapshot() == {'BacklogAge': 3600}
+    metrics.flush()
+    document = json.loads(capsys.readouterr().out)
+    assert {'Name': 'BacklogAge', 'Unit': 'Seconds'} in document['_aws']['CloudWatchMetrics'][0]['Metrics']
+    assert metrics.snapshot() == {}
+
+
+def test_nothing_is_logged_without_metrics(capsys):
+    Metrics().flush()
+
+    assert capsys.readouterr().out == ''
+
+
+def test_handler_is_timed_and_flushed_once_per_invocation(capsys):
+    @instrument_handler
+    def lambda_handler(event, context):
+        metrics_module.get_metrics().count('Records', len(event['Records']))
+        return {'batchItemFailures': []}
+
+    assert lambda_handler({'Records': [{}, {}]}, None) == {'batchItemFailures': []}
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+    assert len(lines) == 1
+    assert lines[0]['Records'] == 2
+    assert lines[0]['Invocations'] == 1
+    assert lines[0]['HandlerCalls'] == 1
+
+
+def test_profile_mode_dumps_stats(capsys, monkeypatch):
+    monkeypatch.setattr(metrics_module, 'PROFILE', True)
+
+    @instrument_handler
+    def lambda_handler(event, context):
+        return sum(range(1000))
+
+    assert lambda_handler({}, None) == sum(range(1000))
+
+    out = capsys.readouterr().out
+    path = out.split('Profile written to ')[1].split('\n')[0]
+    assert os.path.exists(path)
+    assert 'cumulative' in out
+    os.remove(path)
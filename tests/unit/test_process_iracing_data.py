@@ -0,0 +1,224 @@
+import copy
+import json
+import os
+
+import pytest
+
+import process_iracing_data
+from irstats_common import aws
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def per_class_data(data):
+    return {
+        car_class: process_iracing_data.generate_class_specific_data(car_class, data)
+        for car_class in process_iracing_data.get_car_class_list(data)
+    }
+
+
+def test_generate_all_class_data_single_class(results):
+    all_class_data = process_iracing_data.generate_all_class_data(results)
+
+    assert list(all_class_data) == ['Mazda MX-5 Cup 2016']
+    assert all_class_data == per_class_data(results)
+
+
+def test_generate_all_class_data_multiclass(multiclass_results):
+    all_class_data = process_iracing_data.generate_all_class_data(multiclass_results)
+
+    assert list(all_class_data) == process_iracing_data.get_car_class_list(multiclass_results)
+    assert all_class_data == per_class_data(multiclass_results)
+
+
+def test_generate_all_class_data_ignores_classes_not_in_race(multiclass_results):
+    for session in multiclass_results['session_results']:
+        if session['simsession_name'] == 'QUALIFY':
+            session['results'][0]['car_class_name'] = 'Qualifying Only'
+
+    assert 'Qualifying Only' not in process_iracing_data.generate_all_class_data(multiclass_results)
+
+
+@pytest.fixture()
+def dynamo_table(class_table, count_calls):
+    """ A local stand-in for the irstats_iRacing_Data table, counting the requests made to it"""
+    process_iracing_data.best_laps.clear()
+    return count_calls(class_table())
+
+
+def sqs_event(*bodies):
+    return {'Records': [{'messageId': str(n), 'body': json.dumps(body)} for n, body in enumerate(bodies)]}
+
+
+def test_lambda_handler_round_trips_do_not_grow_with_classes(dynamo_table, multiclass_results):
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+
+    assert dynamo_table.calls == ['BatchGetItem', 'BatchWriteItem']
+    assert dynamo_table.scan()['Count'] == 3
+
+
+def test_lambda_handler_times_class_aggregation_and_writes(dynamo_table, multiclass_results, capsys):  # pylint: disable=unused-argument
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results, multiclass_results), None)
+
+    document = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line][-1]
+    assert document['ClassAggregationCalls'] == 2
+    assert document['DbWriteCalls'] == 1
+
+
+def test_lambda_handler_only_writes_changed_records(dynamo_table, multiclass_results):
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+    dynamo_table.calls.clear()
+
+    #the same results again cannot beat the cached laps, so nothing is read or written
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+    assert dynamo_table.calls == []
+
+    #nor once the cache has expired, when the records are read again
+    process_iracing_data.best_laps.clear()
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+    assert dynamo_table.calls == ['BatchGetItem']
+
+    #a faster race lap in one class should only rewrite that class
+    faster = copy.deepcopy(multiclass_results)
+    race = [s for s in faster['session_results'] if s['simsession_name'] == 'RACE'][0]
+    race['results'][0]['best_lap_time'] = 500000
+    dynamo_table.calls.clear()
+    process_iracing_data.lambda_handler(sqs_event(faster), None)
+
+    assert dynamo_table.calls == ['BatchGetItem', 'BatchWriteItem']
+    item = dynamo_table.get_item(
+        Key={'CarClass': race['results'][0]['car_class_name'], 'TrackName': 'Summit Point Raceway - Jefferson Circuit'}
+    )['Item']
+    assert float(item['fastest_lap']) == 50.0
+
+
+def test_retrieve_existing_data_batch_retries_unprocessed_keys(dynamo_table, monkeypatch):
+    responses = [
+        {'Responses': {'irstats_iRacing_Data': []},
+         'UnprocessedKeys': {'irstats_iRacing_Data': {'Keys': [{'CarClass': 'GT3', 'TrackName': 'Spa'}]}}},
+        {'Responses': {'irstats_iRacing_Data': [{'CarClass': 'GT3', 'TrackName': 'Spa', 'fastest_lap': 137}]}},
+    ]
+    monkeypatch.setattr(process_iracing_data.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(aws.get_resource('dynamodb'), 'batch_get_item', lambda **kwargs: responses.pop(0))
+
+    existing = process_iracing_data.retrieve_existing_data_batch([('GT3', 'Spa'), ('GT4', 'Spa')])
+
+    assert existing == {('GT3', 'Spa'): {'CarClass': 'GT3', 'TrackName': 'Spa', 'fastest_lap': 137}, ('GT4', 'Spa'): {}}
+    assert not responses
+
+
+def test_conditional_mode_never_reads_and_keeps_faster_laps(dynamo_table, multiclass_results, monkeypatch):
+    monkeypatch.setattr(process_iracing_data, 'WRITE_MODE', 'conditional')
+    key = {'CarClass': 'Class 0', 'TrackName': 'Summit Point Raceway - Jefferson Circuit'}
+
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+    assert dynamo_table.calls == ['UpdateItem'] * 6
+    stored = dynamo_table.get_item(Key=key)['Item']
+
+    #slower laps fail their conditions and leave the record alone
+    slower = copy.deepcopy(multiclass_results)
+    for session in slower['session_results']:
+        for driver in session['results']:
+            driver['best_lap_time'] += 10000
+    dynamo_table.calls.clear()
+    process_iracing_data.lambda_handler(sqs_event(slower), None)
+
+    assert 'GetItem' not in dynamo_table.calls and 'BatchGetItem' not in dynamo_table.calls
+    assert dynamo_table.get_item(Key=key)['Item'] == stored
+
+
+def test_conditional_mode_skips_laps_the_cache_says_cannot_win(dynamo_table, multiclass_results, monkeypatch):
+    monkeypatch.setattr(process_iracing_data, 'WRITE_MODE', 'conditional')
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+    dynamo_table.calls.clear()
+
+    process_iracing_data.lambda_handler(sqs_event(multiclass_results), None)
+    assert dynamo_table.calls == []
+
+    #a stale entry, slower than the stored lap, lets a lap through which the condition then rejects
+    key = ('Class 0', 'Summit Point Raceway - Jefferson Circuit')
+    stored = dynamo_table.get_item(Key={'CarClass': key[0], 'TrackName': key[1]})['Item']['fastest_lap']
+    process_iracing_data.best_laps.store(key, {'fastest_lap': stored + 100})
+    slower = {'fastest_lap': float(stored) + 1, 'fastest_lap_driver': 'A Driver'}
+
+    assert not process_iracing_data.persist_class_records_conditionally({key: slower})
+    assert dynamo_table.get_item(Key={'CarClass': key[0], 'TrackName': key[1]})['Item']['fastest_lap'] == stored
+    #and the failed condition puts the stored lap back in the cache
+    assert process_iracing_data.best_laps.get(key)['fastest_lap'] == stored
+
+
+def test_conditional_update_replaces_null_lap(dynamo_table):
+    key = {'CarClass': 'GT3', 'TrackName': 'Spa'}
+    dynamo_table.put_item(Item=dict(key, pole_time=None, fastest_lap=None))
+    class_data = {'pole_time': None, 'fastest_lap': 137.5, 'fastest_lap_ir': 2500,
+                  'fastest_lap_driver': 'A Driver', 'fastest_lap_car': 'A Car', 'fastest_lap_temp': 21.0}
+
+    assert not process_iracing_data.run_conditional_update('GT3', 'Spa', class_data, 'pole_time')
+    assert process_iracing_data.run_conditional_update('GT3', 'Spa', class_data, 'fastest_lap')
+    assert not process_iracing_data.run_conditional_update('GT3', 'Spa', class_data, 'fastest_lap')
+    assert float(dynamo_table.get_item(Key=key)['Item']['fastest_lap']) == 137.5
+
+
+def class_data(lap, driver):
+    return {'pole_time': lap, 'pole_ir': 2000, 'pole_driver': driver, 'pole_car': 'A Car', 'pole_temp': 20.0,
+            'fastest_lap': lap, 'fastest_lap_ir': 2000, 'fastest_lap_driver': driver,
+            'fastest_lap_car': 'A Car', 'fastest_lap_temp': 20.0}
+
+
+@pytest.mark.parametrize('first_mode', ['batch', 'conditional'])
+def test_both_write_modes_store_the_same_attributes(dynamo_table, first_mode):
+    key = ('GT3', 'Spa')
+    writes = {
+        'batch': process_iracing_data.persist_class_records,
+        'conditional': process_iracing_data.persist_class_records_conditionally,
+    }
+    second_mode = 'conditional' if first_mode == 'batch' else 'batch'
+
+    writes[first_mode]({key: class_data(140.0, 'First Driver')})
+    first = dynamo_table.get_item(Key={'CarClass': key[0], 'TrackName': key[1]})['Item']
+    process_iracing_data.best_laps.clear()
+    writes[second_mode]({key: class_data(130.0, 'Second Driver')})
+    second = dynamo_table.get_item(Key={'CarClass': key[0], 'TrackName': key[1]})['Item']
+
+    assert set(first) == set(second) == {'CarClass', 'TrackName'} | {
+        attribute for group in process_iracing_data.LAP_GROUPS.values() for attribute in group
+    }
+    assert second['pole_time'] == second['fastest_lap'] == 130
+    assert second['pole_time_driver'] == second['fastest_lap_driver'] == 'Second Driver'
+
+
+def test_lambda_handler_coalesces_batch_and_reports_failures(dynamo_table, multiclass_results):
+    faster = copy.deepcopy(multiclass_results)
+    race = [s for s in faster['session_results'] if s['simsession_name'] == 'RACE'][0]
+    race['results'][0]['best_lap_time'] = 500000
+    event = sqs_event(multiclass_results, faster, multiclass_results)
+    event['Records'].append({'messageId': 'bad', 'body': '{"not": "results"}'})
+
+    ret = process_iracing_data.lambda_handler(event, None)
+
+    assert ret == {'batchItemFailures': [{'itemIdentifier': 'bad'}]}
+    assert dynamo_table.calls == ['BatchGetItem', 'BatchWriteItem']
+    item = dynamo_table.get_item(
+        Key={'CarClass': race['results'][0]['car_class_name'], 'TrackName': 'Summit Point Raceway - Jefferson Circuit'}
+    )['Item']
+    assert float(item['fastest_lap']) == 50.0
+
+
+def test_lambda_handler_reports_records_behind_failed_writes(dynamo_table, multiclass_results, monkeypatch):
+    def fail(class_records):
+        raise RuntimeError('DynamoDB unavailable')
+    monkeypatch.setattr(process_iracing_data, 'persist_class_records', fail)
+
+    ret = process_iracing_data.lambda_handler(sqs_event(multiclass_results, multiclass_results), None)
+
+    assert ret == {'batchItemFailures': [{'itemIdentifier': '0'}, {'itemIdentifier': '1'}]}
+
+
+def test_importing_the_handler_does_not_load_boto3():
+    import subprocess  # pylint: disable=import-outside-toplevel
+    import sys  # pylint: disable=import-outside-toplevel
+    code = ("import sys; sys.path[:0] = ['common', 'process_iRacing_data']; "
+            "import process_iracing_data; print('boto3' in sys.modules)")
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=dict(os.environ, table_name='irstats_iRacing_Data'),
+                         check=True, capture_output=True, text=True).stdout
+    assert out.strip() == 'False'
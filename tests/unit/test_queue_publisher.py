@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+import queuePublisher
+from irstats_common import aws
+from irstats_common import metrics as metrics_module
+
+
+@pytest.fixture()
+def queue(mock_aws, count_calls):  # pylint: disable=unused-argument
+    """ A local SQS queue, counting the requests made to it"""
+    return count_calls(aws.get_resource('sqs').create_queue(QueueName='irStats_iRacingDataProcessingQueue'))
+
+
+def received(queue):
+    bodies = []
+    while True:
+        messages = queue.receive_messages(MaxNumberOfMessages=10)
+        if not messages:
+            return bodies
+        bodies.extend(m.body for m in messages)
+        queue.delete_messages(Entries=[{'Id': m.message_id, 'ReceiptHandle': m.receipt_handle} for m in messages])
+
+
+@pytest.mark.parametrize('parallelism', [1, 3])
+def test_messages_are_sent_in_batches_of_ten(queue, parallelism, monkeypatch):
+    metrics = metrics_module.Metrics()
+    monkeypatch.setattr(metrics_module, '_metrics', metrics)
+    with queuePublisher.QueuePublisher(queue, parallelism=parallelism) as publisher:
+        for n in range(25):
+            publisher.send(f'message {n}')
+
+    assert queue.calls == ['SendMessageBatch'] * 3
+    assert publisher.metrics() == {'messages': 25, 'calls': 3, 'retries': 0, 'callsPerMessage': 0.12}
+    assert {name: value for name, value in metrics.snapshot().items() if name != 'QueueSendBatch'} == {
+        'QueueCalls': 3, 'QueueMessages': 25, 'QueueRetries': 0, 'QueueSendBatchCalls': 3
+    }
+    assert sorted(received(queue)) == sorted(f'message {n}' for n in range(25))
+
+
+def test_batches_respect_the_size_limit(queue):
+    with queuePublisher.QueuePublisher(queue) as publisher:
+        for n in range(4):
+            publisher.send(str(n) * 100 * 1024)
+
+    assert publisher.calls == 2
+    with pytest.raises(ValueError):
+        publisher.send('x' * (256 * 1024 + 1))
+
+
+def test_only_failed_entries_are_retried(queue, monkeypatch):
+    sent = []
+    def send_message_batch(QueueUrl, Entries):
+        sent.append([e['MessageBody'] for e in Entries])
+        if len(sent) == 1:
+            return {'Successful': [], 'Failed': [
+                {'Id': Entries[1]['Id'], 'SenderFault': False, 'Code': 'InternalError'},
+                {'Id': Entries[2]['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents'},
+            ]}
+        return {'Successful': [], 'Failed': []}
+    publisher = queuePublisher.QueuePublisher(queue, parallelism=1)
+    monkeypatch.setattr(publisher.client, 'send_message_batch', send_message_batch)
+
+    for n in range(3):
+        publisher.send(f'message {n}', tag=n)
+
+    assert publisher.flush() == [2]
+    assert sent == [['message 0', 'message 1', 'message 2'], ['message 1']]
+    assert publisher.retries == 1
+
+
+def test_batches_waiting_to_be_sent_are_bounded_when_sqs_is_slow(queue, monkeypatch):
+    publisher = queuePublisher.QueuePublisher(queue, parallelism=2)
+    send_message_batch = publisher.client.send_message_batch
+
+    def slow_send_message_batch(**kwargs):
+        time.sleep(0.02)
+        return send_message_batch(**kwargs)
+
+    monkeypatch.setattr(publisher.client, 'send_message_batch', slow_send_message_batch)
+    waiting = []
+    with publisher:
+        for n in range(100):
+            publisher.send(f'message {n}')
+            waiting.append(len(publisher._futures))  # pylint: disable=protected-access
+
+    assert max(waiting) == 2 * queuePublisher.maxQueuedPerWorker
+    assert len(received(queue)) == 100
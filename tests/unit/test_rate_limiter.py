@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+import rateLimiter
+from benchmarks.stub_server import StubServer
+
+
+class QuotaRoute:
+    """ Allows limit requests per window seconds, answering any more with a 429"""
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.reset = time.time() + window
+        self.used = 0
+        self.throttled = 0
+
+    def __call__(self, handler):
+        now = time.time()
+        if now >= self.reset:
+            self.reset = now + self.window
+            self.used = 0
+        self.used += 1
+        headers = {
+            'x-ratelimit-limit': str(self.limit),
+            'x-ratelimit-remaining': str(max(0, self.limit - self.used)),
+            'x-ratelimit-reset': str(self.reset),
+        }
+        if self.used > self.limit:
+            self.throttled += 1
+            return 429, headers, 'rate limited'
+        return 200, headers, '{}'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_requests_are_paced_across_the_window():
+    clock = FakeClock()
+    limiter = rateLimiter.RateLimiter(burst=1, maxWait=60, clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    limiter.update({'x-ratelimit-remaining': '10', 'x-ratelimit-reset': '1010'})
+
+    for _ in range(9):
+        limiter.acquire()
+
+    assert clock.now == pytest.approx(1009)
+    assert limiter.remaining == 1
+
+
+def test_exhausted_budget_raises_rate_limited():
+    clock = FakeClock()
+    limiter = rateLimiter.RateLimiter(maxWait=20, clock=clock, sleep=clock.sleep)
+    limiter.throttled({'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '1300'})
+
+    with pytest.raises(rateLimiter.RateLimited) as e:
+        limiter.acquire()
+    assert e.value.retryAfter == 300
+
+
+def test_stub_server_quota_is_never_exceeded():
+    route = QuotaRoute(limit=8, window=1.0)
+    limiter = rateLimiter.RateLimiter(burst=2, maxWait=5)
+    with StubServer({'/data': route}) as server:
+        for _ in range(20):
+            assert limiter.get(f'{server.url}/data').status_code == 200
+
+    assert route.throttled <= 1
+
+
+def test_429_is_retried_then_requeued(monkeypatch):
+    monkeypatch.setattr(rateLimiter, 'maxRetries', 2)
+    route = QuotaRoute(limit=0, window=600)
+    limiter = rateLimiter.RateLimiter(maxWait=5, sleep=lambda seconds: None)
+    with StubServer({'/data': route}) as server:
+        with pytest.raises(rateLimiter.RateLimited) as e:
+            limiter.get(f'{server.url}/data')
+
+    assert route.throttled == 1
+    assert e.value.retryAfter > 500
+
+
+def test_backlog_share_keeps_budget_for_fresh_requests():
+    clock = FakeClock()
+    limiter = rateLimiter.RateLimiter(burst=10, maxWait=20, clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    limiter.update({'x-ratelimit-limit': '10', 'x-ratelimit-remaining': '9', 'x-ratelimit-reset': '1300'})
+
+    #half of the budget is kept back from requests given a half share
+    for _ in range(4):
+        limiter.acquire(share=0.5)
+    with pytest.raises(rateLimiter.RateLimited):
+        limiter.acquire(share=0.5)
+
+    #while requests with the whole budget can still use what is left
+    limiter.acquire()
+    assert limiter.remaining == 4
@@ -0,0 +1,105 @@
+import json
+import os
+
+import pytest
+
+import process_iracing_data
+import results_export
+from irstats_common import aws
+
+np = pytest.importorskip('numpy')
+pa = pytest.importorskip('pyarrow')
+
+from analytics import lap_percentiles  # pylint: disable=wrong-import-position
+
+TRACK = 'Summit Point Raceway - Jefferson Circuit'
+
+
+def test_every_driver_row_is_flattened(results):
+    columns = results_export.flatten_results(results, TRACK)
+
+    drivers = [j for session in results['session_results'] for j in session['results']]
+    assert set(columns) == set(results_export.COLUMNS)
+    assert all(len(values) == len(drivers) for values in columns.values())
+    assert columns['best_lap_time'] == [j['best_lap_time'] / 10000 if j['best_lap_time'] > 0 else None for j in drivers]
+    assert results_export.get_week(columns['end_time'][0]) == '2022-W32'
+
+
+def test_rows_are_partitioned_by_track_and_week_and_read_back_once(results, tmp_path):
+    columns = results_export.flatten_results(results, TRACK)
+    later = json.loads(json.dumps(results))
+    later['end_time'] = '2022-08-22T10:34:55Z'
+    later['subsession_id'] += 1
+    columns = results_export.extend_columns(columns, results_export.flatten_results(later, TRACK))
+
+    paths = results_export.export_rows(columns, str(tmp_path))
+    #a retried batch writes the same rows again
+    results_export.export_rows(columns, str(tmp_path))
+
+    assert sorted(os.path.relpath(p, tmp_path).split(os.sep)[1] for p in paths) == ['week=2022-W32', 'week=2022-W34']
+    table = lap_percentiles.load_laps(str(tmp_path))
+    race = [j['best_lap_time'] / 10000 for s in results['session_results'] if s['simsession_name'] == 'RACE'
+            for j in s['results'] if j['best_lap_time'] > 0]
+    assert table.num_rows == 2 * len(race)
+
+
+def test_rows_without_a_customer_id_are_not_taken_as_duplicates(results, tmp_path):
+    for session in results['session_results']:
+        for driver in session['results']:
+            del driver['cust_id']
+    columns = results_export.flatten_results(results, TRACK)
+
+    results_export.export_rows(columns, str(tmp_path))
+    results_export.export_rows(columns, str(tmp_path))
+
+    race = [j for s in results['session_results'] if s['simsession_name'] == 'RACE'
+            for j in s['results'] if j['best_lap_time'] > 0]
+    assert lap_percentiles.load_laps(str(tmp_path)).num_rows == len(race)
+
+
+def test_percentiles_match_numpy_for_every_group():
+    rng = np.random.default_rng(3)
+    classes = rng.integers(0, 4, 5000)
+    tracks = rng.integers(0, 7, 5000)
+    laps = 60 + tracks + rng.random(5000)
+    table = pa.table({
+        'car_class': [f"Class {c}" for c in classes],
+        'track': [f"Track {t}" for t in tracks],
+        'best_lap_time': laps,
+    })
+
+    stats = lap_percentiles.lap_percentiles(table, percentiles=(0, 12.5, 50, 99, 100))
+
+    assert len(stats) == 28
+    for (car_class, track), group in stats.items():
+        mask = (classes == int(car_class[-1])) & (tracks == int(track[-1]))
+        assert group['count'] == mask.sum()
+        expected = np.percentile(laps[mask], [0, 12.5, 50, 99, 100])
+        assert np.allclose([group[p] for p in (0, 12.5, 50, 99, 100)], expected)
+
+
+def test_lambda_handler_exports_to_s3(results, class_table, monkeypatch):
+    s3 = aws.get_client('s3')
+    s3.create_bucket(Bucket='irstats-storage', CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+    class_table()
+    monkeypatch.setattr(results_export, 'EXPORT_PATH', 's3://irstats-storage/analytics/results')
+
+    ret = process_iracing_data.lambda_handler({'Records': [{'messageId': '0', 'body': json.dumps(results)}]}, None)
+
+    assert ret == {'batchItemFailures': []}
+    keys = [o['Key'] for o in s3.list_objects_v2(Bucket='irstats-storage')['Contents']]
+    assert len(keys) == 1
+    assert keys[0].startswith('analytics/results/track=Summit%20Point%20Raceway%20-%20Jefferson%20Circuit/week=2022-W32/')
+
+
+def test_export_is_turned_off_without_pyarrow(monkeypatch, capsys):
+    import importlib  # pylint: disable=import-outside-toplevel
+    monkeypatch.setenv('analytics_export_path', 's3://irstats-storage/analytics/results')
+    monkeypatch.setattr(importlib.util, 'find_spec', lambda name: None)
+    try:
+        importlib.reload(results_export)
+        assert results_export.EXPORT_PATH is None
+        assert 'pyarrow is not installed' in capsys.readouterr().out
+    finally:
+        monkeypatch.undo()
+        importlib.reload(results_export)
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import scheduler
+from irstats_common import aws, priority
+from irstats_common.messages import ResultsFetch, decode
+
+NOW = datetime(2022, 8, 15, 12, 0, tzinfo=timezone.utc)
+
+
+def finished(hours_ago):
+    return (NOW - timedelta(hours=hours_ago)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def test_tier_is_worked_out_from_the_age_of_the_work():
+    assert priority.tier_for(finished(1), NOW, max_age=6 * 3600) == priority.FRESH
+    assert priority.tier_for(finished(7), NOW, max_age=6 * 3600) == priority.BACKLOG
+    #windows are given to the minute
+    assert priority.tier_for('2022-08-15T11:45Z', NOW, max_age=6 * 3600) == priority.FRESH
+    #messages without a finish time are never starved
+    assert priority.tier_for(None) == priority.FRESH
+    assert priority.age_seconds(finished(2), NOW) == 7200
+
+
+@pytest.fixture()
+def queues(mock_aws):  # pylint: disable=unused-argument
+    """ Local fresh and backlog queues"""
+    sqs = aws.get_resource('sqs')
+    return {
+        priority.FRESH: sqs.create_queue(QueueName='irStats_iRacingApiQueryQueue'),
+        priority.BACKLOG: sqs.create_queue(QueueName='irStats_iRacingBacklogQueue'),
+    }
+
+
+def received(queue):
+    bodies = []
+    while True:
+        messages = queue.receive_messages(MaxNumberOfMessages=10)
+        if not messages:
+            return bodies
+        bodies.extend(decode(m.body) for m in messages)
+        queue.delete_messages(Entries=[{'Id': m.message_id, 'ReceiptHandle': m.receipt_handle} for m in messages])
+
+
+def test_work_is_queued_for_its_tier(queues):
+    s = scheduler.Scheduler({tier: (lambda q=queue: q) for tier, queue in queues.items()}, maxAge=6 * 3600)
+    with s.publisher() as publisher:
+        for n, hours in enumerate((0, 1, 8, 30, 2)):
+            message = ResultsFetch(f'/data/results/get?subsession_id={n}', n, finished(hours))
+            publisher.send(message.encode(), s.tierOf(message, NOW), tag=n)
+
+    assert sorted(m.subsession_id for m in received(queues[priority.FRESH])) == [0, 1, 4]
+    assert sorted(m.subsession_id for m in received(queues[priority.BACKLOG])) == [2, 3]
+    assert publisher.metrics()[priority.BACKLOG]['messages'] == 2
+
+
+def test_backlog_goes_to_the_fresh_queue_without_a_backlog_queue(queues):
+    s = scheduler.Scheduler({priority.FRESH: lambda: queues[priority.FRESH], priority.BACKLOG: None})
+
+    assert s.queue(priority.BACKLOG) is queues[priority.FRESH]
+
+
+def test_rate_share_follows_the_running_tier():
+    s = scheduler.Scheduler({}, rateShares={priority.FRESH: 1.0, priority.BACKLOG: 0.25})
+
+    assert s.rateShare() == 1.0
+    with s.running(priority.BACKLOG):
+        assert s.rateShare() == 0.25
+    assert s.currentTier() == priority.FRESH
@@ -0,0 +1,105 @@
+import pytest
+
+import subsessionIndex
+from irstats_common import aws
+from irstats_common import metrics as metrics_module
+
+
+@pytest.fixture()
+def table(mock_aws, count_calls):  # pylint: disable=unused-argument
+    """ A local irStats_Processed_Subsessions table, counting the requests made to it"""
+    return count_calls(aws.get_resource('dynamodb').create_table(
+        TableName='irStats_Processed_Subsessions',
+        KeySchema=[{'AttributeName': 'SubsessionId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'SubsessionId', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST',
+    ))
+
+
+def test_claim_only_succeeds_once(table):
+    index = subsessionIndex.SubsessionIndex(table, clock=lambda: 1000)
+
+    assert index.claim(50374456)
+    assert not index.claim(50374456)
+    #a new container has a cold cache but the table still knows the subsession
+    assert not subsessionIndex.SubsessionIndex(table, clock=lambda: 1000).claim(50374456)
+
+    assert table.calls == ['PutItem', 'PutItem']
+    assert table.get_item(Key={'SubsessionId': 50374456})['Item']['ExpiresAt'] == 1000 + subsessionIndex.ttlSeconds
+    assert index.metrics() == {'localHits': 1, 'tableHits': 0, 'misses': 1, 'hitRate': 0.5}
+
+
+def test_done_subsessions_are_not_fetched_again(table):
+    index = subsessionIndex.SubsessionIndex(table)
+    index.claim(1)
+
+    assert not index.isDone(1)
+    index.markDone(1)
+    assert index.isDone(1)
+    assert subsessionIndex.SubsessionIndex(table).isDone(1)
+
+
+def test_released_subsessions_can_be_claimed_again(table):
+    index = subsessionIndex.SubsessionIndex(table)
+    index.claim(1)
+    index.release(1)
+
+    assert index.claim(1)
+
+
+def test_lapsed_claims_can_be_claimed_again(table):
+    now = [1000]
+    index = subsessionIndex.SubsessionIndex(table, clock=lambda: now[0], claimTimeoutSeconds=600)
+    other = subsessionIndex.SubsessionIndex(table, clock=lambda: now[0], claimTimeoutSeconds=600)
+    assert index.claim(1)
+
+    now[0] += 599
+    assert not index.claim(1)
+    #the fetch was never sent, e.g. the Lambda timed out after claiming
+    now[0] += 1
+    assert other.claim(1)
+    assert table.get_item(Key={'SubsessionId': 1})['Item']['ClaimedAt'] == 1600
+    assert not index.claim(1)
+
+
+def test_done_subsessions_are_never_claimed_again(table):
+    now = [1000]
+    index = subsessionIndex.SubsessionIndex(table, clock=lambda: now[0], claimTimeoutSeconds=600)
+    index.claim(1)
+    index.markDone(1)
+    now[0] += 3600
+
+    assert not index.claim(1)
+    assert not subsessionIndex.SubsessionIndex(table, clock=lambda: now[0], claimTimeoutSeconds=600).claim(1)
+
+
+def test_claims_without_a_claim_time_have_lapsed(table):
+    table.put_item(Item={'SubsessionId': 1, 'Status': subsessionIndex.QUEUED, 'ExpiresAt': 10 ** 10})
+
+    assert subsessionIndex.SubsessionIndex(table).claim(1)
+
+
+def test_lookups_are_counted(table, monkeypatch):
+    metrics = metrics_module.Metrics()
+    monkeypatch.setattr(metrics_module, '_metrics', metrics)
+    index = subsessionIndex.SubsessionIndex(table)
+    index.claim(1)
+    index.claim(1)
+    subsessionIndex.SubsessionIndex(table).claim(1)
+
+    assert metrics.snapshot() == {'IndexMisses': 1, 'IndexLocalHits': 1, 'IndexTableHits': 1}
+
+
+def test_local_cache_is_bounded(table):
+    index = subsessionIndex.SubsessionIndex(table, maxLocalEntries=2)
+    for n in range(3):
+        index.claim(n)
+
+    assert list(index.local) == [1, 2]
+
+
+def test_no_table_treats_everything_as_new():
+    index = subsessionIndex.SubsessionIndex(None)
+
+    assert index.claim(1) and index.claim(1)
+    assert not index.isDone(1)
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+yaml = pytest.importorskip('yaml')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """ Reads CloudFormation tags such as !Ref as (tag, value) pairs"""
+
+
+TemplateLoader.add_multi_constructor('!', lambda loader, tag, node: (tag, loader.construct_scalar(node))
+                                     if isinstance(node, yaml.ScalarNode) else (tag, None))
+
+
+def refs(value):
+    if isinstance(value, tuple) and value[0] in ('Ref', 'GetAtt'):
+        yield value[1].split('.')[0]
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from refs(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from refs(v)
+
+
+def load_template():
+    with open(os.path.join(ROOT, 'template.yaml'), encoding='utf-8') as f:
+        return yaml.load(f, Loader=TemplateLoader)
+
+
+def test_template_parses_and_every_reference_exists():
+    template = load_template()
+
+    assert {'Parameters', 'Globals', 'Resources'} <= set(template)
+    names = set(template['Parameters']) | set(template['Resources'])
+    assert set(refs(template['Resources'])) <= names
+    assert set(refs(template['Globals'])) <= names
+
+
+def test_every_queue_feeding_a_function_has_a_dead_letter_queue():
+    resources = load_template()['Resources']
+    sources = [
+        event['Properties']['Queue'][1].split('.')[0]
+        for resource in resources.values() if resource['Type'] == 'AWS::Serverless::Function'
+        for event in resource['Properties'].get('Events', {}).values() if event['Type'] == 'SQS'
+    ]
+
+    assert set(sources) == {'SQSQueueiRacingQueries', 'SQSQueueiRacingBacklog', 'SQSQueueiRacingData'}
+    for name in sources:
+        policy = resources[name]['Properties']['RedrivePolicy']
+        dead_letters = policy['deadLetterTargetArn'][1].split('.')[0]
+        assert resources[dead_letters]['Type'] == 'AWS::SQS::Queue'
+        assert 'RedrivePolicy' not in resources[dead_letters]['Properties']
+        assert policy['maxReceiveCount'] == ('Ref', 'QueueMaxReceiveCount')
+
+
+def test_queues_stay_hidden_while_their_function_runs():
+    template = load_template()
+    resources = template['Resources']
+    for resource in resources.values():
+        if resource['Type'] != 'AWS::Serverless::Function':
+            continue
+        timeout = resource['Properties'].get('Timeout', template['Globals']['Function']['Timeout'])
+        for event in resource['Properties'].get('Events', {}).values():
+            if event['Type'] == 'SQS':
+                queue = resources[event['Properties']['Queue'][1].split('.')[0]]
+                assert queue['Properties']['VisibilityTimeout'] >= 6 * timeout
@@ -0,0 +1,62 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from irstats_common import timestamps
+
+dateutil_parser = pytest.importorskip('dateutil.parser')
+
+
+@pytest.fixture()
+def end_times(results):
+    """ The end_time of the sample event, along with a spread of times in the same form"""
+    rng = random.Random(7)
+    start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    generated = [
+        (start + timedelta(seconds=rng.randrange(6 * 365 * 86400))).strftime('%Y-%m-%dT%H:%M:%SZ') for _ in range(2000)
+    ]
+    return [results['end_time'], results['start_time']] + generated
+
+
+UNUSUAL = [
+    '2022-08-14T10:34:55.123Z',
+    '2022-08-14T10:34:55.5Z',
+    '2022-08-14T11:34:55+01:00',
+    '2022-08-14T10:34Z',
+    '2022-08-14 10:34:55Z',
+    '20220814T103455Z',
+    '2022-08-14T10:34:55 +00:00',
+]
+
+
+def test_canonical_times_parse_as_dateutil_does(end_times):
+    for value in end_times:
+        assert timestamps.is_canonical(value)
+        assert timestamps.parse_time(value) == dateutil_parser.parse(value)
+
+
+@pytest.mark.parametrize('value', UNUSUAL)
+def test_unusual_times_parse_as_dateutil_does(value):
+    assert not timestamps.is_canonical(value)
+    assert timestamps.parse_time(value) == dateutil_parser.parse(value)
+
+
+def test_times_without_an_offset_are_utc():
+    assert timestamps.parse_time('2022-08-14T10:34:55') == datetime(2022, 8, 14, 10, 34, 55, tzinfo=timezone.utc)
+
+
+def test_latest_matches_the_latest_parsed_time(end_times):
+    rng = random.Random(11)
+    for _ in range(20):
+        values = rng.sample(end_times, 50) + rng.sample(UNUSUAL, 2)
+        expected = max(dateutil_parser.parse(v) for v in values).replace(microsecond=0)
+        assert timestamps.parse_time(timestamps.latest(values)) == expected
+
+
+def test_latest_of_nothing_is_none():
+    assert timestamps.latest([]) is None
+
+
+def test_watermark_format_round_trips():
+    assert timestamps.parse_time('2022-08-15T00:00Z').strftime('%Y-%m-%dT%H:%MZ') == '2022-08-15T00:00Z'